@@ -2,11 +2,10 @@ import argparse
 import cv2
 import glob
 import os
-from basicsr.archs.rrdbnet_arch import RRDBNet
+import torch
 from basicsr.utils.download_util import load_file_from_url
 
-from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan import RealESRGANer, build_model
 
 # Import configuration system
 try:
@@ -17,6 +16,22 @@ except ImportError:
     print("DEBUG: Warning: upscaler_config not found, using default paths")
 
 
+def default_weights_dir():
+    if USE_CONFIG:
+        return str(upscaler_config.weights_dir)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights')
+
+
+def int8_model_path(model_name):
+    """Where quantize_realesrgan.py saves the INT8 TorchScript model for model_name."""
+    return os.path.join(default_weights_dir(), f'{model_name}_int8.pt')
+
+
+def onnx_model_path(model_name):
+    """Where scripts/pytorch2onnx.py saves the ONNX model for model_name."""
+    return os.path.join(default_weights_dir(), f'{model_name}.onnx')
+
+
 def main():
     """Inference demo for Real-ESRGAN.
     """
@@ -58,6 +73,18 @@ def main():
     parser.add_argument('--face_enhance', action='store_true', help='Use GFPGAN to enhance face')
     parser.add_argument(
         '--fp32', action='store_true', help='Use fp32 precision during inference. Default: fp16 (half precision).')
+    parser.add_argument(
+        '--int8',
+        action='store_true',
+        help='Use the INT8 model written by quantize_realesrgan.py if it exists (CPU only)')
+    parser.add_argument(
+        '--backend',
+        type=str,
+        default='torch',
+        choices=['torch', 'onnxruntime'],
+        help='Inference backend. onnxruntime runs the model exported by scripts/pytorch2onnx.py on the CPU')
+    parser.add_argument(
+        '--num_threads', type=int, default=0, help='onnxruntime intra-op threads, 0 lets onnxruntime decide')
     parser.add_argument(
         '--alpha_upsampler',
         type=str,
@@ -77,38 +104,24 @@ def main():
 
     # determine models according to model names
     args.model_name = args.model_name.split('.')[0]
-    # ... (Model determination code remains the same) ...
-    if args.model_name == 'RealESRGAN_x4plus':  # x4 RRDBNet model
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
-        netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth']
-    elif args.model_name == 'RealESRNet_x4plus':  # x4 RRDBNet model
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
-        netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth']
-    elif args.model_name == 'RealESRGAN_x4plus_anime_6B':  # x4 RRDBNet model with 6 blocks
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-        netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth']
-    elif args.model_name == 'RealESRGAN_x2plus':  # x2 RRDBNet model
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
-        netscale = 2
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth']
-    elif args.model_name == 'realesr-animevideov3':  # x4 VGG-style model (XS size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
-        netscale = 4
-        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth']
-    elif args.model_name == 'realesr-general-x4v3':  # x4 VGG-style model (S size)
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
-        netscale = 4
-        file_url = [
-            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
-            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth'
-        ]
+    model, netscale, file_url = build_model(args.model_name)
 
+    onnx_path = onnx_model_path(args.model_name) if args.backend == 'onnxruntime' else None
+    if onnx_path and not os.path.isfile(onnx_path):
+        print(f"DEBUG: ONNX model NOT found: {onnx_path}. Run scripts/pytorch2onnx.py; using the torch backend")
+        onnx_path = None
+    int8_path = int8_model_path(args.model_name) if args.int8 and not onnx_path else None
+    if int8_path and not os.path.isfile(int8_path):
+        print(f"DEBUG: INT8 model NOT found: {int8_path}. Run quantize_realesrgan.py; using the float model")
+        int8_path = None
 
     # determine model paths
-    if args.model_path is not None:
+    if onnx_path:
+        model_path = onnx_path
+        print(f"DEBUG: Using ONNX model: {onnx_path}")
+    elif int8_path:
+        model_path = None
+    elif args.model_path is not None:
         model_path = args.model_path
     else:
         if USE_CONFIG:
@@ -132,11 +145,20 @@ def main():
 
     # use dni to control the denoise strength
     dni_weight = None
-    if args.model_name == 'realesr-general-x4v3' and args.denoise_strength != 1:
+    exported = onnx_path or int8_path  # denoise strength is baked in at export time
+    if args.model_name == 'realesr-general-x4v3' and args.denoise_strength != 1 and not exported:
         wdn_model_path = model_path.replace('realesr-general-x4v3', 'realesr-general-wdn-x4v3')
         model_path = [model_path, wdn_model_path]
         dni_weight = [args.denoise_strength, 1 - args.denoise_strength]
 
+    # the INT8 TorchScript model has its weights baked in and only runs on the CPU
+    device = None
+    half = not args.fp32
+    if int8_path:
+        print(f"DEBUG: Using INT8 model: {int8_path}")
+        model = torch.jit.load(int8_path, map_location='cpu')
+        device, half = torch.device('cpu'), False
+
     # restorer
     print("DEBUG: Initializing RealESRGANer (This is where VRAM/Model load issues often happen)...")
     upsampler = RealESRGANer(
@@ -147,8 +169,11 @@ def main():
         tile=args.tile,
         tile_pad=args.tile_pad,
         pre_pad=args.pre_pad,
-        half=not args.fp32,
-        gpu_id=args.gpu_id)
+        half=half,
+        device=device,
+        gpu_id=args.gpu_id,
+        backend='onnxruntime' if onnx_path else 'torch',
+        num_threads=args.num_threads)
     print("DEBUG: RealESRGANer initialized successfully.")
 
     if args.face_enhance:  # Use GFPGAN for face enhancement
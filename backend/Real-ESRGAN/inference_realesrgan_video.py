@@ -17,13 +17,17 @@ from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
 try:
     import ffmpeg
-except ImportError:
-    import pip
-    pip.main(['install', '--user', 'ffmpeg-python'])
-    import ffmpeg
+except ImportError:  # only video input and output need it, see require_ffmpeg
+    ffmpeg = None
+
+
+def require_ffmpeg():
+    if ffmpeg is None:
+        raise ImportError('Video input and output need ffmpeg-python: pip install ffmpeg-python')
 
 
 def get_video_meta_info(video_path):
+    require_ffmpeg()
     ret = {}
     probe = ffmpeg.probe(video_path)
     video_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'video']
@@ -64,6 +68,7 @@ class Reader:
         self.audio = None
         self.input_fps = None
         if self.input_type.startswith('video'):
+            require_ffmpeg()
             video_path = get_sub_video(args, total_workers, worker_idx)
             self.stream_reader = (
                 ffmpeg.input(video_path).output('pipe:', format='rawvideo', pix_fmt='bgr24',
@@ -137,6 +142,7 @@ class Reader:
 class Writer:
 
     def __init__(self, args, audio, height, width, video_save_path, fps):
+        require_ffmpeg()
         out_width, out_height = int(width * args.outscale), int(height * args.outscale)
         if out_height > 2160:
             print('You are generating video that is larger than 4K, which will be very slow due to IO speed.',
@@ -370,6 +376,7 @@ def main():
         default='auto',
         help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs')
     args = parser.parse_args()
+    require_ffmpeg()
 
     args.input = args.input.rstrip('/').rstrip('\\')
     os.makedirs(args.output, exist_ok=True)
@@ -0,0 +1,148 @@
+import argparse
+import cv2
+import glob
+import os
+import time
+import torch
+from basicsr.metrics import calculate_psnr, calculate_ssim
+from basicsr.utils.download_util import load_file_from_url
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from inference_realesrgan import default_weights_dir, int8_model_path
+from realesrgan import RealESRGANer, build_model
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+
+def load_calibration_images(folder, limit, max_size):
+    """Reads up to `limit` BGR images from `folder`, downscaled so the longer side is at most `max_size`."""
+    paths = sorted(glob.glob(os.path.join(folder, '*')))
+    images = []
+    for path in paths:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        h, w = img.shape[:2]
+        if max(h, w) > max_size:
+            ratio = max_size / max(h, w)
+            img = cv2.resize(img, (round(w * ratio), round(h * ratio)), interpolation=cv2.INTER_AREA)
+        images.append(img)
+        if len(images) == limit:
+            break
+    return images
+
+
+def to_tensor(img):
+    img = torch.from_numpy(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).float().div_(255.)
+    return img.permute(2, 0, 1).unsqueeze(0)
+
+
+def quantize_model(model, images, backend='x86'):
+    """Post-training static quantization of a float network.
+
+    Weights are quantized per channel to int8, activations per tensor to uint8 with ranges observed on `images`.
+
+    Args:
+        model (nn.Module): Float network with loaded weights, on the CPU.
+        images (list[ndarray]): BGR uint8 calibration images.
+        backend (str): Quantization backend. Default: 'x86'.
+
+    Returns:
+        torch.jit.ScriptModule: The frozen INT8 model. It accepts any input size.
+    """
+    torch.backends.quantized.engine = 'fbgemm' if backend == 'x86' else backend
+    example = to_tensor(images[0])
+    prepared = prepare_fx(model.cpu().eval(), get_default_qconfig_mapping(backend), example_inputs=(example, ))
+    with torch.no_grad():
+        for img in images:
+            prepared(to_tensor(img))
+        quantized = convert_fx(prepared)
+        return torch.jit.freeze(torch.jit.trace(quantized, example).eval())
+
+
+def compare(float_upsampler, int8_upsampler, images, outscale):
+    """PSNR / SSIM of the INT8 outputs against the float outputs, plus timings."""
+    psnr, ssim, float_time, int8_time = [], [], 0., 0.
+    for img in images:
+        start = time.perf_counter()
+        ref, _ = float_upsampler.enhance(img, outscale=outscale)
+        float_time += time.perf_counter() - start
+        start = time.perf_counter()
+        out, _ = int8_upsampler.enhance(img, outscale=outscale)
+        int8_time += time.perf_counter() - start
+        psnr.append(calculate_psnr(out, ref, crop_border=0))
+        ssim.append(calculate_ssim(out, ref, crop_border=0))
+    n = len(images)
+    return {
+        'images': n,
+        'psnr_vs_float': round(float(sum(psnr)) / n, 3),
+        'ssim_vs_float': round(float(sum(ssim)) / n, 5),
+        'float_s_per_image': round(float_time / n, 3),
+        'int8_s_per_image': round(int8_time / n, 3),
+    }
+
+
+def main():
+    """Quantizes a compact Real-ESRGAN model to INT8 for CPU inference.
+
+    The result is saved next to the float weights as <model_name>_int8.pt, where inference_realesrgan.py --int8 looks
+    for it. Only the SRVGGNetCompact models are supported: the RRDBNet models branch on the input size and cannot be
+    traced for FX graph mode quantization.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--model_name',
+        type=str,
+        default='realesr-animevideov3',
+        help='Model names: realesr-animevideov3 | realesr-general-x4v3')
+    parser.add_argument('-i', '--input', type=str, default='inputs', help='Folder of sample faces for calibration')
+    parser.add_argument('--eval', type=str, default=None, help='Folder of images for the PSNR/SSIM report')
+    parser.add_argument(
+        '-dn',
+        '--denoise_strength',
+        type=float,
+        default=0.5,
+        help='Denoise strength baked into the INT8 model. Only used for the realesr-general-x4v3 model')
+    parser.add_argument('--model_path', type=str, default=None, help='[Option] Float model path')
+    parser.add_argument('--output', type=str, default=None, help='[Option] Output path of the INT8 model')
+    parser.add_argument('--num_calib', type=int, default=32, help='Maximum number of calibration images')
+    parser.add_argument('--calib_size', type=int, default=256, help='Longer side of the calibration images')
+    args = parser.parse_args()
+
+    model, netscale, file_url = build_model(args.model_name)
+    if not isinstance(model, SRVGGNetCompact):
+        raise SystemExit(f'{args.model_name} is an RRDBNet model; only SRVGGNetCompact models can be quantized')
+
+    model_path = args.model_path
+    if model_path is None:
+        model_path = os.path.join(default_weights_dir(), args.model_name + '.pth')
+        if not os.path.isfile(model_path):
+            for url in file_url:
+                model_path = load_file_from_url(
+                    url=url, model_dir=default_weights_dir(), progress=True, file_name=None)
+    dni_weight = None
+    if args.model_name == 'realesr-general-x4v3' and args.denoise_strength != 1:
+        wdn_model_path = model_path.replace('realesr-general-x4v3', 'realesr-general-wdn-x4v3')
+        model_path = [model_path, wdn_model_path]
+        dni_weight = [args.denoise_strength, 1 - args.denoise_strength]
+
+    cpu = torch.device('cpu')
+    float_upsampler = RealESRGANer(
+        scale=netscale, model_path=model_path, dni_weight=dni_weight, model=model, half=False, device=cpu)
+
+    images = load_calibration_images(args.input, args.num_calib, args.calib_size)
+    if not images:
+        raise SystemExit(f'No calibration images found in {args.input}')
+    int8_model = quantize_model(float_upsampler.model, images)
+    output = args.output or int8_model_path(args.model_name)
+    int8_model.save(output)
+    print(f'Saved INT8 model to {output} (calibrated on {len(images)} images)')
+
+    int8_upsampler = RealESRGANer(scale=netscale, model_path=None, model=int8_model, half=False, device=cpu)
+    eval_images = load_calibration_images(args.eval, args.num_calib, args.calib_size) if args.eval else images
+    print('Accuracy vs float:', compare(float_upsampler, int8_upsampler, eval_images, netscale))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,18 +5,93 @@ import os
 import queue
 import threading
 import torch
+from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def build_model(model_name):
+    """Builds the network for one of the released model names.
+
+    Args:
+        model_name (str): RealESRGAN_x4plus | RealESRNet_x4plus | RealESRGAN_x4plus_anime_6B | RealESRGAN_x2plus |
+            realesr-animevideov3 | realesr-general-x4v3.
+
+    Returns:
+        tuple: (model, netscale, file_url), where file_url is the list of release weights to download.
+    """
+    if model_name == 'RealESRGAN_x4plus':  # x4 RRDBNet model
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+        netscale = 4
+        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth']
+    elif model_name == 'RealESRNet_x4plus':  # x4 RRDBNet model
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+        netscale = 4
+        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth']
+    elif model_name == 'RealESRGAN_x4plus_anime_6B':  # x4 RRDBNet model with 6 blocks
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
+        netscale = 4
+        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth']
+    elif model_name == 'RealESRGAN_x2plus':  # x2 RRDBNet model
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+        netscale = 2
+        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth']
+    elif model_name == 'realesr-animevideov3':  # x4 VGG-style model (XS size)
+        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+        netscale = 4
+        file_url = ['https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth']
+    elif model_name == 'realesr-general-x4v3':  # x4 VGG-style model (S size)
+        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
+        netscale = 4
+        file_url = [
+            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-wdn-x4v3.pth',
+            'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth'
+        ]
+    else:
+        raise ValueError(f'Unknown model name: {model_name}')
+    return model, netscale, file_url
+
+
+class OnnxRuntimeModel():
+    """Runs an exported network with the onnxruntime CPU execution provider.
+
+    It is called like the torch network it stands in for: a float NCHW tensor in, a float NCHW tensor out.
+    face-parsing.PyTorch/ort_runner.py has the same runner for BiSeNet (realesrgan is too heavy to import there);
+    keep the two in step.
+
+    Args:
+        model_path (str): Path to the ONNX model.
+        num_threads (int): Intra-op threads. 0 lets onnxruntime decide. Default: 0.
+        inter_op_threads (int): Inter-op threads, only used by parallel execution. 0 lets onnxruntime decide.
+            Default: 0.
+    """
+
+    def __init__(self, model_path, num_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(output)
+
+
 class RealESRGANer():
     """A helper class for upsampling images with RealESRGAN.
 
     Args:
         scale (int): Upsampling scale factor used in the networks. It is usually 2 or 4.
         model_path (str): The path to the pretrained model. It can be urls (will first download it automatically).
+            None if `model` already carries its weights (e.g. a TorchScript INT8 model).
         model (nn.Module): The defined network. Default: None.
         tile (int): As too large images result in the out of GPU memory issue, so this tile option will first crop
             input images into tiles, and then process each of them. Finally, they will be merged into one image.
@@ -24,6 +99,9 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        backend (str): 'torch' runs `model` with the weights from `model_path`. 'onnxruntime' runs the ONNX model at
+            `model_path` (see scripts/pytorch2onnx.py) on the CPU and ignores `model`. Default: 'torch'.
+        num_threads (int): Intra-op threads of the onnxruntime backend. 0 lets onnxruntime decide. Default: 0.
     """
 
     def __init__(self,
@@ -36,7 +114,9 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 backend='torch',
+                 num_threads=0):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
@@ -51,7 +131,18 @@ class RealESRGANer():
         else:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
 
-        if isinstance(model_path, list):
+        if backend == 'onnxruntime':
+            # the exported graph carries its weights and runs in float32 on the CPU
+            self.device = torch.device('cpu')
+            self.half = False
+            self.model = OnnxRuntimeModel(model_path, num_threads=num_threads)
+            return
+        if backend != 'torch':
+            raise ValueError(f'Unknown backend: {backend}')
+
+        if model_path is None:
+            loadnet = None
+        elif isinstance(model_path, list):
             # dni
             assert len(model_path) == len(dni_weight), 'model_path and dni_weight should have the save length.'
             loadnet = self.dni(model_path[0], model_path[1], dni_weight)
@@ -62,12 +153,13 @@ class RealESRGANer():
                     url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
             loadnet = torch.load(model_path, map_location=torch.device('cpu'))
 
-        # prefer to use params_ema
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
-        else:
-            keyname = 'params'
-        model.load_state_dict(loadnet[keyname], strict=True)
+        if loadnet is not None:
+            # prefer to use params_ema
+            if 'params_ema' in loadnet:
+                keyname = 'params_ema'
+            else:
+                keyname = 'params'
+            model.load_state_dict(loadnet[keyname], strict=True)
 
         model.eval()
         self.model = model.to(self.device)
@@ -1,36 +1,94 @@
 import argparse
+import inspect
+import os
+import sys
 import torch
 import torch.onnx
-from basicsr.archs.rrdbnet_arch import RRDBNet
+from basicsr.utils.download_util import load_file_from_url
 
+ESRGAN_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ESRGAN_ROOT)
+# the parity check is shared with the BiSeNet export
+sys.path.insert(0, os.path.join(os.path.dirname(ESRGAN_ROOT), 'face-parsing.PyTorch'))
+from inference_realesrgan import default_weights_dir, onnx_model_path  # noqa: E402
+from ort_runner import check_parity  # noqa: E402
+from realesrgan import OnnxRuntimeModel, RealESRGANer, build_model  # noqa: E402
 
-def main(args):
-    # An instance of the model
-    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
-    if args.params:
-        keyname = 'params'
-    else:
-        keyname = 'params_ema'
-    model.load_state_dict(torch.load(args.input)[keyname])
-    # set the train mode to false since we will only run the forward pass.
-    model.train(False)
-    model.cpu().eval()
-
-    # An example input
+# batch, height and width are left symbolic so one model serves every tile and image size
+DYNAMIC_AXES = {'input': {0: 'batch', 2: 'height', 3: 'width'}, 'output': {0: 'batch', 2: 'height', 3: 'width'}}
+PARITY_SHAPES = ((1, 3, 64, 64), (2, 3, 48, 80), (1, 3, 120, 96))
+
+
+def export_onnx(model, output, opset_version=11):
+    """Exports `model` with dynamic batch/height/width axes."""
     x = torch.rand(1, 3, 64, 64)
-    # Export the model
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # newer torch defaults to the dynamo exporter; dynamic_axes belong to the TorchScript one
+        kwargs['dynamo'] = False
     with torch.no_grad():
-        torch_out = torch.onnx._export(model, x, args.output, opset_version=11, export_params=True)
-    print(torch_out.shape)
+        torch.onnx.export(
+            model,
+            x,
+            output,
+            opset_version=opset_version,
+            export_params=True,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes=DYNAMIC_AXES,
+            **kwargs)
+
+
+def main(args):
+    model, netscale, file_url = build_model(args.model_name)
+
+    model_path = args.input
+    if model_path is None:
+        model_path = os.path.join(default_weights_dir(), args.model_name + '.pth')
+        if not os.path.isfile(model_path):
+            for url in file_url:
+                model_path = load_file_from_url(url=url, model_dir=default_weights_dir(), progress=True, file_name=None)
+    dni_weight = None
+    if args.model_name == 'realesr-general-x4v3' and args.denoise_strength != 1:
+        wdn_model_path = model_path.replace('realesr-general-x4v3', 'realesr-general-wdn-x4v3')
+        model_path = [model_path, wdn_model_path]
+        dni_weight = [args.denoise_strength, 1 - args.denoise_strength]
+
+    # load the weights the way inference_realesrgan.py does (params_ema when present, dni)
+    model = RealESRGANer(
+        scale=netscale, model_path=model_path, dni_weight=dni_weight, model=model, device=torch.device('cpu')).model
+
+    output = args.output or onnx_model_path(args.model_name)
+    export_onnx(model, output, args.opset)
+    print(f'Saved {args.model_name} to {output}')
+    try:
+        diffs = check_parity(model, OnnxRuntimeModel(output), PARITY_SHAPES, args.atol)
+    except AssertionError as error:
+        raise SystemExit(str(error))
+    for shape, diff in diffs.items():
+        print(f'input {shape}: max |diff| = {diff:.2e}')
 
 
 if __name__ == '__main__':
     """Convert pytorch model to onnx models"""
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '--input', type=str, default='experiments/pretrained_models/RealESRGAN_x4plus.pth', help='Input model path')
-    parser.add_argument('--output', type=str, default='realesrgan-x4.onnx', help='Output onnx path')
-    parser.add_argument('--params', action='store_false', help='Use params instead of params_ema')
+        '-n',
+        '--model_name',
+        type=str,
+        default='RealESRGAN_x4plus',
+        help=('Model names: RealESRGAN_x4plus | RealESRNet_x4plus | RealESRGAN_x4plus_anime_6B | RealESRGAN_x2plus | '
+              'realesr-animevideov3 | realesr-general-x4v3'))
+    parser.add_argument('--input', type=str, default=None, help='Input model path. Default: weights/<model_name>.pth')
+    parser.add_argument('--output', type=str, default=None, help='Output onnx path. Default: weights/<model_name>.onnx')
+    parser.add_argument(
+        '-dn',
+        '--denoise_strength',
+        type=float,
+        default=0.5,
+        help='Denoise strength baked into the exported model. Only used for the realesr-general-x4v3 model')
+    parser.add_argument('--opset', type=int, default=11, help='ONNX opset version')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Maximum allowed difference to the torch outputs')
     args = parser.parse_args()
 
     main(args)
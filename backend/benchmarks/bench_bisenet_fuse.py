@@ -0,0 +1,62 @@
+"""
+Speed of the BatchNorm-folded BiSeNet against the eager model on 512x512 CPU inputs.
+
+Variants (all BiSeNetInference, logits at 1/8 resolution):
+  eager               - checkpoint as trained, separate Conv2d/BatchNorm2d
+  fused               - BatchNorm folded into the convolutions, NCHW
+  fused_channels_last - BatchNorm folded, channels-last weights and inputs
+  frozen              - fused_channels_last traced and torch.jit.freeze'd (what server.py loads)
+
+Usage:
+    python benchmarks/bench_bisenet_fuse.py --cp 79999_iter.pth --batch_size 1 --threads 4
+"""
+import argparse
+
+import torch
+
+from common import time_it, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cp", type=str, default="79999_iter.pth", help="BiSeNet checkpoint in res/cp")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    from model import fuse_for_inference
+    from parsing import load_bisenet
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    eager = load_bisenet(args.cp, device)
+    fused = fuse_for_inference(eager, channels_last=False)
+    fused_cl = fuse_for_inference(eager, channels_last=True)
+    x = torch.randn(args.batch_size, 3, args.size, args.size)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(fused_cl, x).eval())
+        reference = eager(x)
+
+    variants = {"eager": eager, "fused": fused, "fused_channels_last": fused_cl, "frozen": frozen}
+    report = {"batch_size": args.batch_size, "size": args.size, "threads": torch.get_num_threads(), "variants": {}}
+    for name, net in variants.items():
+        with torch.no_grad():
+            mean_ms, min_ms = time_it(lambda: net(x), args.repeats, warmup=2)
+            diff = (net(x) - reference).abs().max().item()
+        report["variants"][name] = {
+            "ms_per_batch": round(mean_ms, 2),
+            "min_ms_per_batch": round(min_ms, 2),
+            "max_abs_logit_diff": float(f"{diff:.3e}"),
+        }
+    base = report["variants"]["eager"]["ms_per_batch"]
+    for entry in report["variants"].values():
+        entry["speedup"] = round(base / entry["ms_per_batch"], 3)
+    write_report(report, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Accuracy/speed tradeoff of the inference-only BiSeNet head.
+
+Variants, all on the same 512x512 batch:
+  full   - BiSeNet.forward (main + both auxiliary heads, all upsampled), argmax of out[0]
+  logits - BiSeNetInference, bilinear upsampling of the logits, argmax (same labels as full)
+  labels - BiSeNetInference, argmax at 1/8 resolution, nearest upsampling of the labels
+
+Accuracy is reported against `full`. Point --input at real faces; without it random noise
+images are used, which only makes the timings meaningful.
+
+Usage:
+    python benchmarks/bench_bisenet_head.py --input test_img --cp 79999_iter.pth --threads 4
+"""
+import argparse
+
+import torch
+
+from common import load_images, mean_iou, pixel_agreement, time_it, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=None, help="Folder of face images")
+    parser.add_argument("--cp", type=str, default="79999_iter.pth", help="BiSeNet checkpoint in res/cp")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    from model import BiSeNetInference
+    from parsing import load_bisenet, parse_tensor, resize_image
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    full = load_bisenet(args.cp, device, inference=False)
+    head = BiSeNetInference(full).eval()
+
+    images, real = load_images(args.input, args.batch_size)
+    batch = torch.stack([resize_image(img) for img in images])
+
+    variants = {
+        "full": lambda: parse_tensor(full, batch, device),
+        "logits": lambda: parse_tensor(head, batch, device, upsample="logits"),
+        "labels": lambda: parse_tensor(head, batch, device, upsample="labels"),
+    }
+    reference = variants["full"]()
+
+    report = {"batch_size": len(images), "real_images": real, "threads": torch.get_num_threads(), "variants": {}}
+    for name, fn in variants.items():
+        mean_ms, min_ms = time_it(fn, args.repeats)
+        labels = fn()
+        report["variants"][name] = {
+            "ms_per_batch": round(mean_ms, 2),
+            "ms_per_image": round(mean_ms / len(images), 2),
+            "min_ms_per_batch": round(min_ms, 2),
+            "pixel_agreement": round(pixel_agreement(labels, reference), 5),
+            "miou_vs_full": round(mean_iou(labels, reference), 5),
+        }
+    base = report["variants"]["full"]["ms_per_batch"]
+    for entry in report["variants"].values():
+        entry["speedup"] = round(base / entry["ms_per_batch"], 3)
+    write_report(report, args.json)
+
+
+if __name__ == "__main__":
+    main()
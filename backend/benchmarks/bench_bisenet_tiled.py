@@ -0,0 +1,62 @@
+"""
+Native-resolution tiled BiSeNet parsing against the letterboxed single pass.
+
+Variants, all producing label maps at the image's own size:
+  letterbox       - parse_letterboxed, one forward pass at half the long side (max 1024)
+  tiled_bN        - parse_tiled at native resolution, N tiles per forward pass
+
+Agreement / mIoU are reported against `letterbox`. Point --input at large real faces; without it
+random noise images of --size are used, which only makes the timings meaningful.
+
+Usage:
+    python benchmarks/bench_bisenet_tiled.py --input test_img --tile 512 --overlap 128 --threads 4
+"""
+import argparse
+
+import torch
+
+from common import load_images, mean_iou, pixel_agreement, time_it, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=None, help="Folder of face images")
+    parser.add_argument("--cp", type=str, default="79999_iter.pth", help="BiSeNet checkpoint in res/cp")
+    parser.add_argument("--size", type=int, default=2048, help="Side of the noise images without --input")
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--batch_sizes", type=str, default="1,4", help="Comma-separated tiles per forward pass")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    from parsing import load_parser, parse_letterboxed, parse_tiled
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    net = load_parser(args.cp, device=torch.device("cpu"))
+    image = load_images(args.input, 1, args.size)[0][0]
+
+    variants = {"letterbox": lambda: parse_letterboxed(net, image)}
+    for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+        variants[f"tiled_b{batch_size}"] = (
+            lambda b=batch_size: parse_tiled(net, image, tile=args.tile, overlap=args.overlap, batch_size=b))
+    reference = variants["letterbox"]()
+
+    report = {"image": list(image.shape[:2]), "tile": args.tile, "overlap": args.overlap,
+              "threads": torch.get_num_threads(), "variants": {}}
+    for name, fn in variants.items():
+        mean_ms, min_ms = time_it(fn, args.repeats)
+        labels = fn()
+        report["variants"][name] = {
+            "ms": round(mean_ms, 2),
+            "min_ms": round(min_ms, 2),
+            "pixel_agreement": round(pixel_agreement(labels, reference), 5),
+            "miou_vs_letterbox": round(mean_iou(labels, reference), 5),
+        }
+    write_report(report, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Import-time budget of the entry points, from `python -X importtime` in a fresh interpreter.
+
+Each entry point has a budget (seconds, cumulative import time of the module, best of --repeats)
+and modules it must not import: the heavy ones belong behind the stage that needs them, so a
+cold start only pays for what it serves.
+  server    - the API; /health and the static assets need none of the models
+  worker    - a pipeline worker process, before it loads the models (server.warmup)
+  renderer  - what the render step imports, in the API, the workers and the batch render processes
+  parsing   - BiSeNet loading (torch, but not torchvision or OpenCV)
+
+Exits with status 1 when an entry point is over budget or imports a forbidden module;
+tests/test_import_budget.py runs the same check under pytest.
+
+Usage:
+    python benchmarks/bench_import.py --repeats 3 --scale 2
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from common import BACKEND_DIR, ESRGAN_ROOT, FACE_PARSING_DIR, write_report
+
+HEAVY = ["torch", "torchvision", "cv2", "basicsr", "realesrgan", "onnxruntime"]
+
+ENTRY_POINTS = {
+    "server": {"budget": 1.5, "forbidden": HEAVY},
+    "worker": {"budget": 1.5, "forbidden": HEAVY},
+    "renderer": {"budget": 0.5, "forbidden": HEAVY},
+    "parsing": {"budget": 3.5, "forbidden": ["torchvision", "cv2", "basicsr", "realesrgan", "onnxruntime"]},
+}
+
+
+def profile(module):
+    """{imported module: cumulative seconds} of importing module (and what it imports) in a fresh interpreter."""
+    env = dict(os.environ, WARMUP="0",
+               PYTHONPATH=os.pathsep.join([str(BACKEND_DIR), str(FACE_PARSING_DIR), str(ESRGAN_ROOT)]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=str(BACKEND_DIR),
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    imported = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if not cumulative.strip().isdigit():
+                continue
+            imported[name.strip()] = int(cumulative) / 1e6
+            if not name.startswith("  "):
+                # A top-level import ends its tree; the interpreter's own (site, encodings) come first
+                if name.strip() == module:
+                    return imported
+                imported = {}
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh interpreters per entry point, best one counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the budgets, e.g. on slow CI machines")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    report, failed = {"entry_points": {}}, False
+    for module, limits in ENTRY_POINTS.items():
+        runs = [profile(module) for _ in range(args.repeats)]
+        imported = min(runs, key=lambda r: r[module])
+        budget = limits["budget"] * args.scale
+        forbidden = sorted(name for name in limits["forbidden"] if name in imported)
+        slowest = sorted((name for name in imported if name != module and "." not in name),
+                         key=imported.get, reverse=True)[:5]
+        entry = {
+            "seconds": round(imported[module], 3),
+            "budget": budget,
+            "forbidden_imports": forbidden,
+            "slowest": {name: round(imported[name], 3) for name in slowest},
+            "ok": imported[module] <= budget and not forbidden,
+        }
+        failed = failed or not entry["ok"]
+        report["entry_points"][module] = entry
+    report["ok"] = not failed
+    write_report(report, args.json)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
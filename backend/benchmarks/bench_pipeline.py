@@ -0,0 +1,210 @@
+"""
+End-to-end benchmark of the /process pipeline (server.py), one case per image x quality x palette.
+
+Per case it reports the wall time of each stage - preprocess, upscale_1 / upscale_2 (the
+ESRGAN passes), parse (BiSeNet), extract_regions, create_math_face and encode (the output
+write, included in create_math_face) - plus the total, the symbols placed and the peak RSS
+of the pipeline process and of its children (the ESRGAN subprocesses). Every case runs in a
+fresh process so the peaks are per case; model loading and warmup are reported apart as
+startup_s (WARMUP=0 skips the warmup passes).
+
+The corpus is face-parsing.PyTorch/6.jpg and hair.png (skipped while they are git-lfs
+pointers), any --images, and synthetic faces of the --synthetic sizes.
+
+The pipeline works in the server's folders (test_img, Real-ESRGAN/inputs and results,
+Divided Regions), so don't run this next to a live server.
+
+With --baseline the report is compared against an earlier one and the script exits with
+status 1 if any stage got slower by more than --tolerance (and at least --min_delta seconds).
+
+Usage:
+    python benchmarks/bench_pipeline.py --json pipeline.json
+    python benchmarks/bench_pipeline.py --qualities low --palettes math --baseline pipeline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import BACKEND_DIR, FACE_PARSING_DIR, write_report
+from bench_render import SYNTHETIC_REGIONS
+
+SAMPLE_IMAGES = [FACE_PARSING_DIR / "6.jpg", FACE_PARSING_DIR / "hair.png"]
+QUALITIES = ["low", "medium", "high"]
+# (R, G, B) per synthetic region id, before shading
+SYNTHETIC_COLORS = {17: (60, 40, 30), 14: (200, 160, 130), 1: (225, 185, 155), 2: (70, 50, 40), 3: (70, 50, 40),
+                    4: (240, 240, 240), 5: (240, 240, 240), 10: (215, 170, 140), 12: (180, 90, 90), 13: (170, 80, 80)}
+
+
+def synthetic_face(size, seed=0):
+    """JPEG bytes of a shaded cartoon face (ellipses) on a grey background."""
+    import cv2
+    from PIL import Image
+
+    rng = np.random.RandomState(seed)
+    img = np.full((size, size, 3), 128, dtype=np.float32)
+    yy, xx = np.mgrid[0:size, 0:size] / float(size)
+    for region_id, cy, cx, ry, rx in SYNTHETIC_REGIONS:
+        img[((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1] = SYNTHETIC_COLORS[region_id]
+    shade = cv2.resize(rng.uniform(0.7, 1.1, (8, 8)).astype(np.float32), (size, size), interpolation=cv2.INTER_CUBIC)
+    img = np.clip(img * shade[:, :, None], 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def load_corpus(images, synthetic_sizes):
+    """[(name, bytes)] of the benchmark images, and the names of the files that were skipped."""
+    from PIL import Image
+
+    corpus, skipped = [], []
+    for path in list(SAMPLE_IMAGES) + [os.path.abspath(p) for p in images]:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            Image.open(io.BytesIO(data)).verify()
+        except OSError:
+            skipped.append(str(path))
+            continue
+        corpus.append((os.path.basename(str(path)), data))
+    for size in synthetic_sizes:
+        corpus.append((f"synthetic_{size}", synthetic_face(size)))
+    return corpus, skipped
+
+
+def run_case(image_path, quality, palette, output_format, density):
+    """Runs one request through the pipeline in this process and returns its measurements."""
+    sys.path.insert(0, str(BACKEND_DIR))
+    start = time.perf_counter()
+    import server
+    server.warmup()
+    result = {"startup_s": round(time.perf_counter() - start, 3), "bisenet_resident": server.face_parser is not None,
+              "warmup": server.warmup_report}
+
+    with open(image_path, "rb") as f:
+        data = f.read()
+    stages = {}
+
+    def on_progress(event, payload):
+        if event == "stage_done":
+            stages[payload["stage"]] = payload["seconds"]
+
+    start = time.perf_counter()
+    try:
+        server.run_request(data, quality, palette, output_format, density, on_progress=on_progress)
+    except Exception as exc:
+        result["error"] = str(getattr(exc, "detail", exc))[-2000:]
+    result["total_s"] = round(time.perf_counter() - start, 3)
+    result["stages"] = stages
+
+    from placement_log import read_log
+    logs = sorted(server.DIVIDED_REGIONS_DIR.glob("symbol_placements.mfpl*"), key=lambda p: p.stat().st_mtime)
+    result["symbols"] = read_log(str(logs[-1]))[0]["count"] if logs and "error" not in result else None
+    result["peak_rss_mb"] = server.peak_rss_mb()
+    return result
+
+
+def compare(report, baseline, tolerance, min_delta):
+    """Stages of report that got slower than in baseline, as printable lines."""
+    def key(case):
+        return case["image"], case["quality"], case["palette"]
+
+    previous = {key(case): case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in report["cases"]:
+        old = previous.get(key(case))
+        if not old:
+            continue
+        for stage, seconds in case.get("stages", {}).items():
+            before = old.get("stages", {}).get(stage)
+            if before is not None and seconds > before * (1 + tolerance) and seconds - before >= min_delta:
+                regressions.append(f"{'/'.join(key(case))} {stage}: {before:.3f}s -> {seconds:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=str, nargs="*", default=[], help="Extra face images")
+    parser.add_argument("--synthetic", type=str, default="256,512", help="Comma-separated synthetic face sizes")
+    parser.add_argument("--qualities", type=str, default=",".join(QUALITIES))
+    parser.add_argument("--palettes", type=str, default=None, help="Comma-separated palettes (default: all)")
+    parser.add_argument("--output_format", type=str, default="png")
+    parser.add_argument("--density", type=int, default=50)
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown per stage")
+    parser.add_argument("--min_delta", type=float, default=0.05, help="Ignore slowdowns below this many seconds")
+    parser.add_argument("--case", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # Child process: run one case and write its measurements to the given file
+        spec = json.loads(args.case)
+        result = run_case(spec["image_path"], spec["quality"], spec["palette"], spec["output_format"],
+                          spec["density"])
+        with open(spec["result_path"], "w") as f:
+            json.dump(result, f)
+        return
+
+    from palettes import get_registry
+
+    palettes = args.palettes.split(",") if args.palettes else list(get_registry())
+    qualities = args.qualities.split(",")
+    corpus, skipped = load_corpus(args.images, [int(s) for s in args.synthetic.split(",") if s])
+
+    import torch
+    report = {
+        "env": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            "settings": {name: os.getenv(name) for name in
+                         ("INFERENCE_BACKEND", "USE_INT8", "BISENET_TILE", "ORT_THREADS") if os.getenv(name)},
+        },
+        "output_format": args.output_format,
+        "density": args.density,
+        "skipped": skipped,
+        "cases": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as workdir:
+        for name, data in corpus:
+            image_path = os.path.join(workdir, name)
+            with open(image_path, "wb") as f:
+                f.write(data)
+            for quality in qualities:
+                for palette in palettes:
+                    result_path = os.path.join(workdir, "result.json")
+                    spec = {"image_path": image_path, "quality": quality, "palette": palette,
+                            "output_format": args.output_format, "density": args.density, "result_path": result_path}
+                    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(spec)],
+                                               capture_output=True, text=True, encoding="utf-8", errors="replace")
+                    case = {"image": name, "quality": quality, "palette": palette}
+                    if completed.returncode == 0 and os.path.exists(result_path):
+                        with open(result_path) as f:
+                            case.update(json.load(f))
+                        os.remove(result_path)
+                    else:
+                        case["error"] = (completed.stderr or completed.stdout)[-2000:]
+                    report["cases"].append(case)
+                    sys.stderr.write(f"{name} {quality} {palette}: {case.get('total_s')}s "
+                                     f"{'error' if 'error' in case else case.get('symbols')}\n")
+    write_report(report, args.json)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Cost of the symbol renderer (face-parsing.PyTorch/renderer.py) per placed symbol.
+
+Sections:
+  style_lookup  - brightness -> gamma -> font size per lattice point: the per-symbol scalar
+                  calls (safe_gamma, size_mapping) against the GAMMA_LUT / Palette.size_luts
+                  lookups the render loop uses, in ns per symbol
+  render        - create_math_face end to end for each output format and encode speed, in ms
+                  and us per symbol, with the output's size in bytes
+
+Without --regions a synthetic face (ellipses for skin, hair, eyes, lips...) of --size is
+rendered; point --regions at a "Divided Regions" folder from a real run for real faces.
+
+Usage:
+    python benchmarks/bench_render.py --size 2048 --densities 25,50,100 --json render.json
+    python benchmarks/bench_render.py --size 2048 --formats png,webp,jpeg --encode_speeds fast,balanced,small
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from common import time_it, write_report
+
+# (region id, centre y, centre x, radius y, radius x) as fractions of the canvas, drawn in order
+SYNTHETIC_REGIONS = [
+    (17, 0.45, 0.5, 0.45, 0.4),   # hair
+    (14, 0.85, 0.5, 0.15, 0.15),  # neck
+    (1, 0.5, 0.5, 0.32, 0.26),    # face
+    (2, 0.4, 0.4, 0.02, 0.07), (3, 0.4, 0.6, 0.02, 0.07),  # brows
+    (4, 0.45, 0.4, 0.03, 0.06), (5, 0.45, 0.6, 0.03, 0.06),  # eyes
+    (10, 0.55, 0.5, 0.07, 0.04),  # nose
+    (12, 0.66, 0.5, 0.02, 0.09), (13, 0.7, 0.5, 0.02, 0.09),  # lips
+]
+
+
+def write_synthetic_regions(folder, size, seed=0):
+    """Writes region_<id>.png images of a synthetic face with smooth random shading."""
+    import cv2
+    from PIL import Image
+
+    rng = np.random.RandomState(seed)
+    labels = np.zeros((size, size), dtype=np.uint8)
+    yy, xx = np.mgrid[0:size, 0:size] / float(size)
+    for region_id, cy, cx, ry, rx in SYNTHETIC_REGIONS:
+        labels[((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1] = region_id
+    shade = cv2.resize(rng.randint(40, 256, (16, 16, 3)).astype(np.uint8), (size, size),
+                       interpolation=cv2.INTER_CUBIC)
+    for region_id in np.unique(labels)[1:]:
+        Image.fromarray(shade * (labels == region_id)[:, :, None]).save(
+            os.path.join(folder, f"region_{region_id}.png"))
+
+
+def bench_style_lookup(palette, n=200000, seed=0):
+    from math_face import GAMMA_LUT, safe_gamma, size_mapping
+
+    rng = np.random.RandomState(seed)
+    raw = rng.randint(0, 256, n)
+    raw_list = raw.tolist()
+    region_id = 1
+    base_font, _ = palette.style_for(region_id)
+    importance = palette.importance_for(region_id)
+    size_lut = palette.size_luts[region_id]
+
+    def scalar():
+        for v in raw_list:
+            size_mapping(base_font, safe_gamma(v), importance)
+
+    def lut():
+        size_lut[GAMMA_LUT[raw]].tolist()
+
+    report = {}
+    for name, fn in (("scalar", scalar), ("lut", lut)):
+        mean_ms, min_ms = time_it(fn, repeats=3)
+        report[name] = {"ns_per_symbol": round(min_ms * 1e6 / n, 1)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=str, default=None, help="Folder of region_<id>.png images")
+    parser.add_argument("--size", type=int, default=1024, help="Side of the synthetic face without --regions")
+    parser.add_argument("--palette", type=str, default="math")
+    parser.add_argument("--densities", type=str, default="50", help="Comma-separated densities (1-100)")
+    parser.add_argument("--formats", type=str, default="png,svg", help="Comma-separated output formats")
+    parser.add_argument("--encode_speeds", type=str, default="balanced",
+                        help="Comma-separated encode speeds (raster formats)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    from palettes import get_palette
+    from placement_log import read_log
+    from renderer import create_math_face, output_extension
+
+    palette = get_palette(args.palette)
+    workdir = tempfile.mkdtemp(prefix="bench_render_")
+    try:
+        if args.regions:
+            for name in os.listdir(args.regions):
+                if name.startswith("region_") and name.endswith(".png"):
+                    shutil.copy(os.path.join(args.regions, name), workdir)
+        else:
+            write_synthetic_regions(workdir, args.size)
+
+        report = {"palette": palette.name, "regions": args.regions or f"synthetic {args.size}px",
+                  "style_lookup": bench_style_lookup(palette), "render": {}}
+        for density in (int(d) for d in args.densities.split(",")):
+            for output_format in args.formats.split(","):
+                speeds = ["balanced"] if output_format == "svg" else args.encode_speeds.split(",")
+                for encode_speed in speeds:
+                    def render():
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            create_math_face(palette=palette.name, seed=0, output_format=output_format,
+                                             density=density, region_dir=workdir, encode_speed=encode_speed)
+
+                    mean_ms, min_ms = time_it(render, args.repeats)
+                    count = read_log(os.path.join(workdir, "symbol_placements.mfpl"))[0]["count"]
+                    output_path = os.path.join(workdir, f"gift_worthy_mathematical_face.{output_extension(output_format)}")
+                    name = output_format if output_format == "svg" else f"{output_format}_{encode_speed}"
+                    report["render"][f"{name}_d{density}"] = {
+                        "symbols": count,
+                        "ms": round(mean_ms, 2),
+                        "min_ms": round(min_ms, 2),
+                        "us_per_symbol": round(min_ms * 1000 / max(count, 1), 2),
+                        "bytes": os.path.getsize(output_path),
+                    }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    write_report(report, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Shared helpers for the benchmark scripts in this folder.
+Puts face-parsing.PyTorch and Real-ESRGAN on sys.path so their modules import as they do in the pipeline.
+"""
+import glob
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+FACE_PARSING_DIR = BACKEND_DIR / "face-parsing.PyTorch"
+ESRGAN_ROOT = BACKEND_DIR / "Real-ESRGAN"
+
+for _path in (str(FACE_PARSING_DIR), str(ESRGAN_ROOT)):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+from parsing import mean_iou, pixel_agreement  # noqa: E402,F401  (re-exported for the benchmarks)
+
+
+def load_images(folder, limit=8, size=512, seed=0):
+    """
+    Loads up to `limit` RGB images from `folder` as uint8 arrays.
+    Falls back to random noise images of `size`x`size` when the folder is missing or empty,
+    which is enough for timing but not for accuracy numbers.
+    """
+    from PIL import Image
+
+    paths = []
+    if folder and os.path.isdir(folder):
+        paths = sorted(p for p in glob.glob(os.path.join(folder, "*"))
+                       if p.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp")))
+    images = []
+    for path in paths[:limit]:
+        try:
+            images.append(np.array(Image.open(path).convert("RGB")))
+        except OSError:
+            continue
+    if images:
+        return images, True
+
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, (size, size, 3), dtype=np.uint8) for _ in range(limit)], False
+
+
+def time_it(fn, repeats=5, warmup=1):
+    """Returns (mean, min) wall time of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return float(np.mean(times)), float(np.min(times))
+
+
+def write_report(report, path):
+    """Prints `report` and, when `path` is set, writes it there as JSON."""
+    text = json.dumps(report, indent=2)
+    print(text)
+    if path:
+        with open(path, "w") as f:
+            f.write(text)
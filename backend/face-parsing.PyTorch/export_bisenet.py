@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Folds BatchNorm into the BiSeNet convolutions, converts to channels-last and writes a
+# torch.jit.freeze'd TorchScript artifact that server.py loads at start-up.
+# With --onnx it writes an ONNX model with dynamic batch/height/width instead, for the
+# onnxruntime backend, and checks it against the torch model on a few input shapes.
+#
+#   python export_bisenet.py --cp 79999_iter.pth --output res/cp/bisenet_fused.pt
+#   python export_bisenet.py --cp 79999_iter.pth --onnx
+
+import argparse
+
+import torch
+
+from parsing import FROZEN_ARTIFACT, ONNX_ARTIFACT, PARSE_SIZE, export_frozen, export_onnx, load_bisenet
+from model import fuse_for_inference
+from ort_runner import OnnxRuntimeModel, check_parity
+
+PARITY_SHAPES = ((1, 3, PARSE_SIZE, PARSE_SIZE), (2, 3, 384, 448))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cp', type=str, default='79999_iter.pth', help='BiSeNet checkpoint in res/cp')
+    parser.add_argument('--output', type=str, default=None, help='Output path (default depends on the format)')
+    parser.add_argument('--no_channels_last', action='store_true', help='Keep contiguous (NCHW) weights')
+    parser.add_argument('--onnx', action='store_true', help='Export ONNX for the onnxruntime backend')
+    parser.add_argument('--opset', type=int, default=11, help='ONNX opset version')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Maximum |logit diff| of the ONNX model')
+    args = parser.parse_args()
+
+    device = torch.device('cpu')
+    net = load_bisenet(args.cp, device)
+
+    if args.onnx:
+        output = args.output or ONNX_ARTIFACT
+        export_onnx(fuse_for_inference(net, channels_last=False), output, opset_version=args.opset)
+        print(f'Saved ONNX BiSeNet to {output}')
+        try:
+            diffs = check_parity(net, OnnxRuntimeModel(output), PARITY_SHAPES, args.atol)
+        except AssertionError as error:
+            raise SystemExit(str(error))
+        for shape, diff in diffs.items():
+            print(f'input {shape}: max |logit diff| vs eager: {diff:.2e}')
+        return
+
+    output = args.output or FROZEN_ARTIFACT
+    fused = fuse_for_inference(net, channels_last=not args.no_channels_last)
+    frozen = export_frozen(fused, output)
+
+    # Sanity check: the artifact must reproduce the eager logits
+    x = torch.randn(1, 3, PARSE_SIZE, PARSE_SIZE)
+    with torch.no_grad():
+        diff = (frozen(x) - net(x)).abs().max().item()
+    print(f'Saved frozen BiSeNet to {output} (max |logit diff| vs eager: {diff:.2e})')
+
+
+if __name__ == '__main__':
+    main()
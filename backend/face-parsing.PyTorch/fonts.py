@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Process-wide font manager for the mathematical face renderer.
+#
+# FONT_PATHS is probed once; every FreeType face is opened at most once per size. Each symbol
+# is drawn with the first font in FONT_PATHS whose character map contains it, so a symbol the
+# math font lacks comes from a fallback font instead of rendering as a tofu box. Coverage is
+# checked by comparing the symbol's raster with the font's .notdef glyph (what it draws for a
+# code point it does not have), which needs nothing beyond Pillow.
+
+import sys
+
+import numpy as np
+from PIL import ImageFont
+
+from math_face import FONT_PATHS, render_glyph_mask
+
+# Size the coverage probe renders at, and a code point no font maps (plane 16 private use)
+PROBE_SIZE = 32
+MISSING_CHAR = '\U0010FFFD'
+
+_manager = None
+
+
+def _same_raster(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return a.shape == b.shape and np.array_equal(a, b)
+
+
+class FontManager(object):
+    """Opens fonts once and picks, per symbol, the first font that contains it."""
+
+    def __init__(self, font_paths=FONT_PATHS):
+        self.paths = []
+        for path in font_paths:
+            try:
+                ImageFont.truetype(path, PROBE_SIZE)
+            except (IOError, OSError):
+                continue
+            self.paths.append(path)
+        if not self.paths:
+            sys.stderr.write(f"WARNING: none of {font_paths} could be opened; math symbols will not render\n")
+        # (path, size) -> FreeTypeFont, path -> .notdef raster, symbol -> path (None: no font has it)
+        self.fonts = {}
+        self.notdef = {}
+        self.resolved = {}
+
+    def font(self, path, size):
+        key = (path, size)
+        if key not in self.fonts:
+            self.fonts[key] = ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
+        return self.fonts[key]
+
+    def covers(self, path, sym):
+        """True if the font at path has a glyph for every character of sym."""
+        font = self.font(path, PROBE_SIZE)
+        if path not in self.notdef:
+            self.notdef[path] = render_glyph_mask(MISSING_CHAR, font, 0)
+        return not any(_same_raster(render_glyph_mask(ch, font, 0), self.notdef[path])
+                       for ch in sym if not ch.isspace())
+
+    def resolve(self, sym):
+        """Path of the first font containing sym, or None if none of them does."""
+        if sym not in self.resolved:
+            self.resolved[sym] = next((path for path in self.paths if self.covers(path, sym)), None)
+        return self.resolved[sym]
+
+    def font_for(self, sym, size):
+        """The font to draw sym with at size: the first that has it, else the primary font."""
+        path = self.resolve(sym)
+        if path is None and self.paths:
+            path = self.paths[0]
+        return self.font(path, size)
+
+    def check_coverage(self, symbols):
+        """Resolves symbols up front and reports the ones no font can draw. Returns them."""
+        missing = sorted({sym for sym in symbols if self.resolve(sym) is None})
+        if missing and self.paths:
+            sys.stderr.write(f"WARNING: no font in {self.paths} has {' '.join(missing)}; they will draw as boxes\n")
+        return missing
+
+
+def get_font_manager():
+    """The process-wide font manager, created on first use."""
+    global _manager
+    if _manager is None:
+        _manager = FontManager()
+    return _manager
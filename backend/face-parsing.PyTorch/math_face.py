@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Shared style constants and glyph helpers for the mathematical face renderer.
+# Used by renderer.py (single image), palettes.py and math_face_video.py (clips).
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Regions produced by BiSeNet that we render (0 is background)
+REGION_INDICES = [i for i in range(1, 18)]
+# Length of the dense per-region tables (indexed by region id)
+N_REGION_IDS = max(REGION_INDICES) + 1
+
+# Symbol sets and per-region opacity / importance / (base font, step) tables live in the
+# palette files (palettes/*.json, see palettes.py); regions a palette leaves out use these
+DEFAULT_STYLE = (9, 6)
+
+# Style params
+JITTER_CAP_PX = 2
+ROT_RANGE_DEG = 8
+GAMMA = 0.75
+
+# In order of preference; fonts.py draws each symbol with the first of these that has it
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuMathTeXGyre.ttf",  # Math symbols
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",     # Fallback
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSerif.ttf",
+    "/usr/share/fonts/opentype/stix/STIXGeneral-Regular.otf",
+    "cour.ttf",
+    "arial.ttf",
+    "seguisym.ttf",  # Segoe UI Symbol (Windows)
+]
+
+
+def safe_gamma(bright):
+    b = np.clip(bright / 255.0, 0, 1)
+    g = b ** GAMMA
+    return int(np.clip(g * 255, 0, 255))
+
+
+def size_mapping(base, brightness, region_importance=1.0):
+    brightness_norm = brightness / 255.0
+    size_factor = 0.9 + 0.5 * (1 - brightness_norm)
+    min_size = max(9, int(base * 0.85))
+    size_factor *= region_importance
+    return max(min_size, int(base * size_factor))
+
+
+# safe_gamma / size_mapping as lookup tables, so the render loops index instead of calling them
+GAMMA_LUT = np.array([safe_gamma(v) for v in range(256)], dtype=np.uint8)
+
+
+def size_lut(base, region_importance=1.0):
+    """size_mapping(base, b, region_importance) for every (gamma corrected) brightness b."""
+    return np.array([size_mapping(base, b, region_importance) for b in range(256)], dtype=np.int32)
+
+
+def render_glyph_mask(sym, font, angle):
+    """Rasterizes one rotated symbol as an 8-bit coverage mask, or returns None if it has no ink.
+
+    Colouring the mask (glyph_image, colorize_glyph) gives the same pixels as drawing the symbol
+    in that colour with ImageDraw, so a single rasterization can be reused for every
+    brightness/opacity the symbol is drawn at.
+    """
+    bbox = font.getbbox(sym)
+    wtxt, htxt = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    if wtxt <= 0 or htxt <= 0:
+        return None
+
+    txt = Image.new("L", (wtxt, htxt), 0)
+    d = ImageDraw.Draw(txt)
+    d.text((-bbox[0], -bbox[1]), sym, font=font, fill=255)
+    return np.asarray(txt.rotate(angle, expand=1))
+
+
+def glyph_image(mask, brightness, alpha):
+    """RGBA image of a coverage mask filled with (b, b, b, alpha), identical to drawing the symbol in that colour."""
+    if mask is None:
+        return None
+    rgb = np.where(mask > 0, brightness, 0).astype(np.uint8)
+    a = ((mask.astype(np.uint16) * alpha + 127) // 255).astype(np.uint8)
+    return Image.fromarray(np.dstack([rgb, rgb, rgb, a]), 'RGBA')
+
+
+def colorize_glyph(mask, brightness, alpha):
+    """Turns a coverage mask into float RGB/alpha planes matching ImageDraw's fill of (b, b, b, alpha)."""
+    cover = mask.astype(np.float32) / 255.0
+    return cover * brightness, cover * (alpha / 255.0)
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Mathematical face effect for short clips.
+#
+# Every region gets a fixed placement lattice (the same grid create_math_face walks) and each
+# lattice point gets its symbol, rotation and jitter once, from a seeded generator, so glyphs
+# stay put from frame to frame. Per frame we only look at the lattice points: a point whose
+# label, brightness or placement changed marks the canvas tiles under its old and new glyph
+# dirty, and only those tiles are recomposited. Frames stream into the Real-ESRGAN video Writer.
+
+import argparse
+import math
+import mimetypes
+import os
+import os.path as osp
+import sys
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from math_face import REGION_INDICES, JITTER_CAP_PX, ROT_RANGE_DEG, GAMMA_LUT, colorize_glyph
+from palettes import get_palette
+from parsing import PARSE_SIZE, load_bisenet, parse_batch
+
+SCRIPT_DIR = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(osp.dirname(SCRIPT_DIR), 'Real-ESRGAN'))
+from inference_realesrgan_video import Reader, Writer  # noqa: E402
+
+
+class TemporalMathFace(object):
+    """Incrementally rendered mathematical face for a sequence of same-sized frames.
+
+    Args:
+        height, width (int): Frame size; the canvas has the same size.
+        palette (str): Name of a palette in palettes/ (see palettes.py).
+        seed (int): Seed for the per-point symbol, rotation and jitter.
+        brightness_threshold (int): A placed glyph is only redrawn once its gamma-corrected
+            brightness drifts by at least this much, which keeps sensor noise from flickering.
+        tile_size (int): Edge of the square canvas tiles that are recomposited when dirty.
+    """
+
+    def __init__(self, height, width, palette='math', seed=0, brightness_threshold=8, tile_size=32):
+        self.height, self.width = height, width
+        self.brightness_threshold = brightness_threshold
+        self.tile_size = tile_size
+        self.palette = get_palette(palette)
+        self.gamma_lut = GAMMA_LUT.astype(np.int16)
+
+        self.symbols = []
+        sym_codes = {}
+        rng = np.random.RandomState(seed)
+        regions, ys, xs, syms = [], [], [], []
+        for slot, region_id in enumerate(REGION_INDICES):
+            step = int(self.palette.step_table[region_id])
+
+            codes = []
+            for sym in self.palette.symbols_for(region_id):
+                if sym not in sym_codes:
+                    sym_codes[sym] = len(self.symbols)
+                    self.symbols.append(sym)
+                codes.append(sym_codes[sym])
+
+            gy, gx = np.mgrid[0:height:step, 0:width:step]
+            n = gy.size
+            regions.append(np.full(n, slot, dtype=np.int16))
+            ys.append(gy.ravel())
+            xs.append(gx.ravel())
+            syms.append(np.asarray(codes, dtype=np.int32)[rng.randint(0, len(codes), n)])
+
+        # Lattice points in the order create_math_face composites them (region, then raster)
+        self.region_slot = np.concatenate(regions)
+        self.region_ids = np.asarray(REGION_INDICES, dtype=np.int16)[self.region_slot]
+        self.cy = np.concatenate(ys).astype(np.int32)
+        self.cx = np.concatenate(xs).astype(np.int32)
+        self.sym = np.concatenate(syms)
+        n = self.cy.size
+        self.angle = rng.randint(-ROT_RANGE_DEG, ROT_RANGE_DEG + 1, n).astype(np.int32)
+        self.jy = self.cy + rng.randint(-JITTER_CAP_PX, JITTER_CAP_PX + 1, n).astype(np.int32)
+        self.jx = self.cx + rng.randint(-JITTER_CAP_PX, JITTER_CAP_PX + 1, n).astype(np.int32)
+        self.size_lut = self.palette.size_luts[REGION_INDICES]
+        self.alpha = self.palette.opacity_table[self.region_ids]
+
+        # Where each point (and its jittered twin) samples the 512x512 label map - INTER_NEAREST
+        self.label_cy = self.cy * PARSE_SIZE // height
+        self.label_cx = self.cx * PARSE_SIZE // width
+        self.jit_inside = (self.jy >= 0) & (self.jy < height) & (self.jx >= 0) & (self.jx < width)
+        self.jy_c = np.clip(self.jy, 0, height - 1)
+        self.jx_c = np.clip(self.jx, 0, width - 1)
+        self.label_jy = self.jy_c * PARSE_SIZE // height
+        self.label_jx = self.jx_c * PARSE_SIZE // width
+
+        # State of what is currently on the canvas
+        self.placed = np.zeros(n, dtype=bool)
+        self.b = np.zeros(n, dtype=np.int16)
+        self.size = np.zeros(n, dtype=np.int32)
+        self.glyph_w = np.zeros(n, dtype=np.int32)
+        self.glyph_h = np.zeros(n, dtype=np.int32)
+        self.x0 = np.zeros(n, dtype=np.int32)
+        self.y0 = np.zeros(n, dtype=np.int32)
+
+        self.glyph_cache = {}
+        self.canvas = np.zeros((height, width), dtype=np.float32)
+        self.tiles_y = math.ceil(height / tile_size)
+        self.tiles_x = math.ceil(width / tile_size)
+        self.frames = 0
+        self.redrawn_tiles = 0
+
+    def glyph(self, code, size, angle):
+        key = (code, size, angle)
+        mask = self.glyph_cache.get(key)
+        if mask is None:
+            mask = self.palette.glyph_mask(self.symbols[code], size, angle)
+            if mask is None:
+                mask = np.zeros((0, 0), dtype=np.uint8)
+            self.glyph_cache[key] = mask
+        return mask
+
+    def update(self, frame, labels):
+        """Brings the canvas up to date with one RGB frame and its 512x512 label map."""
+        gray = frame.mean(axis=2).astype(np.uint8)
+        slot_ids = self.region_ids
+
+        # Which lattice points are inside their region this frame
+        cand = (labels[self.label_cy, self.label_cx] == slot_ids) & (gray[self.cy, self.cx] > 10)
+
+        raw_b = frame[self.cy, self.cx].mean(axis=1).astype(np.int32)
+        b = self.gamma_lut[raw_b]
+        keep = self.placed & cand & (np.abs(b - self.b) < self.brightness_threshold)
+        b = np.where(keep, self.b, b)
+        size = self.size_lut[self.region_slot, b]
+
+        # Only points whose glyph changed need a (cached) rasterization lookup
+        glyph_w, glyph_h = self.glyph_w.copy(), self.glyph_h.copy()
+        for i in np.flatnonzero(cand & (~self.placed | (size != self.size))):
+            mask = self.glyph(self.sym[i], size[i], self.angle[i])
+            glyph_h[i], glyph_w[i] = mask.shape
+
+        half_w, half_h = glyph_w // 2, glyph_h // 2
+        ink = glyph_w > 0
+        jit_mask = (self.jit_inside & (labels[self.label_jy, self.label_jx] == slot_ids)
+                    & (gray[self.jy_c, self.jx_c] > 10))
+        jit_ok = (jit_mask & (self.jx - half_w >= 0) & (self.jy - half_h >= 0)
+                  & (self.jx + half_w < self.width) & (self.jy + half_h < self.height))
+        center_ok = ((self.cx - half_w >= 0) & (self.cy - half_h >= 0)
+                     & (self.cx + half_w < self.width) & (self.cy + half_h < self.height))
+        placed = cand & ink & (jit_ok | center_ok)
+        x0 = np.where(jit_ok, self.jx, self.cx) - half_w
+        y0 = np.where(jit_ok, self.jy, self.cy) - half_h
+
+        moved = (b != self.b) | (x0 != self.x0) | (y0 != self.y0) | (size != self.size)
+        changed = (placed != self.placed) | (placed & moved)
+
+        dirty = np.zeros((self.tiles_y, self.tiles_x), dtype=bool)
+        t = self.tile_size
+        for i in np.flatnonzero(changed):
+            if self.placed[i]:
+                dirty[self.y0[i] // t:(self.y0[i] + self.glyph_h[i] - 1) // t + 1,
+                      self.x0[i] // t:(self.x0[i] + self.glyph_w[i] - 1) // t + 1] = True
+            if placed[i]:
+                dirty[y0[i] // t:(y0[i] + glyph_h[i] - 1) // t + 1,
+                      x0[i] // t:(x0[i] + glyph_w[i] - 1) // t + 1] = True
+
+        self.placed, self.b, self.size = placed, b, size
+        self.glyph_w, self.glyph_h, self.x0, self.y0 = glyph_w, glyph_h, x0, y0
+
+        n_dirty = int(dirty.sum())
+        if self.frames == 0 or n_dirty > dirty.size // 2:
+            self.redraw((0, 0, self.height, self.width))
+            n_dirty = dirty.size
+        else:
+            for ty, tx in zip(*np.nonzero(dirty)):
+                self.redraw((ty * t, tx * t, min((ty + 1) * t, self.height), min((tx + 1) * t, self.width)))
+        self.frames += 1
+        self.redrawn_tiles += n_dirty
+        return n_dirty
+
+    def redraw(self, box):
+        """Clears one canvas window and composites every placed glyph overlapping it, in order."""
+        top, left, bottom, right = box
+        patch = self.canvas[top:bottom, left:right]
+        patch[:] = 0
+
+        idx = np.flatnonzero(self.placed)
+        x0, y0 = self.x0[idx], self.y0[idx]
+        x1, y1 = x0 + self.glyph_w[idx], y0 + self.glyph_h[idx]
+        hit = (x0 < right) & (x1 > left) & (y0 < bottom) & (y1 > top)
+        for i in idx[hit]:
+            mask = self.glyph(self.sym[i], self.size[i], self.angle[i])
+            gx0, gy0 = self.x0[i], self.y0[i]
+            sx0, sy0 = max(left, gx0), max(top, gy0)
+            sx1, sy1 = min(right, gx0 + mask.shape[1]), min(bottom, gy0 + mask.shape[0])
+            rgb, a = colorize_glyph(mask[sy0 - gy0:sy1 - gy0, sx0 - gx0:sx1 - gx0], self.b[i], self.alpha[i])
+            dst = patch[sy0 - top:sy1 - top, sx0 - left:sx1 - left]
+            dst *= 1.0 - a
+            dst += rgb * a
+
+    def render(self):
+        """Returns the current canvas as a BGR uint8 frame (the symbols are grey on black)."""
+        gray = np.clip(self.canvas + 0.5, 0, 255).astype(np.uint8)
+        return cv2.merge([gray, gray, gray])
+
+
+def inference_video(args, video_save_path):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = load_bisenet(args.cp, device)
+
+    reader = Reader(args)
+    audio = reader.get_audio()
+    height, width = reader.get_resolution()
+    fps = reader.get_fps()
+    writer = Writer(args, audio, height, width, video_save_path, fps)
+    renderer = TemporalMathFace(
+        height,
+        width,
+        palette=args.palette,
+        seed=args.seed,
+        brightness_threshold=args.brightness_threshold,
+        tile_size=args.tile_size)
+
+    pbar = tqdm(total=len(reader), unit='frame', desc='math face')
+    done = False
+    while not done:
+        frames = []
+        while len(frames) < args.batch_size:
+            img = reader.get_frame()
+            if img is None:
+                done = True
+                break
+            frames.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        if not frames:
+            break
+
+        labels = parse_batch(net, frames, device=device, upsample=args.upsample)
+        for frame, label in zip(frames, labels):
+            renderer.update(frame, label)
+            writer.write_frame(renderer.render())
+            pbar.update(1)
+
+    reader.close()
+    writer.close()
+    total_tiles = renderer.tiles_y * renderer.tiles_x * max(renderer.frames, 1)
+    print(f'Redrew {renderer.redrawn_tiles}/{total_tiles} tiles '
+          f'({100.0 * renderer.redrawn_tiles / total_tiles:.1f}%), {len(renderer.glyph_cache)} cached glyphs')
+
+
+def main():
+    """Renders the mathematical face effect over a video, image folder or single image."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True, help='Input video, image or folder')
+    parser.add_argument('-o', '--output', type=str, default='res/video_res', help='Output folder')
+    parser.add_argument('--suffix', type=str, default='mathface', help='Suffix of the rendered video')
+    parser.add_argument('--palette', type=str, default='math', help='Symbol palette, a file name in palettes/ (math, ascii, ...)')
+    parser.add_argument('--cp', type=str, default='79999_iter.pth', help='BiSeNet checkpoint in res/cp')
+    parser.add_argument('--batch_size', type=int, default=4, help='Frames parsed per BiSeNet forward pass')
+    parser.add_argument(
+        '--upsample',
+        type=str,
+        default='labels',
+        help=('How BiSeNet output reaches 512x512: labels (argmax at 1/8, nearest upsample) | '
+              'logits (bilinear logits, exact)'))
+    parser.add_argument(
+        '--brightness_threshold',
+        type=int,
+        default=8,
+        help='Redraw a glyph only when its brightness changes by at least this much')
+    parser.add_argument('--tile_size', type=int, default=32, help='Canvas tile size used for partial redraws')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the symbol layout')
+    parser.add_argument('--fps', type=float, default=None, help='FPS of the output video')
+    parser.add_argument('--ffmpeg_bin', type=str, default='ffmpeg', help='The path to ffmpeg')
+    args = parser.parse_args()
+
+    # The Real-ESRGAN Writer sizes its pipe by outscale; the symbol canvas matches the input
+    args.outscale = 1
+    args.input = args.input.rstrip('/').rstrip('\\')
+    os.makedirs(args.output, exist_ok=True)
+
+    if mimetypes.guess_type(args.input)[0] is None and not osp.isdir(args.input):
+        raise ValueError(f'Unrecognised input: {args.input}')
+
+    video_name = osp.splitext(osp.basename(args.input))[0]
+    video_save_path = osp.join(args.output, f'{video_name}_{args.suffix}.mp4')
+    inference_video(args, video_save_path)
+    print(f'Saved to: {video_save_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,12 @@
 # -*- encoding: utf-8 -*-
 
 
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from resnet import Resnet18
 # from modules.bn import InPlaceABNSync as BatchNorm2d
@@ -75,7 +77,7 @@ class AttentionRefinementModule(nn.Module):
 
     def forward(self, x):
         feat = self.conv(x)
-        atten = F.avg_pool2d(feat, feat.size()[2:])
+        atten = feat.mean((2, 3), keepdim=True)
         atten = self.conv_atten(atten)
         atten = self.bn_atten(atten)
         atten = self.sigmoid_atten(atten)
@@ -108,7 +110,7 @@ class ContextPath(nn.Module):
         H16, W16 = feat16.size()[2:]
         H32, W32 = feat32.size()[2:]
 
-        avg = F.avg_pool2d(feat32, feat32.size()[2:])
+        avg = feat32.mean((2, 3), keepdim=True)
         avg = self.conv_avg(avg)
         avg_up = F.interpolate(avg, (H32, W32), mode='nearest')
 
@@ -200,7 +202,7 @@ class FeatureFusionModule(nn.Module):
     def forward(self, fsp, fcp):
         fcat = torch.cat([fsp, fcp], dim=1)
         feat = self.convblk(fcat)
-        atten = F.avg_pool2d(feat, feat.size()[2:])
+        atten = feat.mean((2, 3), keepdim=True)
         atten = self.conv1(atten)
         atten = self.relu(atten)
         atten = self.conv2(atten)
@@ -272,6 +274,62 @@ class BiSeNet(nn.Module):
         return wd_params, nowd_params, lr_mul_wd_params, lr_mul_nowd_params
 
 
+class BiSeNetInference(nn.Module):
+    """Main head of a trained BiSeNet, for inference.
+
+    Skips the auxiliary conv_out16/conv_out32 heads (only used by the training loss) and
+    returns the main logits at 1/8 of the input resolution, so callers decide how to get
+    back to full size (see parsing.parse_tensor). Shares the wrapped network's weights.
+    """
+    def __init__(self, net, channels_last=False):
+        super(BiSeNetInference, self).__init__()
+        self.cp = net.cp
+        self.ffm = net.ffm
+        self.conv_out = net.conv_out
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        feat_res8, feat_cp8, _ = self.cp(x)
+        feat_fuse = self.ffm(feat_res8, feat_cp8)
+        return self.conv_out(feat_fuse)
+
+
+# (conv, bn) attribute pairs that are applied back to back in ConvBNReLU,
+# AttentionRefinementModule, Resnet18 and BasicBlock
+_CONV_BN_PAIRS = (('conv', 'bn'), ('conv_atten', 'bn_atten'), ('conv1', 'bn1'), ('conv2', 'bn2'))
+
+
+def fuse_for_inference(net, channels_last=True):
+    """Returns an inference copy of BiSeNet with every BatchNorm folded into the preceding conv.
+
+    Accepts BiSeNet or BiSeNetInference; the result is a BiSeNetInference in eval mode, optionally
+    with channels-last weights (and inputs), ready to run or to trace with torch.jit.
+    The original network is left untouched.
+    """
+    if not isinstance(net, BiSeNetInference):
+        net = BiSeNetInference(net)
+    net = copy.deepcopy(net).eval()
+
+    for module in net.modules():
+        for conv_name, bn_name in _CONV_BN_PAIRS:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+        # BasicBlock.downsample is Sequential(Conv2d, BatchNorm2d)
+        if isinstance(module, nn.Sequential) and len(module) == 2 \
+                and isinstance(module[0], nn.Conv2d) and isinstance(module[1], nn.BatchNorm2d):
+            module[0] = fuse_conv_bn_eval(module[0], module[1])
+            module[1] = nn.Identity()
+
+    if channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    net.channels_last = channels_last
+    return net
+
+
 if __name__ == "__main__":
     net = BiSeNet(19)
     net.cuda()
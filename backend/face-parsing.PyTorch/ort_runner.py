@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# onnxruntime helpers shared by the ONNX exports: OnnxRuntimeModel runs an exported network on the
+# CPU execution provider, check_parity() compares it with the torch model it was exported from.
+# export_bisenet.py and Real-ESRGAN/scripts/pytorch2onnx.py both check their exports with it.
+#
+# OnnxRuntimeModel mirrors realesrgan.utils.OnnxRuntimeModel on purpose: the Real-ESRGAN inference
+# process does not have this directory on its path, and importing realesrgan here would pull basicsr
+# and torchvision into every BiSeNet load. Keep the two in step.
+
+import torch
+
+
+class OnnxRuntimeModel(object):
+    """Runs an ONNX model with the onnxruntime CPU execution provider.
+
+    Called like the torch module it was exported from: a float NCHW tensor in, a float tensor out.
+    num_threads=0 (inter_op_threads=0) lets onnxruntime pick the thread count.
+    """
+
+    def __init__(self, path, num_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def check_parity(model, runner, shapes, atol):
+    """Runs model and runner on a random input of each shape.
+
+    Returns {shape: max |diff|}; raises AssertionError when an output shape differs or a diff exceeds atol.
+    """
+    diffs = {}
+    for shape in shapes:
+        x = torch.rand(*shape)
+        with torch.no_grad():
+            ref = model(x)
+        out = runner(x)
+        assert out.shape == ref.shape, f'output shape {tuple(out.shape)} != {tuple(ref.shape)} for input {shape}'
+        diffs[tuple(shape)] = (out - ref).abs().max().item()
+    max_diff = max(diffs.values())
+    assert max_diff <= atol, f'ONNX parity check failed: max |diff| {max_diff:.2e} > {atol:.0e}'
+    return diffs
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Palette registry for the mathematical face renderer.
+#
+# A palette is a JSON file in palettes/ describing, per BiSeNet region id, the symbols to draw
+# and optionally their opacity (0-255), size importance and (base font size, lattice step):
+#
+#   {"name": "runes", "label": "Runes", "description": "...", "extends": "math",
+#    "symbols": {"1": ["ᚠ", "ᚢ"], "16": ["ᛉ"]}}
+#
+# "extends" inherits every table (and the fallback symbol) from another palette, so a new
+# palette can be as small as a symbol list. Region ids: 1 face, 2/3 eyebrows, 4/5 eyes,
+# 6 eyeglasses, 7/8 ears, 9 nose bridge, 10 nose, 11 mouth, 12/13 lips, 14 neck,
+# 15 head accessory, 16/17 hair.
+#
+# The registry is loaded once per process. Loading also rasterizes every symbol at every font
+# size its regions can reach (see size_mapping), so requests only rotate cached masks. Each
+# symbol is drawn with the first font that contains it (see fonts.py).
+
+import glob
+import json
+import os.path as osp
+
+import numpy as np
+from PIL import Image
+
+from fonts import get_font_manager
+from math_face import DEFAULT_STYLE, GAMMA_LUT, N_REGION_IDS, REGION_INDICES, render_glyph_mask, size_lut
+
+SCRIPT_DIR = osp.dirname(osp.abspath(__file__))
+PALETTE_DIR = osp.join(SCRIPT_DIR, 'palettes')
+DEFAULT_PALETTE = 'math'
+
+_registry = None
+
+
+def _int_keys(table):
+    return {int(k): v for k, v in (table or {}).items()}
+
+
+class Palette(object):
+    """Symbol sets and style tables of one palette, plus its rasterized glyphs."""
+
+    def __init__(self, name, label, description, symbols, opacity, importance, style, fallback_symbol='·'):
+        self.name = name
+        self.label = label
+        self.description = description
+        self.symbols = symbols
+        self.opacity = opacity
+        self.importance = importance
+        self.style = style
+        self.fallback_symbol = fallback_symbol
+        self.fonts = None
+        # Dense tables indexed by region id; size_luts[region_id][b] is the font size at
+        # gamma-corrected brightness b
+        region_ids = range(N_REGION_IDS)
+        self.opacity_table = np.array([self.opacity_for(i) for i in region_ids], dtype=np.int32)
+        self.base_font_table = np.array([self.style_for(i)[0] for i in region_ids], dtype=np.int32)
+        self.step_table = np.array([self.style_for(i)[1] for i in region_ids], dtype=np.int32)
+        self.size_luts = np.stack([size_lut(self.style_for(i)[0], self.importance_for(i)) for i in region_ids])
+        # (symbol, size) -> unrotated coverage mask, (symbol, size, angle) -> rotated mask,
+        # (symbol, size) -> text origin
+        self.masks = {}
+        self.rotated = {}
+        self.origins = {}
+
+    @classmethod
+    def from_dict(cls, spec, base=None):
+        symbols = dict(base.symbols) if base else {}
+        opacity = dict(base.opacity) if base else {}
+        importance = dict(base.importance) if base else {}
+        style = dict(base.style) if base else {}
+        symbols.update(_int_keys(spec.get('symbols')))
+        opacity.update(_int_keys(spec.get('opacity')))
+        importance.update(_int_keys(spec.get('importance')))
+        style.update({k: tuple(v) for k, v in _int_keys(spec.get('style')).items()})
+        fallback = spec.get('fallback_symbol', base.fallback_symbol if base else '·')
+        return cls(spec['name'], spec.get('label', spec['name']), spec.get('description', ''),
+                   symbols, opacity, importance, style, fallback)
+
+    def symbols_for(self, region_id):
+        return self.symbols.get(region_id, [self.fallback_symbol])
+
+    def opacity_for(self, region_id):
+        return self.opacity.get(region_id, 255)
+
+    def importance_for(self, region_id):
+        return self.importance.get(region_id, 1.0)
+
+    def style_for(self, region_id):
+        return self.style.get(region_id, DEFAULT_STYLE)
+
+    def font_sizes(self, region_id):
+        """Every font size size_mapping can give this region."""
+        return np.unique(self.size_luts[region_id][GAMMA_LUT]).tolist()
+
+    def all_symbols(self):
+        return {sym for region_id in REGION_INDICES for sym in self.symbols_for(region_id)}
+
+    def precompute(self, fonts):
+        """Rasterizes each region's symbols at each size the region can reach."""
+        self.fonts = fonts
+        for region_id in REGION_INDICES:
+            for size in self.font_sizes(region_id):
+                for sym in self.symbols_for(region_id):
+                    self.mask(sym, size)
+
+    def mask(self, sym, size):
+        """Unrotated coverage mask of sym at size, or None if it has no ink."""
+        key = (sym, size)
+        if key not in self.masks:
+            self.masks[key] = render_glyph_mask(sym, self.fonts.font_for(sym, size), 0)
+        return self.masks[key]
+
+    def glyph_mask(self, sym, size, angle):
+        """Coverage mask of sym at size rotated by angle degrees (as render_glyph_mask), or None."""
+        key = (sym, size, angle)
+        if key not in self.rotated:
+            mask = self.mask(sym, size)
+            if mask is not None and angle:
+                mask = np.asarray(Image.fromarray(mask).rotate(angle, expand=1))
+            self.rotated[key] = mask
+        return self.rotated[key]
+
+    def text_origin(self, sym, size):
+        """(font family, dx, dy): where the text baseline origin of sym at size sits relative to
+        the centre of its ink, for vector output that must match the raster placement."""
+        key = (sym, size)
+        if key not in self.origins:
+            font = self.fonts.font_for(sym, size)
+            left, top, right, bottom = font.getbbox(sym)
+            ascent = font.getmetrics()[0]
+            self.origins[key] = (font.getname()[0], -(left + right) / 2, ascent - (top + bottom) / 2)
+        return self.origins[key]
+
+    def describe(self):
+        """JSON-friendly summary for the /palettes endpoint."""
+        preview = []
+        for region_id in sorted(self.symbols):
+            for sym in self.symbols[region_id]:
+                if sym not in preview:
+                    preview.append(sym)
+        return {
+            'name': self.name,
+            'label': self.label,
+            'description': self.description,
+            'preview': ''.join(preview[:12]),
+            'regions': len(self.symbols),
+        }
+
+
+def load_palettes(directory=PALETTE_DIR, fonts=None):
+    """Reads every palette file in directory, resolving "extends", and precomputes their glyphs."""
+    specs = {}
+    for path in sorted(glob.glob(osp.join(directory, '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            spec = json.load(f)
+        spec.setdefault('name', osp.splitext(osp.basename(path))[0])
+        specs[spec['name'].lower()] = spec
+
+    palettes = {}
+
+    def resolve(name, chain=()):
+        if name in palettes:
+            return palettes[name]
+        if name in chain:
+            raise ValueError(f'Palette inheritance cycle: {" -> ".join(chain + (name,))}')
+        if name not in specs:
+            raise ValueError(f'Unknown palette {name!r} in {directory}')
+        spec = specs[name]
+        base = resolve(spec['extends'].lower(), chain + (name,)) if spec.get('extends') else None
+        palettes[name] = Palette.from_dict(spec, base)
+        return palettes[name]
+
+    for name in specs:
+        resolve(name)
+    fonts = fonts or get_font_manager()
+    fonts.check_coverage(set().union(*(palette.all_symbols() for palette in palettes.values())))
+    for palette in palettes.values():
+        palette.precompute(fonts)
+    return palettes
+
+
+def get_registry():
+    """The process-wide palettes, loaded on first use."""
+    global _registry
+    if _registry is None:
+        _registry = load_palettes()
+    return _registry
+
+
+def get_palette(name):
+    """Palette by name (case-insensitive); unknown names get the default palette."""
+    registry = get_registry()
+    return registry.get((name or DEFAULT_PALETTE).lower(), registry[DEFAULT_PALETTE])
+
+
+def list_palettes():
+    return [palette.describe() for palette in get_registry().values()]
@@ -0,0 +1,442 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Batched BiSeNet inference.
+#
+# parse_batch() takes in-memory images, resizes and normalizes them as tensors, runs one
+# forward pass for the whole batch and takes the argmax on the device, so only uint8 label
+# maps are copied back. iter_parse_dir() does the same for a folder through a prefetching
+# DataLoader so decoding overlaps with inference.
+#
+# Only the main BiSeNet head is evaluated (BiSeNetInference). Its 1/8-resolution logits are
+# brought back to full size in one of two ways:
+#   'logits' - bilinear upsampling of the logits, then argmax (identical to net(x)[0])
+#   'labels' - argmax at 1/8 resolution, then nearest upsampling of the labels; avoids the
+#              19-channel full-size interpolation and argmax at a small cost in edge accuracy
+# benchmarks/bench_bisenet_head.py measures both against the full network.
+#
+# parse_letterboxed() is the aspect-preserving path for a single image: it scales the image so
+# its long side matches a parse resolution chosen from the target label-map size, pads it
+# bottom/right to the network stride and maps the 1/8 logits straight onto the target grid
+# (band by band, so full-size 19-channel logits never exist) instead of stretching the image
+# to a square and upsampling square labels afterwards.
+#
+# parse_tiled() parses at native resolution instead, like RealESRGANer's tiling: overlapping
+# stride-aligned tiles are run batch_size at a time and their 1/8 logits blended into one
+# 1/8-resolution accumulator with linear ramps across the overlaps, so memory is bounded by the
+# tile batch and the accumulator rather than the image size.
+#
+# load_parser() is what long-lived callers use: BatchNorm folded into the convolutions and
+# channels-last weights, or the torch.jit.freeze'd artifact written by export_bisenet.py.
+# With quantized=True it prefers the static INT8 artifact written by quantize.py (CPU only);
+# backend='onnxruntime' runs the ONNX export (export_bisenet.py --onnx) through ort_runner.OnnxRuntimeModel.
+
+import inspect
+import math
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+from model import BiSeNet, BiSeNetInference, fuse_for_inference
+from ort_runner import OnnxRuntimeModel
+
+SCRIPT_DIR = osp.dirname(osp.abspath(__file__))
+N_CLASSES = 19
+PARSE_SIZE = 512
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+UPSAMPLE_MODES = ('logits', 'labels')
+STRIDE = 32
+MAX_PARSE_SIDE = 1024
+FROZEN_ARTIFACT = osp.join(SCRIPT_DIR, 'res/cp', 'bisenet_fused.pt')
+INT8_ARTIFACT = osp.join(SCRIPT_DIR, 'res/cp', 'bisenet_int8.pt')
+ONNX_ARTIFACT = osp.join(SCRIPT_DIR, 'res/cp', 'bisenet.onnx')
+BACKENDS = ('torch', 'onnxruntime')
+
+
+def default_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def module_device(net):
+    # Frozen TorchScript modules have their weights inlined and expose no parameters;
+    # the onnxruntime runner has none at all and runs on the CPU
+    if isinstance(net, torch.nn.Module):
+        for tensor in net.parameters():
+            return tensor.device
+    return torch.device('cpu')
+
+
+def pixel_agreement(pred, ref):
+    """Fraction of pixels where two label maps agree."""
+    return float((np.asarray(pred) == np.asarray(ref)).mean())
+
+
+def mean_iou(pred, ref, n_classes=N_CLASSES):
+    """Mean IoU of the label map pred against ref over the classes present in either."""
+    pred, ref = np.asarray(pred).ravel(), np.asarray(ref).ravel()
+    hist = np.bincount(ref.astype(np.int64) * n_classes + pred, minlength=n_classes * n_classes)
+    hist = hist.reshape(n_classes, n_classes)
+    inter = np.diag(hist)
+    union = hist.sum(0) + hist.sum(1) - inter
+    present = union > 0
+    return float((inter[present] / union[present]).mean()) if present.any() else 1.0
+
+
+def load_bisenet(cp='79999_iter.pth', device=None, inference=True):
+    """Builds BiSeNet and loads a checkpoint; relative paths are looked up in res/cp.
+
+    Returns the inference-only main head unless inference=False.
+    """
+    device = device or default_device()
+    net = BiSeNet(n_classes=N_CLASSES)
+    save_pth = cp if osp.isabs(cp) else osp.join(SCRIPT_DIR, 'res/cp', cp)
+    net.load_state_dict(torch.load(save_pth, map_location=device))
+    if inference:
+        net = BiSeNetInference(net)
+    net.to(device)
+    net.eval()
+    return net
+
+
+def load_parser(cp='79999_iter.pth', artifact=None, device=None, quantized=False, backend='torch', num_threads=0):
+    """Loads the network for serving: the frozen TorchScript artifact if it exists, otherwise
+    the checkpoint's inference head with BatchNorm folded and channels-last weights.
+
+    quantized=True loads INT8_ARTIFACT on the CPU instead when it exists; backend='onnxruntime'
+    loads ONNX_ARTIFACT with num_threads intra-op threads.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'backend must be one of {BACKENDS}, got {backend!r}')
+    if backend == 'onnxruntime':
+        if osp.isfile(ONNX_ARTIFACT):
+            return OnnxRuntimeModel(ONNX_ARTIFACT, num_threads)
+        print(f'ONNX BiSeNet not found at {ONNX_ARTIFACT}, run export_bisenet.py --onnx; using torch')
+    if quantized:
+        if osp.isfile(INT8_ARTIFACT):
+            net = torch.jit.load(INT8_ARTIFACT, map_location='cpu')
+            net.eval()
+            return net
+        print(f'INT8 BiSeNet not found at {INT8_ARTIFACT}, run quantize.py; using the float model')
+    device = device or default_device()
+    if artifact and osp.isfile(artifact):
+        net = torch.jit.load(artifact, map_location=device)
+        net.eval()
+        return net
+    return fuse_for_inference(load_bisenet(cp, device))
+
+
+def export_frozen(net, path, size=PARSE_SIZE):
+    """Traces a (fused) inference network at 1x3xSxS, freezes it and saves it to path.
+
+    The trace keeps the spatial sizes symbolic, so the artifact accepts any batch and size.
+    """
+    example = torch.zeros(1, 3, size, size, device=module_device(net))
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(net, example).eval())
+    traced.save(path)
+    return traced
+
+
+def export_onnx(net, path, size=PARSE_SIZE, opset_version=11):
+    """Exports an inference network to ONNX with symbolic batch, height and width."""
+    example = torch.zeros(1, 3, size, size, device=module_device(net))
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Newer torch defaults to the dynamo exporter; dynamic_axes belong to the TorchScript one
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(net, example, path, opset_version=opset_version, input_names=['input'],
+                          output_names=['logits'], dynamic_axes={'input': axes, 'logits': axes}, **kwargs)
+
+
+def image_tensor(img):
+    """RGB image (PIL or HxWx3 uint8 array) -> 3xHxW uint8 tensor."""
+    if isinstance(img, Image.Image):
+        img = np.array(img.convert('RGB'))
+    elif not img.flags.writeable:
+        img = img.copy()
+    return torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+
+
+def resize_tensor(x, size):
+    """Bilinear resize of a 3xHxW uint8 tensor to size (H, W)."""
+    if tuple(x.shape[-2:]) == tuple(size):
+        return x
+    # antialias matches PIL's BILINEAR when downscaling large uploads
+    x = F.interpolate(x[None].float(), size, mode='bilinear', align_corners=False, antialias=True)
+    return x.round_().clamp_(0, 255).to(torch.uint8)[0]
+
+
+def resize_image(img, size=PARSE_SIZE):
+    """Converts an RGB image (PIL or HxWx3 uint8 array) to a 3xSxS uint8 tensor."""
+    return resize_tensor(image_tensor(img), (size, size))
+
+
+def choose_parse_side(target_size, base=PARSE_SIZE, max_side=MAX_PARSE_SIDE):
+    """Long side to run the network at for a label map of target_size (H, W).
+
+    Half the target's long side, clamped to [base, max_side]: the logits are interpolated to the
+    target afterwards, so parsing at full resolution buys little for the extra cost.
+    """
+    return int(min(max_side, max(base, max(target_size) // 2)))
+
+
+def letterbox(x, long_side, stride=STRIDE):
+    """Scales a 3xHxW uint8 tensor so its long side is long_side, keeping the aspect ratio.
+
+    Returns the resized tensor and the (height, width) padded up to a multiple of stride.
+    """
+    height, width = x.shape[-2:]
+    scale = long_side / max(height, width)
+    x = resize_tensor(x, (max(1, round(height * scale)), max(1, round(width * scale))))
+    h, w = x.shape[-2:]
+    return x, (math.ceil(h / stride) * stride, math.ceil(w / stride) * stride)
+
+
+def upsample_letterboxed(out, content_size, padded_size, size, upsample='logits', band_rows=256):
+    """Maps 1xCxhxw logits of a letterboxed input onto an (H, W) = size uint8 label map.
+
+    content_size is the (h, w) of the image inside the padded_size input. 'logits' samples the
+    logits bilinearly and takes the argmax, 'labels' samples the 1/8 argmax with nearest. Runs
+    band_rows output rows at a time so memory stays at C x band_rows x W.
+    """
+    if upsample not in UPSAMPLE_MODES:
+        raise ValueError(f'upsample must be one of {UPSAMPLE_MODES}, got {upsample!r}')
+    H, W = size
+    (h, w), (hp, wp) = content_size, padded_size
+    if upsample == 'labels':
+        src, mode = out.argmax(1, keepdim=True).float(), 'nearest'
+    else:
+        src, mode = out.float(), 'bilinear'
+    # Output pixel centres in grid_sample's [-1, 1] coordinates of the padded input
+    xs = (torch.arange(W, device=out.device) + 0.5) * (2.0 * w / (W * wp)) - 1
+    ys = (torch.arange(H, device=out.device) + 0.5) * (2.0 * h / (H * hp)) - 1
+    labels = torch.empty((H, W), dtype=torch.uint8, device=out.device)
+    for r0 in range(0, H, band_rows):
+        gy = ys[r0:r0 + band_rows]
+        grid = torch.stack(torch.broadcast_tensors(xs[None, :], gy[:, None]), -1)[None]
+        band = F.grid_sample(src, grid, mode=mode, padding_mode='border', align_corners=False)[0]
+        labels[r0:r0 + len(gy)] = band.argmax(0) if upsample == 'logits' else band[0]
+    return labels
+
+
+def normalize_batch(batch, device):
+    """uint8 Bx3xHxW -> normalized float tensor on device (ToTensor + Normalize for a batch)."""
+    batch = batch.to(device, non_blocking=True).float().div_(255.0)
+    mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, device=device).view(1, 3, 1, 1)
+    return batch.sub_(mean).div_(std)
+
+
+def logits_to_labels(out, size, upsample='logits'):
+    """Turns BxCxhxw logits into BxHxW uint8 labels at size (H, W) using the given upsample mode."""
+    if upsample not in UPSAMPLE_MODES:
+        raise ValueError(f'upsample must be one of {UPSAMPLE_MODES}, got {upsample!r}')
+    if tuple(out.shape[-2:]) == tuple(size):
+        return out.argmax(1).to(torch.uint8)
+    if upsample == 'labels':
+        labels = out.argmax(1, keepdim=True).to(torch.uint8)
+        return F.interpolate(labels, size, mode='nearest')[:, 0]
+    out = F.interpolate(out, size, mode='bilinear', align_corners=True)
+    return out.argmax(1).to(torch.uint8)
+
+
+def forward_logits(net, batch):
+    out = net(batch)
+    if isinstance(out, (tuple, list)):
+        out = out[0]
+    return out
+
+
+@torch.no_grad()
+def parse_tensor(net, batch, device=None, upsample='logits'):
+    """Runs BiSeNet on a uint8 Bx3xSxS batch and returns BxSxS uint8 label maps as a numpy array.
+
+    net may be BiSeNetInference or the full BiSeNet (whose first output is used).
+    """
+    device = device or module_device(net)
+    out = forward_logits(net, normalize_batch(batch, device))
+    return logits_to_labels(out, batch.shape[-2:], upsample).cpu().numpy()
+
+
+def parse_batch(net, images, size=PARSE_SIZE, device=None, upsample='logits'):
+    """Parses a list of RGB images (PIL or uint8 arrays, any sizes) in one forward pass.
+
+    Returns a (B, size, size) uint8 array of class indices.
+    """
+    if len(images) == 0:
+        return np.zeros((0, size, size), dtype=np.uint8)
+    batch = torch.stack([resize_image(img, size) for img in images])
+    return parse_tensor(net, batch, device, upsample)
+
+
+@torch.no_grad()
+def parse_letterboxed(net, img, size=None, max_side=MAX_PARSE_SIDE, device=None, upsample='logits'):
+    """Parses one RGB image (PIL or uint8 array) without distorting its aspect ratio.
+
+    Returns an (H, W) uint8 label map at size, by default the image's own size.
+    """
+    device = device or module_device(net)
+    x = image_tensor(img)
+    size = tuple(size or x.shape[-2:])
+    x, (hp, wp) = letterbox(x, choose_parse_side(size, max_side=max_side))
+    h, w = x.shape[-2:]
+    # Padding after normalization fills with the mean colour, i.e. zeros
+    batch = F.pad(normalize_batch(x[None], device), (0, wp - w, 0, hp - h))
+    out = forward_logits(net, batch)
+    return upsample_letterboxed(out, (h, w), (hp, wp), size, upsample).cpu().numpy()
+
+
+@torch.no_grad()
+def parse_letterboxed_batch(net, images, max_side=MAX_PARSE_SIDE, device=None, upsample='logits', batch_size=8):
+    """parse_letterboxed over a list of RGB images, batch_size at a time per letterboxed input size.
+
+    Images that letterbox to the same padded size share a forward pass, so the label maps are
+    the same as parse_letterboxed's. Returns a list of (H, W) uint8 label maps, in order.
+    """
+    device = device or module_device(net)
+    boxed, groups = [], {}
+    for i, img in enumerate(images):
+        x = image_tensor(img)
+        size = tuple(x.shape[-2:])
+        x, padded = letterbox(x, choose_parse_side(size, max_side=max_side))
+        boxed.append((x, size))
+        groups.setdefault(padded, []).append(i)
+
+    labels = [None] * len(images)
+    for (hp, wp), indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            batch = torch.cat([F.pad(normalize_batch(boxed[i][0][None], device),
+                                     (0, wp - boxed[i][0].shape[-1], 0, hp - boxed[i][0].shape[-2])) for i in chunk])
+            out = forward_logits(net, batch)
+            for j, i in enumerate(chunk):
+                x, size = boxed[i]
+                labels[i] = upsample_letterboxed(out[j:j + 1], tuple(x.shape[-2:]), (hp, wp), size,
+                                                 upsample).cpu().numpy()
+    return labels
+
+
+def tile_starts(length, tile, step):
+    """Tile offsets covering [0, length); the last tile is aligned to the end."""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, step))
+    return starts + [length - tile]
+
+
+def blend_window(size, ramp):
+    """1-D weights rising linearly over ramp cells at both ends (never zero)."""
+    i = torch.arange(size, dtype=torch.float32)
+    return torch.minimum(i + 1, size - i).clamp_(max=ramp) / ramp
+
+
+@torch.no_grad()
+def parse_tiled(net, img, tile=PARSE_SIZE, overlap=128, batch_size=4, device=None, upsample='logits'):
+    """Parses one RGB image (PIL or uint8 array) at native resolution with overlapping tiles.
+
+    tile and overlap are rounded to the network stride; tiles are batched batch_size at a time.
+    Each tile only sees its own context (BiSeNet pools globally per input), so keep tiles
+    large enough to hold a good part of the face. Returns an (H, W) uint8 label map.
+    """
+    device = device or module_device(net)
+    tile = max(STRIDE, tile // STRIDE * STRIDE)
+    overlap = min(tile - STRIDE, max(0, overlap // STRIDE * STRIDE))
+    x = image_tensor(img)
+    height, width = x.shape[-2:]
+    hp, wp = math.ceil(height / STRIDE) * STRIDE, math.ceil(width / STRIDE) * STRIDE
+    full = F.pad(normalize_batch(x[None], device), (0, wp - width, 0, hp - height))
+
+    scale = 8  # BiSeNetInference emits logits at 1/8 resolution
+    boxes = [(y, x0) for y in tile_starts(hp, tile, tile - overlap) for x0 in tile_starts(wp, tile, tile - overlap)]
+    th, tw = min(tile, hp), min(tile, wp)
+    ramp = max(1, overlap // scale)
+    weight = (blend_window(th // scale, ramp)[:, None] * blend_window(tw // scale, ramp)[None, :]).to(device)
+    acc = weight_sum = None
+
+    for i in range(0, len(boxes), batch_size):
+        chunk = boxes[i:i + batch_size]
+        batch = torch.cat([full[:, :, y:y + th, x0:x0 + tw] for y, x0 in chunk])
+        out = forward_logits(net, batch).float()
+        if acc is None:
+            acc = torch.zeros((1, out.shape[1], hp // scale, wp // scale), device=device)
+            weight_sum = torch.zeros((hp // scale, wp // scale), device=device)
+        for logits, (y, x0) in zip(out, chunk):
+            ys, xs = slice(y // scale, (y + th) // scale), slice(x0 // scale, (x0 + tw) // scale)
+            acc[0, :, ys, xs] += logits * weight
+            weight_sum[ys, xs] += weight
+    acc /= weight_sum
+    return upsample_letterboxed(acc, (height, width), (hp, wp), (height, width), upsample).cpu().numpy()
+
+
+def count_tiles(height, width, tile=PARSE_SIZE, overlap=128):
+    """Number of tiles parse_tiled runs the network on for a height x width image."""
+    tile = max(STRIDE, tile // STRIDE * STRIDE)
+    overlap = min(tile - STRIDE, max(0, overlap // STRIDE * STRIDE))
+    hp, wp = math.ceil(height / STRIDE) * STRIDE, math.ceil(width / STRIDE) * STRIDE
+    return len(tile_starts(hp, tile, tile - overlap)) * len(tile_starts(wp, tile, tile - overlap))
+
+
+class ImageFolder(Dataset):
+    """Decodes and resizes the images of a folder (or a single file) in DataLoader workers."""
+
+    def __init__(self, dspth, size=PARSE_SIZE):
+        if osp.isfile(dspth):
+            self.root = osp.dirname(dspth)
+            self.names = [osp.basename(dspth)]
+        else:
+            self.root = dspth
+            self.names = sorted(n for n in os.listdir(dspth) if n.lower().endswith(IMG_EXTENSIONS))
+        self.size = size
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        name = self.names[idx]
+        img = Image.open(osp.join(self.root, name)).convert('RGB')
+        return resize_image(img, self.size), name
+
+
+def iter_parse_letterboxed(net, dspth, max_side=MAX_PARSE_SIDE, device=None, upsample='logits', tile=0):
+    """Yields (name, uint8 HxWx3 image, uint8 HxW label map) at each image's own size.
+
+    tile > 0 parses at native resolution with parse_tiled instead of letterboxing.
+    """
+    dataset = ImageFolder(dspth)
+    for name in dataset.names:
+        image = np.array(Image.open(osp.join(dataset.root, name)).convert('RGB'))
+        if tile:
+            labels = parse_tiled(net, image, tile=tile, device=device, upsample=upsample)
+        else:
+            labels = parse_letterboxed(net, image, max_side=max_side, device=device, upsample=upsample)
+        yield name, image, labels
+
+
+def iter_parse_dir(net, dspth, batch_size=8, num_workers=2, size=PARSE_SIZE, device=None, upsample='logits'):
+    """Yields (name, resized uint8 HxWx3 image, uint8 label map) for every image in dspth."""
+    device = device or module_device(net)
+    dataset = ImageFolder(dspth, size)
+    if len(dataset) <= batch_size:
+        # A single batch gains nothing from prefetching; skip the worker start-up
+        num_workers = 0
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=device.type == 'cuda',
+        prefetch_factor=2 if num_workers > 0 else None)
+    for batch, names in loader:
+        labels = parse_tensor(net, batch, device, upsample)
+        images = batch.permute(0, 2, 3, 1).numpy()
+        for name, image, parsing in zip(names, images, labels):
+            yield name, image, parsing
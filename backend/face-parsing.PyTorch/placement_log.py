@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Compact columnar log of the symbols create_math_face placed, for the animation frontend.
+#
+# Layout (little-endian):
+#   b'MFPL' | u8 version | u32 header length | header (UTF-8 JSON) | column data
+# The header holds the canvas size, the symbol count, the symbol dictionary (column "symbol"
+# indexes into it) and, per column, its dtype and byte offset into the column data. Each
+# column starts on an 8-byte boundary so a reader can view it in place (numpy.frombuffer,
+# JavaScript typed arrays). Placement order is row order; a symbol's top-left corner is
+# (x - width // 2, y - height // 2).
+#
+# The whole file is written with one write, optionally gzip (.gz) or zstd (.zst) compressed.
+#
+#   python placement_log.py "../Divided Regions/symbol_placements.mfpl"   # dump as JSON
+
+import argparse
+import gzip
+import json
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'MFPL'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sBI')
+ALIGN = 8
+
+# (name, dtype) in the order of create_math_face's placement tuples
+COLUMNS = (
+    ('symbol', '<u2'),
+    ('font_size', '<u2'),
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('rotation', 'i1'),
+    ('brightness', 'u1'),
+    ('alpha', 'u1'),
+    ('region_id', 'u1'),
+    ('width', '<u2'),
+    ('height', '<u2'),
+)
+
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd placement logs need the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decompress(data):
+    if data[:2] == b'\x1f\x8b':
+        return gzip.decompress(data)
+    if data[:4] == b'\x28\xb5\x2f\xfd':
+        return _zstd().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def encode(placements, width, height):
+    """Packs create_math_face's placement tuples into the log's bytes."""
+    symbols = {}
+    rows = [(symbols.setdefault(p[0], len(symbols)),) + tuple(p[1:]) for p in placements]
+    table = np.array(rows, dtype=[(name, dtype) for name, dtype in COLUMNS]) if rows else None
+
+    columns, chunks, offset = [], [], 0
+    for name, dtype in COLUMNS:
+        data = table[name].tobytes() if table is not None else b''
+        pad = -len(data) % ALIGN
+        columns.append({'name': name, 'dtype': np.dtype(dtype).str, 'offset': offset})
+        chunks += [data, b'\0' * pad]
+        offset += len(data) + pad
+
+    header = json.dumps({
+        'width': width,
+        'height': height,
+        'count': len(rows),
+        'symbols': list(symbols),
+        'columns': columns,
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    # pad the header too, so the column data (and every column) starts aligned
+    header += b' ' * (-(PREAMBLE.size + len(header)) % ALIGN)
+    return b''.join([PREAMBLE.pack(MAGIC, VERSION, len(header)), header] + chunks)
+
+
+def decode(data):
+    """Inverse of encode: returns (header dict, {column name: array})."""
+    data = decompress(data)
+    magic, version, header_len = PREAMBLE.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a version {VERSION} placement log')
+    start = PREAMBLE.size + header_len
+    header = json.loads(data[PREAMBLE.size:start].decode('utf-8'))
+    columns = {col['name']: np.frombuffer(data, dtype=col['dtype'], count=header['count'],
+                                          offset=start + col['offset'])
+               for col in header['columns']}
+    return header, columns
+
+
+def write_log(path, placements, width, height, compression=None):
+    """Writes the log to path plus the compression's extension and returns that path."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression!r}, use one of {list(COMPRESSIONS)}')
+    path += COMPRESSIONS[compression]
+    data = compress(encode(placements, width, height), compression)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def read_log(path):
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+
+def to_records(header, columns):
+    """The log as a list of per-symbol dicts, e.g. for debugging or JSON export."""
+    symbols = header['symbols']
+    names = [name for name, _ in COLUMNS]
+    return [dict(zip(names, row), symbol=symbols[row[0]])
+            for row in zip(*(columns[name].tolist() for name in names))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='Placement log (.mfpl, .mfpl.gz or .mfpl.zst)')
+    args = parser.parse_args()
+    header, columns = read_log(args.path)
+    json.dump({'width': header['width'], 'height': header['height'], 'placements': to_records(header, columns)},
+              sys.stdout, ensure_ascii=False)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Post-training static INT8 quantization of the BiSeNet inference head for CPU serving.
+#
+# FX graph mode quantization with the x86 (fbgemm) default config: per-channel int8 weights,
+# per-tensor uint8 activations calibrated on sample faces. The converted model is traced,
+# frozen and saved as TorchScript; load_parser(quantized=True) picks it up.
+#
+#   python quantize.py --calib ../test_img --eval ../test_img --cp 79999_iter.pth
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from parsing import (INT8_ARTIFACT, PARSE_SIZE, ImageFolder, load_bisenet, logits_to_labels, mean_iou,
+                     normalize_batch, pixel_agreement)
+
+
+def load_batches(dspth, batch_size=4, limit=None):
+    """Normalized float batches of the images in dspth, resized to the parsing size."""
+    dataset = ImageFolder(dspth)
+    n = len(dataset) if limit is None else min(limit, len(dataset))
+    if n == 0:
+        raise ValueError(f'No images found in {dspth}')
+    images = [dataset[i][0] for i in range(n)]
+    cpu = torch.device('cpu')
+    return [normalize_batch(torch.stack(images[i:i + batch_size]), cpu) for i in range(0, n, batch_size)]
+
+
+def quantize_bisenet(net, calib_batches, backend='x86'):
+    """Quantizes a float BiSeNetInference, calibrating activations on calib_batches.
+
+    Returns the converted FX GraphModule (CPU only).
+    """
+    torch.backends.quantized.engine = 'fbgemm' if backend == 'x86' else backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    prepared = prepare_fx(net.cpu().eval(), qconfig_mapping, example_inputs=(calib_batches[0],))
+    with torch.no_grad():
+        for batch in calib_batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def save_frozen(qnet, path, size=PARSE_SIZE):
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(qnet, torch.zeros(1, 3, size, size)).eval())
+    traced.save(path)
+    return traced
+
+
+@torch.no_grad()
+def accuracy_report(float_net, qnet, batches):
+    """mIoU / pixel agreement of the INT8 labels against the float model, plus timings."""
+    ious, agree, float_ms, int8_ms, n = [], [], 0.0, 0.0, 0
+    for batch in batches:
+        size = batch.shape[-2:]
+        start = time.perf_counter()
+        ref = logits_to_labels(float_net(batch), size).numpy()
+        float_ms += (time.perf_counter() - start) * 1000.0
+        start = time.perf_counter()
+        pred = logits_to_labels(qnet(batch), size).numpy()
+        int8_ms += (time.perf_counter() - start) * 1000.0
+        for p, r in zip(pred, ref):
+            ious.append(mean_iou(p, r))
+            agree.append(pixel_agreement(p, r))
+        n += len(batch)
+    return {
+        'images': n,
+        'miou_vs_float': round(float(np.mean(ious)), 5),
+        'pixel_agreement': round(float(np.mean(agree)), 5),
+        'float_ms_per_image': round(float_ms / n, 2),
+        'int8_ms_per_image': round(int8_ms / n, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calib', type=str, required=True, help='Folder of sample faces for calibration')
+    parser.add_argument('--eval', type=str, default=None, help='Folder of faces for the accuracy report')
+    parser.add_argument('--cp', type=str, default='79999_iter.pth', help='BiSeNet checkpoint in res/cp')
+    parser.add_argument('--output', type=str, default=INT8_ARTIFACT, help='Output TorchScript path')
+    parser.add_argument('--num_calib', type=int, default=32, help='Maximum number of calibration images')
+    parser.add_argument('--batch_size', type=int, default=4)
+    args = parser.parse_args()
+
+    net = load_bisenet(args.cp, torch.device('cpu'))
+    calib = load_batches(args.calib, args.batch_size, args.num_calib)
+    qnet = quantize_bisenet(net, calib)
+    save_frozen(qnet, args.output)
+    print(f'Saved INT8 BiSeNet to {args.output} (calibrated on {sum(len(b) for b in calib)} images)')
+
+    report = accuracy_report(net, qnet, load_batches(args.eval or args.calib, args.batch_size))
+    print('Accuracy vs float:', report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# The mathematical face renderer: splits the parsed image into per-region images and draws
+# each region with its palette's symbols. Importable without side effects, so server.py can
+# keep the palette registry (and its rasterized glyphs) resident across requests; test.py
+# runs the same functions from the command line.
+#
+# Symbols are first placed (positions, sizes, rotations, colours), then either composited
+# onto a raster canvas (PNG, WebP or JPEG) or written out as SVG <text> elements without
+# rasterizing.
+# The raster can be composited coarse-to-fine in several passes, handing a preview of the
+# canvas to a callback after each pass but the last.
+
+import logging
+import math
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+import numpy as np
+from PIL import Image
+
+from math_face import REGION_INDICES, JITTER_CAP_PX, ROT_RANGE_DEG, GAMMA_LUT, glyph_image
+from palettes import get_palette
+from placement_log import write_log
+from shared_arrays import ArrayRef, Attached
+
+Image.MAX_IMAGE_PIXELS = None
+
+# Per-region and per-render progress is logged at debug level: the renderer runs in the server
+# and its render processes on every request (test.py turns it on for the command line)
+logger = logging.getLogger('renderer')
+
+# output_format -> (file extension, PIL format) of the raster outputs; 'svg' is written as text
+RASTER_FORMATS = {
+    'png': ('png', 'PNG'),
+    'webp': ('webp', 'WEBP'),
+    'webp_lossless': ('webp', 'WEBP'),
+    'jpeg': ('jpg', 'JPEG'),
+}
+OUTPUT_FORMATS = tuple(RASTER_FORMATS) + ('svg',)
+
+# encode_speed -> encoder options per raster format; 'balanced' PNG is PIL's default (zlib level 6)
+ENCODE_SPEEDS = ('fast', 'balanced', 'small')
+ENCODE_OPTIONS = {
+    'png': {'fast': {'compress_level': 1}, 'balanced': {'compress_level': 6}, 'small': {'compress_level': 9}},
+    'webp': {'fast': {'quality': 85, 'method': 0}, 'balanced': {'quality': 85, 'method': 4},
+             'small': {'quality': 80, 'method': 6}},
+    'webp_lossless': {'fast': {'lossless': True, 'quality': 0, 'method': 0},
+                      'balanced': {'lossless': True, 'quality': 60, 'method': 4},
+                      'small': {'lossless': True, 'quality': 80, 'method': 5}},
+    'jpeg': {'fast': {'quality': 90}, 'balanced': {'quality': 90, 'optimize': True},
+             'small': {'quality': 85, 'optimize': True, 'progressive': True}},
+}
+
+# density runs 1-100; at DEFAULT_DENSITY every region uses its palette's own lattice step and
+# the number of symbols scales roughly linearly with density around it
+DEFAULT_DENSITY = 50
+MIN_STEP = 2
+
+
+def output_extension(output_format):
+    return 'svg' if output_format == 'svg' else RASTER_FORMATS[output_format][0]
+
+
+def encode_canvas(canvas, path, output_format, encode_speed='balanced'):
+    """Saves the RGBA canvas as a raster output_format. The canvas is opaque (black background),
+    so every format but PNG drops the alpha channel."""
+    _, pil_format = RASTER_FORMATS[output_format]
+    image = canvas if output_format == 'png' else canvas.convert('RGB')
+    image.save(path, format=pil_format, **ENCODE_OPTIONS[output_format][encode_speed])
+
+
+# Script 2 code
+def extract_regions(orig_path=None, parsing_path=None, output_dir=None):
+    """Writes region_<id>.png per label of parsing_path, cut out of orig_path, into output_dir (cleared first).
+
+    The defaults are the single-process layout: test_img/test.jpg, res/test_res/test_label.png
+    and "Divided Regions"; pipeline workers pass a folder of their own per job. orig_path and
+    parsing_path may also be the arrays themselves (HxWx3 RGB and HxW labels, uint8).
+    """
+    # Paths - Using relative paths from the script location
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    project_root = os.path.dirname(script_dir)  # Go up one level from face-parsing.PyTorch
+    
+    if orig_path is None:
+        orig_path = os.path.join(project_root, "test_img", "test.jpg")
+    if parsing_path is None:
+        parsing_path = os.path.join(script_dir, "res", "test_res", "test_label.png")
+    output_dir = output_dir or os.path.join(project_root, "Divided Regions")
+
+    # Clear the output directory to avoid conflicts with old region files
+    if os.path.exists(output_dir):
+        import shutil
+        shutil.rmtree(output_dir)
+        logger.debug('Cleared old region files from: %s', output_dir)
+    
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Load images
+    orig = orig_path if isinstance(orig_path, np.ndarray) else np.array(Image.open(orig_path).convert('RGB'))
+    parsing = parsing_path if isinstance(parsing_path, np.ndarray) else np.array(Image.open(parsing_path))
+
+    # Optionally, print present region indices
+    unique_indices = np.unique(parsing)
+    logger.debug('Present region indices: %s', unique_indices)
+
+    for idx in unique_indices:
+        # Skip background if you wish
+        if idx == 0:
+            continue
+
+        mask = (parsing == idx).astype(np.uint8)
+
+        # Resize mask to match original image if needed (using cv2 for speed):
+        if mask.shape[:2] != orig.shape[:2]:
+            import cv2  # only label maps of another size need it; render processes skip the import
+
+            mask = cv2.resize(mask, (orig.shape[1], orig.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+        # Multiply to get only that region in color
+        part_image = orig * mask[:, :, None]
+
+        # Save with clear index
+        filename = f"region_{idx}.png"
+        Image.fromarray(part_image).save(os.path.join(output_dir, filename))
+        logger.debug('Saved %s', filename)
+
+    logger.debug('All segmented region images saved in: %s', output_dir)
+
+def lattice_steps(regions, density=DEFAULT_DENSITY, max_symbols=None, count=None):
+    """Lattice step per region for a density and an optional cap on the number of symbols.
+
+    regions is a list of (pixel_count, palette step). A region holds about
+    pixel_count / step ** 2 lattice points, so steps scale by sqrt(DEFAULT_DENSITY / density).
+    If the estimate still exceeds max_symbols, every step grows by the same factor to fit,
+    which bounds the render time of a request. The integer steps are then checked with
+    count(i, step), the exact number of lattice points of region i at that step (the estimate
+    by default), and grown until the regions hold at most max_symbols points between them.
+    """
+    scale = math.sqrt(DEFAULT_DENSITY / min(max(density, 1), 100))
+    steps = []
+    for pixel_count, step in regions:
+        # Dynamic step sizing: larger step for smaller regions (speedup!)
+        if pixel_count < 2000:
+            step *= 2.0
+        elif pixel_count < 5000:
+            step *= 1.5
+        steps.append(step * scale)
+
+    if not max_symbols:
+        return [max(MIN_STEP, int(step)) for step in steps]
+
+    estimate = sum(pixel_count / step ** 2 for (pixel_count, _), step in zip(regions, steps))
+    if estimate > max_symbols:
+        # Rounded up: rounding down would add back points the cap just took away
+        steps = [max(MIN_STEP, math.ceil(step * math.sqrt(estimate / max_symbols))) for step in steps]
+    else:
+        steps = [max(MIN_STEP, int(step)) for step in steps]
+    count = count or (lambda i, step: regions[i][0] / step ** 2)
+    counts = [count(i, step) for i, step in enumerate(steps)]
+    # A region down to its one point at (0, 0) can't shrink further
+    while sum(counts) > max_symbols and any(c > 1 for c in counts):
+        factor = math.sqrt(sum(counts) / max_symbols)
+        steps = [max(step + 1, math.ceil(step * factor)) for step in steps]
+        counts = [count(i, step) for i, step in enumerate(steps)]
+    return steps
+
+
+def lattice_pass(iy, ix, passes):
+    """Pass (0 = coarsest) that draws each lattice point (iy, ix arrays) out of `passes`.
+
+    Pass k adds the points on the grid spaced 2 ** (passes - 1 - k) lattice steps apart, so
+    each pass roughly quadruples the density of the previous one.
+    """
+    pass_ids = np.full(np.broadcast(iy, ix).shape, passes - 1, dtype=np.int32)
+    for k in reversed(range(passes - 1)):
+        spacing = 1 << (passes - 1 - k)
+        pass_ids[(iy % spacing == 0) & (ix % spacing == 0)] = k
+    return pass_ids
+
+
+def iter_svg(palette, width, height, placements):
+    """Yields an SVG document drawing placements (as built by create_math_face) in order.
+
+    Each symbol is a <text> element in its resolved font, positioned so its ink is centred
+    where the raster renderer composites it and rotated the same way.
+    """
+    yield (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+           f'viewBox="0 0 {width} {height}">\n')
+    families = {}
+    body = []
+    for sym, size, cx, cy, angle, b, alpha, _, _, _ in placements:
+        family, dx, dy = palette.text_origin(sym, size)
+        cls = families.setdefault(family, f'f{len(families)}')
+        transform = f' transform="rotate({-angle} {cx} {cy})"' if angle else ''
+        opacity = f' fill-opacity="{alpha / 255:.3g}"' if alpha != 255 else ''
+        body.append(f'<text class="{cls}" x="{cx + dx:g}" y="{cy + dy:g}" font-size="{size}" '
+                    f'fill="#{b:02x}{b:02x}{b:02x}"{opacity}{transform}>{escape(sym)}</text>\n')
+    yield '<style>' + ''.join(f".{cls}{{font-family:'{family}'}}" for family, cls in families.items()) + '</style>\n'
+    yield f'<rect width="{width}" height="{height}" fill="#000"/>\n'
+    for start in range(0, len(body), 4096):
+        yield ''.join(body[start:start + 4096])
+    yield '</svg>\n'
+
+
+# Script 3 code - INTEGRATED WITH YOUR PROVIDED LOGIC
+def create_math_face(palette='math', seed=None, output_format='png', log_compression=None, passes=1,
+                     on_preview=None, density=DEFAULT_DENSITY, max_symbols=None, region_dir=None, stats=None,
+                     encode_speed='balanced'):
+    """Draws the face from the region images and returns the path of the output file.
+
+    The raster output_formats ('png', 'webp', 'webp_lossless', 'jpeg') composite every symbol
+    onto a canvas, encoded with the options encode_speed picks ('fast', 'balanced' or 'small',
+    see ENCODE_OPTIONS); 'svg' writes the placements as vector text and skips rasterization
+    altogether. The placement log is written next to it, at the same time as the output, and
+    compressed with log_compression (None, 'gzip' or 'zstd').
+
+    density (1-100) and max_symbols set the per-region lattice steps, see lattice_steps.
+    region_dir overrides the folder of region images (and outputs), "Divided Regions".
+    A stats dict, if given, receives the symbol count ("symbols"), the canvas size ("width",
+    "height") and the seconds spent writing the output ("encode") and the placement log
+    ("placement_log").
+
+    With passes > 1 symbols are placed and composited coarse-to-fine (see lattice_pass) and
+    on_preview(pass_number, passes, image) gets an RGBA copy of the canvas after each pass
+    but the last. The lattice, and so the final density, is the same for any number of
+    passes; a given seed reproduces the layout for a given number of passes.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output_format {output_format!r}, use one of {list(OUTPUT_FORMATS)}')
+    if encode_speed not in ENCODE_SPEEDS:
+        raise ValueError(f'Unknown encode_speed {encode_speed!r}, use one of {list(ENCODE_SPEEDS)}')
+
+    # ---------------- Config ----------------
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    project_root = os.path.dirname(script_dir)  # Go up one level from face-parsing.PyTorch
+    base_path = region_dir or os.path.join(project_root, "Divided Regions")
+    region_indices = REGION_INDICES
+
+    # Symbols and style tables come from the palette registry (palettes/*.json, loaded once
+    # per process with every glyph already rasterized)
+    palette = get_palette(palette)
+
+    # Style params
+    jitter_cap_px = JITTER_CAP_PX
+    rot_range_deg = ROT_RANGE_DEG
+
+    # Local generator: a fixed seed reproduces the same layout
+    rng = random.Random(seed)
+
+    # ---------------- Pre-scan regions to set canvas ----------------
+    sizes = []
+    available_regions = []
+
+    for region_id in region_indices:
+        p = os.path.join(base_path, f"region_{region_id}.png")
+        if os.path.exists(p):
+            try:
+                with Image.open(p) as im:
+                    sizes.append(im.size)  # (w, h)
+                    available_regions.append(region_id)
+            except Exception:
+                pass
+
+    if not sizes:
+        logger.warning('Region images not found in %s', base_path)
+        return
+
+    # Determine the maximum width and height for the canvas
+    max_w = max(w for (w, h) in sizes)
+    max_h = max(h for (w, h) in sizes)
+
+    # Global canvas dimensions
+    global_width, global_height = max_w, max_h 
+
+    logger.debug('Canvas initialized: %dx%d', global_width, global_height)
+
+    # ---------------- Scan regions ----------------
+    # Region images are disjoint crops of one parse, so one map of which region owns each
+    # pixel (where it is bright enough to draw on) and one brightness map describe them all
+    owner = np.zeros((global_height, global_width), dtype=np.uint8)
+    brightness = np.zeros((global_height, global_width), dtype=np.uint8)
+    plans = []
+    for region_id in available_regions: # Iterate over regions that actually exist
+        region_path = os.path.join(base_path, f"region_{region_id}.png")
+        logger.debug('Processing region %d', region_id)
+
+        img_pil = Image.open(region_path).convert("RGB")
+        
+        # Get the specific dimensions for the current region's image
+        region_width, region_height = img_pil.size 
+
+        img = np.array(img_pil)
+        gray = img.mean(axis=2).astype(np.uint8)
+        mask = gray > 10 # Mask will have region_height, region_width
+        
+        # Pre-compute pixel count for region
+        pixel_count = np.sum(mask)
+        if pixel_count == 0:
+            logger.debug('Region %d: skipped (empty)', region_id)
+            continue
+
+        owner[:region_height, :region_width][mask] = region_id
+        brightness[:region_height, :region_width][mask] = gray[mask]
+
+        plans.append((region_id, region_width, region_height, int(pixel_count)))
+
+    def lattice_points(i, step):
+        region_id, region_width, region_height, _ = plans[i]
+        return int(np.count_nonzero(owner[:region_height:step, :region_width:step] == region_id))
+
+    steps = lattice_steps([(pixel_count, palette.step_table[region_id]) for region_id, _, _, pixel_count in plans],
+                          density, max_symbols, lattice_points)
+    plans = [(region_id, region_width, region_height, step)
+             for (region_id, region_width, region_height, _), step in zip(plans, steps)]
+
+    # INITIALIZE SYMBOL LOG: (symbol, size, center x, center y, angle, brightness, alpha,
+    # region id, drawn width, drawn height) in drawing order
+    placements = []
+    placed_per_region = {region_id: 0 for region_id, *_ in plans}
+    if output_format != 'svg':
+        canvas = Image.new('RGBA', (global_width, global_height), (0, 0, 0, 255))
+
+    # ---------------- Render ----------------
+    # Pass by pass (coarse lattice first), region by region
+    for k in range(passes):
+        pass_start = len(placements)
+        for region_id, region_width, region_height, adaptive_step in plans:
+            symbols = palette.symbols_for(region_id)
+            alpha_val = int(palette.opacity_table[region_id])
+
+            # This pass's lattice points inside the region, in raster order, with their
+            # gamma-corrected brightness and font size looked up for all of them at once
+            gy, gx = np.mgrid[0:region_height:adaptive_step, 0:region_width:adaptive_step]
+            inside = owner[gy, gx] == region_id
+            if passes > 1:
+                inside &= lattice_pass(gy // adaptive_step, gx // adaptive_step, passes) == k
+            ys, xs = gy[inside], gx[inside]
+            bs = GAMMA_LUT[brightness[ys, xs]]
+            sizes = palette.size_luts[region_id][bs]
+
+            for y, x, b, final_size in zip(ys.tolist(), xs.tolist(), bs.tolist(), sizes.tolist()):
+                sym = rng.choice(symbols)
+                
+                angle = rng.randint(-rot_range_deg, rot_range_deg)
+
+                glyph = palette.glyph_mask(sym, final_size, angle)
+                if glyph is None:
+                    continue
+                hy, wx = glyph.shape # Size of rotated text image
+
+                jitter_x = rng.randint(-jitter_cap_px, jitter_cap_px)
+                jitter_y = rng.randint(-jitter_cap_px, jitter_cap_px)
+                
+                # Proposed center for the symbol
+                ox, oy = x + jitter_x, y + jitter_y
+
+                placed = False
+                final_draw_x, final_draw_y = 0, 0 # Coords where symbol is actually drawn
+
+                # YOUR PROVIDED LOGIC FOR PLACEMENT:
+                # Attempt to place with jitter, checking against global canvas bounds AND region mask
+                if (ox - wx//2 >= 0 and oy - hy//2 >= 0 and
+                    ox + wx//2 < global_width and oy + hy//2 < global_height):
+                    
+                    # Ensure the central point (ox,oy) for mask check is within the *current region's* bounds
+                    if (0 <= oy < region_height and 0 <= ox < region_width and owner[oy, ox] == region_id):
+                        placed = True
+                        final_draw_x, final_draw_y = ox - wx//2, oy - hy//2
+                
+                # Fallback: try center of cell (x,y) if jittered pos failed, checking against global canvas bounds
+                if not placed:
+                    # Check if the symbol's full bounding box fits within the GLOBAL canvas
+                    if (x - wx//2 >= 0 and y - hy//2 >= 0 and
+                        x + wx//2 < global_width and y + hy//2 < global_height):
+                        
+                        placed = True
+                        final_draw_x, final_draw_y = x - wx//2, y - hy//2
+
+                # CRITICAL: LOG EVERY SYMBOL PLACEMENT DETAIL IF IT WAS PLACED
+                if placed:
+                    placed_per_region[region_id] += 1
+                    placements.append((sym, final_size, final_draw_x + wx//2, final_draw_y + hy//2, angle,
+                                       b, alpha_val, region_id, wx, hy))
+
+        if output_format != 'svg':
+            for sym, size, cx, cy, angle, b, alpha_val, _, wx, hy in placements[pass_start:]:
+                txt = glyph_image(palette.glyph_mask(sym, size, angle), b, alpha_val)
+                canvas.alpha_composite(txt, (cx - wx//2, cy - hy//2))
+            if on_preview is not None and k < passes - 1:
+                on_preview(k + 1, passes, canvas.copy())
+
+    for region_id, count in placed_per_region.items():
+        logger.debug('Region %d: %d symbols placed', region_id, count)
+
+    # Save the final image
+    output_path = os.path.join(base_path, f"gift_worthy_mathematical_face.{output_extension(output_format)}")
+
+    def write_output():
+        start = time.perf_counter()
+        if output_format == 'svg':
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.writelines(iter_svg(palette, global_width, global_height, placements))
+        else:
+            encode_canvas(canvas, output_path, output_format, encode_speed)
+        return time.perf_counter() - start
+
+    # The image encoders and zlib/zstd release the GIL, so the output is encoded in a worker
+    # thread while the placement log is written
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        output_job = pool.submit(write_output)
+
+        # SAVE THE SYMBOL PLACEMENT LOG - ANIMATION GOLD! (columnar binary, see placement_log.py)
+        start = time.perf_counter()
+        log_path = write_log(os.path.join(base_path, "symbol_placements.mfpl"), placements,
+                             global_width, global_height, compression=log_compression)
+        log_seconds = time.perf_counter() - start
+        encode_seconds = output_job.result()
+    if stats is not None:
+        stats.update(symbols=len(placements), width=global_width, height=global_height,
+                     encode=encode_seconds, placement_log=log_seconds)
+
+    logger.debug('Mathematical face saved to %s, %d symbols; placement log: %s', output_path, len(placements),
+                 log_path)
+    return output_path
+
+
+def render_regions(orig, parsing, region_dir, **options):
+    """extract_regions then create_math_face (with options) in region_dir; returns (output path, stats).
+
+    One picklable call per face, for the render process pool of the batch endpoint. orig and
+    parsing are paths or ArrayRefs to shared memory (shared_arrays.py), read in place.
+    """
+    with Attached() as shared:
+        def load(source):
+            return shared.array(source) if isinstance(source, ArrayRef) else source
+
+        extract_regions(load(orig), load(parsing), region_dir)
+    stats = {}
+    output_path = create_math_face(region_dir=region_dir, stats=stats, **options)
+    return output_path, stats
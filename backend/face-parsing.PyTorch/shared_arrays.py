@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Zero-copy handoff of image arrays to other processes (the batch render pool in server.py).
+# The sender copies an array into a multiprocessing.shared_memory segment once and sends an
+# ArrayRef - the segment's name, the array's shape and dtype - in place of the pixels; the
+# receiver maps the segment and reads the array in place (Attached). A BufferPool recycles the
+# segments, so a batch doesn't create and unlink one per image. The sender owns the segments:
+# it must not release an ArrayRef before the receiver is done with it.
+
+import sys
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+ArrayRef = namedtuple('ArrayRef', ['name', 'shape', 'dtype'])
+
+# Segment sizes are rounded up to this, so images of similar sizes reuse each other's segments
+SEGMENT_ALIGN = 1 << 20
+
+
+def _destroy(segment):
+    segment.close()
+    segment.unlink()
+
+
+class BufferPool(object):
+    """Shared memory segments for ArrayRefs, recycled.
+
+    put() copies an array into the smallest free segment that holds it (or a new one) and
+    release() hands the segment back; up to max_free_bytes of free segments are kept for
+    reuse, the oldest unlinked beyond that. close() unlinks them all. Thread-safe.
+    """
+
+    def __init__(self, max_free_bytes=256 << 20):
+        self.max_free_bytes = max_free_bytes
+        self.lock = threading.Lock()
+        self.free = []
+        self.used = {}
+
+    def put(self, array):
+        array = np.ascontiguousarray(array)
+        with self.lock:
+            fits = [segment for segment in self.free if segment.size >= array.nbytes]
+            if fits:
+                segment = min(fits, key=lambda s: s.size)
+                self.free.remove(segment)
+            else:
+                size = max(1, -(-array.nbytes // SEGMENT_ALIGN)) * SEGMENT_ALIGN
+                segment = shared_memory.SharedMemory(create=True, size=size)
+            self.used[segment.name] = segment
+        np.ndarray(array.shape, array.dtype, buffer=segment.buf)[...] = array
+        return ArrayRef(segment.name, array.shape, array.dtype.str)
+
+    def release(self, ref):
+        with self.lock:
+            self.free.append(self.used.pop(ref.name))
+            while sum(segment.size for segment in self.free) > self.max_free_bytes:
+                _destroy(self.free.pop(0))
+
+    def close(self):
+        with self.lock:
+            for segment in self.free + list(self.used.values()):
+                _destroy(segment)
+            self.free, self.used = [], {}
+
+
+class Attached(object):
+    """Maps ArrayRefs in the receiving process for a with block.
+
+    array(ref) is a read-only view of the sender's array, valid until the end of the block,
+    when the segments are closed; don't keep a view (or anything sharing its memory) past it.
+    """
+
+    def __enter__(self):
+        self.segments = []
+        return self
+
+    def array(self, ref):
+        if sys.version_info >= (3, 13):
+            # The sender unlinks the segment; the receiver stays out of the resource tracker
+            segment = shared_memory.SharedMemory(name=ref.name, track=False)
+        else:
+            segment = shared_memory.SharedMemory(name=ref.name)
+        self.segments.append(segment)
+        view = np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=segment.buf)
+        view.flags.writeable = False
+        return view
+
+    def __exit__(self, exc_type, exc, tb):
+        for segment in self.segments:
+            try:
+                segment.close()
+            except BufferError:
+                # Still viewed, e.g. from the traceback of an error; unmapped once collected
+                pass
+        self.segments = []
@@ -1,23 +1,19 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
-from logger import setup_logger
-from model import BiSeNet
-import torch
+from renderer import extract_regions, create_math_face
 import os
 import os.path as osp
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-import torchvision.transforms as transforms
-import cv2
-import random
-import json
 import io
+import logging
 import sys
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None 
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 def vis_parsing_maps(im, parsing_anno, stride, save_im=False, save_path='vis_results/parsing_map_on_im.jpg'):
+    # Imported here so runs that don't parse (--skip-parse) don't load OpenCV
+    import cv2
+
     # Colors for all 20 parts
     part_colors = [[255, 0, 0], [255, 85, 0], [255, 170, 0],
                    [255, 0, 85], [255, 0, 170],
@@ -50,405 +46,43 @@ def vis_parsing_maps(im, parsing_anno, stride, save_im=False, save_path='vis_res
         # Visualization overlay
         cv2.imwrite(save_path, vis_im, [int(cv2.IMWRITE_JPEG_QUALITY), 100])  # Only saves *visualization* overlay
 
-def evaluate(respth='./res/test_res', dspth='./data', cp='model_final_diss.pth'):
+def evaluate(respth='./res/test_res', dspth='./data', cp='model_final_diss.pth', batch_size=8, num_workers=2,
+             upsample='logits', letterbox=True, tile=0):
     if not os.path.exists(respth):
         os.makedirs(respth)
 
-    n_classes = 19
-    net = BiSeNet(n_classes=n_classes)
-
-    # Check if CUDA is available, otherwise use CPU
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    net.to(device)
-
-    save_pth = osp.join('res/cp', cp)
-    net.load_state_dict(torch.load(save_pth, map_location=device))
-    net.eval()
-
-    to_tensor = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-    ])
-
-    with torch.no_grad():
-        # Handle both file path and directory path
-        if os.path.isfile(dspth):
-            # Single file passed
-            image_paths = [os.path.basename(dspth)]
-            dspth = os.path.dirname(dspth)
-        else:
-            # Directory passed
-            image_paths = os.listdir(dspth)
-        
-        for image_path in image_paths:
-            img = Image.open(osp.join(dspth, image_path)).convert('RGB')
-            image = img.resize((512, 512), Image.BILINEAR)
-            img_tensor = to_tensor(image)
-            img_tensor = torch.unsqueeze(img_tensor, 0)
-            img_tensor = img_tensor.to(device)
-            out = net(img_tensor)[0]
-            parsing = out.squeeze(0).cpu().numpy().argmax(0)  # 2D array: class indices
-
-            # --- The KEY: Save the raw label map as PNG using PIL only ---
-            label_save_path = osp.join(respth, image_path[:-4] + '_label.png')
-            Image.fromarray(parsing.astype(np.uint8)).save(label_save_path)
-            print(f"Saved raw label map: {label_save_path}")
-
-            # Save colored visualization overlay (optional)
-            vis_save_path = osp.join(respth, image_path[:-4] + '_overlay.jpg')
-            vis_parsing_maps(image, parsing, stride=1, save_im=True, save_path=vis_save_path)
-
-# Script 2 code
-def extract_regions():
-    # Paths - Using relative paths from the script location
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.dirname(script_dir)  # Go up one level from face-parsing.PyTorch
-    
-    orig_path = os.path.join(project_root, "test_img", "test.jpg")
-    parsing_path = os.path.join(script_dir, "res", "test_res", "test_label.png")
-    output_dir = os.path.join(project_root, "Divided Regions")
-
-    # Clear the output directory to avoid conflicts with old region files
-    if os.path.exists(output_dir):
-        import shutil
-        shutil.rmtree(output_dir)
-        print(f"🧹 Cleared old region files from: {output_dir}")
-    
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Load images
-    orig = np.array(Image.open(orig_path).convert('RGB'))
-    parsing = np.array(Image.open(parsing_path))
-
-    # Optionally, print present region indices
-    unique_indices = np.unique(parsing)
-    print('Present region indices:', unique_indices)
-
-    for idx in unique_indices:
-        # Skip background if you wish
-        if idx == 0:
-            continue
-
-        mask = (parsing == idx).astype(np.uint8)
-
-        # Resize mask to match original image if needed (using cv2 for speed):
-        if mask.shape[:2] != orig.shape[:2]:
-            mask = cv2.resize(mask, (orig.shape[1], orig.shape[0]), interpolation=cv2.INTER_NEAREST)
-
-        # Multiply to get only that region in color
-        part_image = orig * mask[:, :, None]
-
-        # Save with clear index
-        filename = f"region_{idx}.png"
-        Image.fromarray(part_image).save(os.path.join(output_dir, filename))
-        print(f"Saved {filename}")
-
-    print("Done! All segmented region images saved in:", output_dir)
-
-# Script 3 code - INTEGRATED WITH YOUR PROVIDED LOGIC
-def create_math_face(palette='math'):
-    # ---------------- Config ----------------
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.dirname(script_dir)  # Go up one level from face-parsing.PyTorch
-    base_path = os.path.join(project_root, "Divided Regions")
-    region_indices = [i for i in range(1, 18)]
-
-    # Region-specific math symbol sets
-    region_symbols_map = {
-    1:  ['∂', '∑', '√', '≈', '∇', '∞'],        # Face (skin)
-    2:  ['—', '−', '≡', '―', '∼'],             # Eyebrow L  n
-    3:  ['—', '−', '≡', '―', '∼'],             # Eyebrow R  n
-    4:  ['●', '◉', '◎', '○', '◍'],             # Eye L     y
-    5:  ['●', '◉', '◎', '○', '◍'],             # Eye R     y
-    6:  ['▭', '▬', '═', '≡', '≣'],             # Eyeglasses n
-    7:  ['∫', '∮', 'Ω', 'σ', 'θ'],             # Ear L       y
-    8:  ['∫', '∮', 'Ω', 'σ', 'θ'],             # Ear R       y
-    9:  ['⇔', '⇒', '⟹', '→', '↠'],             # Nose Glasses Bridge n
-    10: ['|', '‖', '∣', '∥', '+'],             # Nose     y
-    11: ['⧉', '◧', '◨', '▣', '⊞'],             # Mouth Interior / Teeth y
-    12: ['⌒', '∩', '∪', '⌓', '∿'],            # Lower lip n
-    13: ['⌒', '∩', '∪', '⌓', '∿'],            # Upper lip n
-    14: ['∏', 'Π', 'µ', 'ω', 'φ'],             # Neck y
-    15: ['☼', '✶', '✷', '✸', '✹'],            # Hat / Head accessory n
-    16: ['Σ', 'π', '∑', 'λ', 'Ψ', 'Ω'],        # Hair n
-    17: ['Σ', 'π', '∑', 'λ', 'Ψ', 'Ω']         # Hair (alt / background overlap) n
-}
-    
-    # ASCII charset - only classical ASCII characters (no math symbols)
-    region_symbols_ascii = {
-    1:  ['@', '%', '#', '*', '&'],              # Face (skin)
-    2:  ['-', '=', '_', '~', '-'],              # Eyebrow L
-    3:  ['-', '=', '_', '~', '-'],              # Eyebrow R
-    4:  ['0', 'o', 'O', '8', 'Q'],              # Eye L
-    5:  ['0', 'o', 'O', '8', 'Q'],              # Eye R
-    6:  ['[', ']', '|', '||', '[]'],            # Eyeglasses
-    7:  ['(', ')', 'C', 'c', '3'],              # Ear L
-    8:  ['(', ')', 'C', 'c', '3'],              # Ear R
-    9:  ['-', '=', '|', '+', 'x'],              # Nose Glasses Bridge
-    10: ['|', '||', '+', 'l', 'I'],             # Nose
-    11: ['n', 'u', 'm', 'w', 'V'],              # Mouth Interior / Teeth
-    12: ['^', 'v', 'n', 'u', '_'],              # Lower lip
-    13: ['^', 'v', 'n', 'u', '_'],              # Upper lip
-    14: ['I', 'l', '|', '1', 'L'],              # Neck
-    15: ['*', '+', 'T', 't', '?'],              # Hat / Head accessory
-    16: ['W', 'w', 'M', 'm', '~'],              # Hair
-    17: ['W', 'w', 'M', 'm', '~']               # Hair (alt / background overlap)
-}
-
-    # Select the appropriate symbol map based on palette
-    if palette.lower() == 'ascii':
-        region_symbols_map = region_symbols_ascii
-
-    region_opacity_map = {
-        4: 170, 5: 170,                   # Eyes - full opacity (100%)
-        12: 170, 13: 170,                  # Lips - full opacity (100%)
-        2: int(255 * 0.85), 3: int(255 * 0.85),  # Eyebrows - 85% opacity
-        10: int(255 * 0.90),                  # Nose - 90% opacity
-        1: int(255 * 0.60),                   # Face - 60% opacity (background texture)
-        7: int(255 * 0.75), 8: int(255 * 0.75),  # Ears - 75% opacity
-        14: int(255 * 0.70),                  # Neck - 70% opacity
-        16: int(255 * 0.80), 17: int(255 * 0.80), # Hair - 80% opacity
-    }
-
-    # Region importance factor (kept for sizing)
-    region_importance_map = {
-        1: 1.0,  2: 1.1, 3: 1.1,
-        4: 1.3, 5: 1.3,
-        7: 1.0, 8: 1.0,
-        10: 1.0,
-        12: 1.2, 13: 1.2,
-        14: 1.0,
-        16: 0.9, 17: 0.9
-    }
+    # Imported here so --skip-parse runs don't load torch
+    from parsing import load_parser, iter_parse_dir, iter_parse_letterboxed
 
-    # Base font size and step
-    region_style_map = {
-        1: (12, 10), 2: (9, 6), 3: (9, 6), 4: (9, 5), 5: (9, 5),
-        7: (9, 7), 8: (9, 7), 10: (10, 8), 12: (8, 5),
-        13: (8, 5), 14: (10, 8), 16: (8, 7), 17: (8, 7)
-    }
+    # Uses CUDA when available, otherwise CPU; BatchNorm folded for inference
+    net = load_parser(cp)
 
-    # Style params
-    jitter_cap_px = 2
-    rot_range_deg = 8
-    gamma = 0.75
+    # Handles both a single file and a directory. letterbox keeps each image's aspect ratio and
+    # writes label maps at its full size; otherwise images are squashed to 512x512, decoded by
+    # a prefetching DataLoader and parsed batch_size at a time. tile > 0 parses at native
+    # resolution in overlapping tiles
+    if letterbox or tile:
+        results = iter_parse_letterboxed(net, dspth, upsample=upsample, tile=tile)
+    else:
+        results = iter_parse_dir(net, dspth, batch_size=batch_size, num_workers=num_workers, upsample=upsample)
+    for image_path, image, parsing in results:
+        name = osp.splitext(image_path)[0]
 
-    def safe_gamma(bright):
-        b = np.clip(bright / 255.0, 0, 1)
-        g = b ** gamma
-        return int(np.clip(g * 255, 0, 255))
+        # --- The KEY: Save the raw label map as PNG using PIL only ---
+        label_save_path = osp.join(respth, name + '_label.png')
+        Image.fromarray(parsing).save(label_save_path)
+        print(f"Saved raw label map: {label_save_path}")
 
-    def size_mapping(base, brightness, region_importance=1.0):
-        brightness_norm = brightness / 255.0
-        size_factor = 0.9 + 0.5 * (1 - brightness_norm)
-        min_size = max(9, int(base * 0.85))
-        size_factor *= region_importance
-        return max(min_size, int(base * size_factor))
-
-    # FONT CACHE - avoid repeated font loading (major speedup!)
-    font_cache = {}
-    font_paths = [
-        "/usr/share/fonts/truetype/dejavu/DejaVuMathTeXGyre.ttf",  # Math symbols
-        "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",     # Fallback
-        "cour.ttf", 
-        "arial.ttf"
-    ]
-    default_font = None
-    for font_path in font_paths:
-        try:
-            default_font = ImageFont.truetype(font_path, 12)
-            break
-        except (IOError, OSError):
-            continue
-    if default_font is None:
-        default_font = ImageFont.load_default()
-    
-    def load_font(size):
-        # Check cache first (huge speedup!)
-        if size in font_cache:
-            return font_cache[size]
-        
-        # Try to load font at desired size
-        for font_path in font_paths:
-            try:
-                font = ImageFont.truetype(font_path, size)
-                font_cache[size] = font
-                return font
-            except (IOError, OSError):
-                continue
-        
-        # Fallback to default
-        font_cache[size] = default_font
-        return default_font
-
-    # ---------------- Pre-scan regions to set canvas ----------------
-    sizes = []
-    available_regions = []
-
-    for region_id in region_indices:
-        p = os.path.join(base_path, f"region_{region_id}.png")
-        if os.path.exists(p):
-            try:
-                with Image.open(p) as im:
-                    sizes.append(im.size)  # (w, h)
-                    available_regions.append(region_id)
-            except Exception:
-                pass
-
-    if not sizes:
-        print("❌ Region images not found in base_path:", base_path)
-        return
-
-    # Determine the maximum width and height for the canvas
-    max_w = max(w for (w, h) in sizes)
-    max_h = max(h for (w, h) in sizes)
-
-    # Global canvas dimensions
-    global_width, global_height = max_w, max_h 
-    canvas = Image.new('RGBA', (global_width, global_height), (0, 0, 0, 255))
-
-    print(f" Canvas initialized: {global_width}x{global_height}")
-    print(" Creating gift-worthy mathematical face...")
-
-    # INITIALIZE SYMBOL LOG
-    symbol_log = []
-    total_symbols = 0
-
-    # ---------------- Render ----------------
-    for region_id in available_regions: # Iterate over regions that actually exist
-        region_path = os.path.join(base_path, f"region_{region_id}.png")
-        print(f"Processing region {region_id}...")
-
-        img_pil = Image.open(region_path).convert("RGB")
-        
-        # Get the specific dimensions for the current region's image
-        region_width, region_height = img_pil.size 
-
-        img = np.array(img_pil)
-        gray = img.mean(axis=2).astype(np.uint8)
-        mask = (gray > 10).astype(np.uint8) # Mask will have region_height, region_width
-        
-        # Pre-compute pixel count for region
-        pixel_count = np.sum(mask)
-        if pixel_count == 0:
-            print(f"Region {region_id}: skipped (empty)")
-            continue
-
-        base_font, step = region_style_map.get(region_id, (9, 6))
-        region_importance = region_importance_map.get(region_id, 1.0)
-        symbols = region_symbols_map.get(region_id, ['·']) # Added a fallback symbol
-        
-        # Dynamic step sizing: larger step for smaller regions (speedup!)
-        adaptive_step = step
-        if pixel_count < 5000:
-            adaptive_step = max(step, int(step * 1.5))
-        elif pixel_count < 2000:
-            adaptive_step = max(step, int(step * 2.0))
-
-        symbols_placed_in_region = 0 
-
-        # Iterate using the current region's dimensions (region_height, region_width)
-        for y in range(0, region_height, adaptive_step):
-            for x in range(0, region_width, adaptive_step):
-                # Ensure x and y are within the mask's bounds before accessing.
-                if not (0 <= y < region_height and 0 <= x < region_width):
-                    continue
-                
-                if mask[y, x] != 1:
-                    continue
-
-                raw_b = int(img[y, x].mean())
-                b = safe_gamma(raw_b)
-                
-                sym = random.choice(symbols)
-                final_size = size_mapping(base_font, b, region_importance)
-                font = load_font(final_size)
-                
-                angle = random.randint(-rot_range_deg, rot_range_deg)
-                bbox = font.getbbox(sym)
-                wtxt, htxt = bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-                if wtxt <= 0 or htxt <= 0:
-                    continue
-
-                txt = Image.new("RGBA", (wtxt, htxt), (0, 0, 0, 0))
-                d = ImageDraw.Draw(txt)
-                
-                alpha_val = region_opacity_map.get(region_id, 255)
-                color = (b, b, b, alpha_val)
-                
-                d.text((-bbox[0], -bbox[1]), sym, font=font, fill=color)
-                txt = txt.rotate(angle, expand=1)
-                wx, hy = txt.size # Size of rotated text image
-
-                jitter_x = random.randint(-jitter_cap_px, jitter_cap_px)
-                jitter_y = random.randint(-jitter_cap_px, jitter_cap_px)
-                
-                # Proposed center for the symbol
-                ox, oy = x + jitter_x, y + jitter_y
-
-                placed = False
-                final_draw_x, final_draw_y = 0, 0 # Coords where symbol is actually drawn
-
-                # YOUR PROVIDED LOGIC FOR PLACEMENT:
-                # Attempt to place with jitter, checking against global canvas bounds AND region mask
-                if (ox - wx//2 >= 0 and oy - hy//2 >= 0 and
-                    ox + wx//2 < global_width and oy + hy//2 < global_height):
-                    
-                    # Ensure the central point (ox,oy) for mask check is within the *current region's* bounds
-                    if (0 <= oy < region_height and 0 <= ox < region_width and mask[oy, ox] == 1):
-                        canvas.alpha_composite(txt, (ox - wx//2, oy - hy//2))
-                        symbols_placed_in_region += 1
-                        placed = True
-                        final_draw_x, final_draw_y = ox - wx//2, oy - hy//2
-                
-                # Fallback: try center of cell (x,y) if jittered pos failed, checking against global canvas bounds AND region mask
-                if not placed and (0 <= y < region_height and 0 <= x < region_width and mask[y, x] == 1):
-                    # Check if the symbol's full bounding box fits within the GLOBAL canvas
-                    if (x - wx//2 >= 0 and y - hy//2 >= 0 and
-                        x + wx//2 < global_width and y + hy//2 < global_height):
-                        
-                        canvas.alpha_composite(txt, (x - wx//2, y - hy//2))
-                        symbols_placed_in_region += 1
-                        placed = True
-                        final_draw_x, final_draw_y = x - wx//2, y - hy//2
-
-                # CRITICAL: LOG EVERY SYMBOL PLACEMENT DETAIL IF IT WAS PLACED
-                if placed:
-                    total_symbols += 1
-                    symbol_info = {
-                        "symbol": sym,
-                        "font_size": final_size,
-                        "position_center_of_text": [final_draw_x + wx//2, final_draw_y + hy//2], 
-                        "position_top_left_of_text": [final_draw_x, final_draw_y], 
-                        "rotation": angle,
-                        "color": color,
-                        "region_id": region_id,
-                        "order": total_symbols,
-                        "text_drawn_size": [wx, hy],  
-                        "brightness": b,
-                        "alpha": alpha_val,
-                        "timestamp": total_symbols 
-                    }
-                    symbol_log.append(symbol_info)
-
-        print(f"Region {region_id}: {symbols_placed_in_region} symbols placed")
-
-    # Save the final image
-    output_path = os.path.join(base_path, "gift_worthy_mathematical_face.png")
-    canvas.save(output_path)
-
-    # SAVE THE SYMBOL PLACEMENT LOG - ANIMATION GOLD!
-    log_path = os.path.join(base_path, "symbol_placements.json")
-    with open(log_path, "w") as f:
-        json.dump(symbol_log, f, indent=2)
-
-    print(f"\n🎁 Gift-worthy mathematical face completed!")
-    print(f"📁 Saved to: {output_path}")
-    print(f"📁 Symbol placement details saved to: {log_path}")
-    print(f"🎯 Total symbols logged for animation: {len(symbol_log)}")
+        # Save colored visualization overlay (optional)
+        vis_save_path = osp.join(respth, name + '_overlay.jpg')
+        vis_parsing_maps(image, parsing, stride=1, save_im=True, save_path=vis_save_path)
 
 if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    # The renderer's progress, which it logs at debug level
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('renderer').setLevel(logging.DEBUG)
+
     # Ensure the logger is set up if needed by the BiSeNet model
     # setup_logger takes an argument for log directory, adjust if needed
     # For a quick run, you might comment this out if it's causing issues
@@ -459,10 +93,20 @@ if __name__ == "__main__":
     project_root = os.path.dirname(script_dir)
     
     # Accept image path from command line, default to test_img if not provided
-    # Format: python test.py <image_path> [quality] [palette]
+    # Format: python test.py <image_path> [quality] [palette] [output_format] [density] [max_symbols] [encode_speed] [--skip-parse]
+    # --skip-parse re-renders from the label map an earlier run left in res/test_res/test_label.png
+    # (e.g. to try other palettes or densities). server.py only runs this script, without the
+    # flag, when BiSeNet could not be loaded in-process
+    skip_parse = "--skip-parse" in sys.argv
+    if skip_parse:
+        sys.argv.remove("--skip-parse")
     test_img_path = os.path.join(project_root, "test_img")
     quality = "low"
     palette = "math"
+    output_format = "png"
+    density = 50
+    max_symbols = None
+    encode_speed = "balanced"
     
     if len(sys.argv) > 1:
         test_img_path = sys.argv[1]
@@ -470,16 +114,27 @@ if __name__ == "__main__":
         quality = sys.argv[2].lower()
     if len(sys.argv) > 3:
         palette = sys.argv[3].lower()
+    if len(sys.argv) > 4:
+        output_format = sys.argv[4].lower()
+    if len(sys.argv) > 5:
+        density = int(sys.argv[5])
+    if len(sys.argv) > 6:
+        max_symbols = int(sys.argv[6])
+    if len(sys.argv) > 7:
+        encode_speed = sys.argv[7].lower()
     
-    print(f"DEBUG: test.py called with quality={quality}, palette={palette}")
+    print(f"DEBUG: test.py called with quality={quality}, palette={palette}, density={density}")
     
-    evaluate(
-        dspth=test_img_path,
-        cp='79999_iter.pth'
-    )
+    if not skip_parse:
+        evaluate(
+            dspth=test_img_path,
+            cp='79999_iter.pth'
+        )
 
     # Run script 2
     extract_regions()
 
     # Run script 3 - Pass palette to create_math_face
-    create_math_face(palette=palette)
\ No newline at end of file
+    create_math_face(palette=palette, output_format=output_format,
+                     log_compression=os.getenv("PLACEMENT_LOG_COMPRESSION") or None,
+                     density=density, max_symbols=max_symbols, encode_speed=encode_speed)
\ No newline at end of file
@@ -0,0 +1,306 @@
+"""
+Job queue between the API process (server.py) and pipeline workers (worker.py), so the pipeline
+can run in several processes, on one box or several.
+
+A job carries its options and an estimated cost; its upload and its results live in its folder
+under JOBS_DIR, which the API and the workers share. Workers claim jobs the way scheduler.py
+picks them (lowest cost minus time waited, within per-tier concurrency limits) and publish
+progress events ("stage", "stage_done", "preview") the API relays to the client.
+
+Backends, picked by open_queue(url):
+  memory://               MemoryQueue: within one process (worker threads), for tests and one-box setups
+  sqlite:///path/jobs.db  SQLiteQueue: any number of API and worker processes sharing the database file
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from scheduler import QueueFull
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+# A running job whose worker hasn't renewed it (renew(), every JOB_HEARTBEAT_SECONDS while it
+# runs) within JOB_LEASE_SECONDS is failed, so a crashed worker can't leave its client waiting
+# forever, however long the job itself takes
+JOB_LEASE_SECONDS = 300
+JOB_HEARTBEAT_SECONDS = 30
+# Workers that claimed (or polled for) a job within this many seconds count as active
+WORKER_ACTIVE_SECONDS = 30
+
+
+class Job:
+    __slots__ = ("id", "quality", "cost", "params", "status", "submitted", "started", "result", "error", "renewed")
+
+    def __init__(self, id, quality, cost, params, status=PENDING, submitted=None, started=None, result=None,
+                 error=None, renewed=None):
+        self.id = id
+        self.quality = quality
+        self.cost = cost
+        self.params = params
+        self.status = status
+        self.submitted = submitted if submitted is not None else time.time()
+        self.started = started
+        self.result = result
+        self.error = error
+        self.renewed = renewed if renewed is not None else started
+
+
+def retry_after(pending_costs, running, workers, now):
+    """Seconds until the queued and running work should be done by the active workers, at least 1."""
+    backlog = sum(pending_costs) + sum(max(0.0, cost - (now - started)) for cost, started in running)
+    return max(1, math.ceil(backlog / max(1, workers)))
+
+
+class MemoryQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.events = {}
+        self.workers = {}
+
+    def submit(self, job_id, quality, cost, params, limit):
+        """Queues a job, or raises QueueFull when limit jobs of its tier are already waiting."""
+        with self.lock:
+            pending = [j for j in self.jobs.values() if j.status == PENDING]
+            if sum(1 for j in pending if j.quality == quality) >= limit:
+                now = time.time()
+                running = [(j.cost, j.started) for j in self.jobs.values() if j.status == RUNNING]
+                raise QueueFull(quality, retry_after([j.cost for j in pending], running, self._active(now), now))
+            self.jobs[job_id] = Job(job_id, quality, cost, params)
+            self.events[job_id] = []
+
+    def _active(self, now):
+        return sum(1 for seen in self.workers.values() if seen > now - WORKER_ACTIVE_SECONDS)
+
+    def claim(self, worker_id, concurrency):
+        """Marks the next job to run as running and returns it, or None if there is none."""
+        with self.lock:
+            now = time.time()
+            self.workers[worker_id] = now
+            for job in self.jobs.values():
+                if job.status == RUNNING and job.renewed < now - JOB_LEASE_SECONDS:
+                    job.status, job.error = FAILED, {"status": 500, "detail": "The worker running the job was lost"}
+            busy = {}
+            for job in self.jobs.values():
+                if job.status == RUNNING:
+                    busy[job.quality] = busy.get(job.quality, 0) + 1
+            candidates = [j for j in self.jobs.values()
+                          if j.status == PENDING and busy.get(j.quality, 0) < concurrency[j.quality]]
+            if not candidates:
+                return None
+            job = min(candidates, key=lambda j: j.cost + j.submitted)
+            job.status, job.started, job.renewed = RUNNING, now, now
+            return job
+
+    def renew(self, job_id):
+        """Extends the lease of a running job by JOB_LEASE_SECONDS from now."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status == RUNNING:
+                job.renewed = time.time()
+
+    def publish(self, job_id, event, payload):
+        # A job deleted while it runs (its client went away) takes no more events or results
+        with self.lock:
+            if job_id in self.events:
+                self.events[job_id].append((event, payload))
+
+    def read_events(self, job_id, after=0):
+        """[(seq, event, payload)] published after seq `after`."""
+        with self.lock:
+            events = self.events.get(job_id, [])
+            return [(seq, event, payload) for seq, (event, payload) in enumerate(events[after:], after + 1)]
+
+    def finish(self, job_id, result):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.status, job.result = DONE, result
+
+    def fail(self, job_id, status, detail):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.status, job.error = FAILED, {"status": status, "detail": detail}
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def delete(self, job_id):
+        """Drops the job and its events; returns its status (None if it was gone) - a RUNNING job's
+        worker still has its folder."""
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            self.events.pop(job_id, None)
+            return job.status if job is not None else None
+
+    def stats(self):
+        """{quality: {"pending", "running", "pending_cost"}} of the jobs not finished."""
+        stats = {}
+        with self.lock:
+            for job in self.jobs.values():
+                if job.status in (PENDING, RUNNING):
+                    tier = stats.setdefault(job.quality, {"pending": 0, "running": 0, "pending_cost": 0.0})
+                    tier[job.status] += 1
+                    if job.status == PENDING:
+                        tier["pending_cost"] += job.cost
+        return stats
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, quality TEXT NOT NULL, cost REAL NOT NULL, params TEXT NOT NULL,
+    status TEXT NOT NULL, submitted REAL NOT NULL, started REAL, result TEXT, error TEXT, renewed REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS events (
+    job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, payload TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, seen REAL NOT NULL);
+"""
+
+
+class SQLiteQueue:
+    """The queue in an SQLite database (WAL mode); every process and thread uses its own connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.executescript(SCHEMA)
+        if "renewed" not in [column[1] for column in db.execute("PRAGMA table_info(jobs)")]:
+            # A database created before leases were renewed
+            db.execute("ALTER TABLE jobs ADD COLUMN renewed REAL")
+
+    def connection(self):
+        # A connection must not cross fork() or threads
+        if getattr(self.local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db, self.local.pid = db, os.getpid()
+        return self.local.db
+
+    def connect(self):
+        return Transaction(self.connection())
+
+    def _job(self, row):
+        if row is None:
+            return None
+        id, quality, cost, params, status, submitted, started, result, error, renewed = row
+        return Job(id, quality, cost, json.loads(params), status, submitted, started,
+                   json.loads(result) if result else None, json.loads(error) if error else None, renewed)
+
+    def submit(self, job_id, quality, cost, params, limit):
+        with self.connect() as db:
+            waiting = db.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND quality = ?",
+                                 (PENDING, quality)).fetchone()[0]
+            if waiting >= limit:
+                now = time.time()
+                pending = [c for c, in db.execute("SELECT cost FROM jobs WHERE status = ?", (PENDING,))]
+                running = db.execute("SELECT cost, started FROM jobs WHERE status = ?", (RUNNING,)).fetchall()
+                workers = db.execute("SELECT COUNT(*) FROM workers WHERE seen > ?",
+                                     (now - WORKER_ACTIVE_SECONDS,)).fetchone()[0]
+                raise QueueFull(quality, retry_after(pending, running, workers, now))
+            db.execute("INSERT INTO jobs (id, quality, cost, params, status, submitted) VALUES (?, ?, ?, ?, ?, ?)",
+                       (job_id, quality, cost, json.dumps(params), PENDING, time.time()))
+
+    def claim(self, worker_id, concurrency):
+        with self.connect() as db:
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO workers (id, seen) VALUES (?, ?)", (worker_id, now))
+            db.execute("UPDATE jobs SET status = ?, error = ? WHERE status = ? AND COALESCE(renewed, started) < ?",
+                       (FAILED, json.dumps({"status": 500, "detail": "The worker running the job was lost"}),
+                        RUNNING, now - JOB_LEASE_SECONDS))
+            busy = dict(db.execute("SELECT quality, COUNT(*) FROM jobs WHERE status = ? GROUP BY quality",
+                                   (RUNNING,)).fetchall())
+            open_tiers = [q for q, limit in concurrency.items() if busy.get(q, 0) < limit]
+            if not open_tiers:
+                return None
+            row = db.execute(f"SELECT * FROM jobs WHERE status = ? AND quality IN ({','.join('?' * len(open_tiers))}) "
+                             "ORDER BY cost + submitted, rowid LIMIT 1", [PENDING] + open_tiers).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = ?, started = ?, renewed = ? WHERE id = ?", (RUNNING, now, now, row[0]))
+            job = self._job(row)
+            job.status, job.started, job.renewed = RUNNING, now, now
+            return job
+
+    def renew(self, job_id):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET renewed = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING))
+
+    def publish(self, job_id, event, payload):
+        with self.connect() as db:
+            db.execute("INSERT INTO events (job_id, seq, event, payload) "
+                       "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ? FROM events WHERE job_id = ? "
+                       "HAVING EXISTS (SELECT 1 FROM jobs WHERE id = ?)",
+                       (job_id, event, json.dumps(payload), job_id, job_id))
+
+    def read_events(self, job_id, after=0):
+        with self.connect() as db:
+            rows = db.execute("SELECT seq, event, payload FROM events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                              (job_id, after)).fetchall()
+        return [(seq, event, json.loads(payload)) for seq, event, payload in rows]
+
+    def finish(self, job_id, result):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ?, result = ? WHERE id = ?", (DONE, json.dumps(result), job_id))
+
+    def fail(self, job_id, status, detail):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ?, error = ? WHERE id = ?",
+                       (FAILED, json.dumps({"status": status, "detail": detail}), job_id))
+
+    def get(self, job_id):
+        with self.connect() as db:
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def delete(self, job_id):
+        with self.connect() as db:
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            db.execute("DELETE FROM events WHERE job_id = ?", (job_id,))
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return row[0] if row else None
+
+    def stats(self):
+        stats = {}
+        with self.connect() as db:
+            rows = db.execute("SELECT quality, status, COUNT(*), SUM(cost) FROM jobs WHERE status IN (?, ?) "
+                              "GROUP BY quality, status", (PENDING, RUNNING)).fetchall()
+        for quality, status, count, cost in rows:
+            tier = stats.setdefault(quality, {"pending": 0, "running": 0, "pending_cost": 0.0})
+            tier[status] = count
+            if status == PENDING:
+                tier["pending_cost"] = cost
+        return stats
+
+
+class Transaction:
+    """An immediate (write-locking) transaction on db for a with block, so check-then-write is atomic."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def open_queue(url):
+    """The queue backend for url: memory:// or sqlite:///path/to/jobs.db."""
+    if url == "memory://":
+        return MemoryQueue()
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return SQLiteQueue(path)
+    raise ValueError(f"Unknown job queue {url!r}, use memory:// or sqlite:///path/to/jobs.db")
@@ -0,0 +1,133 @@
+"""
+Admission control for the pipeline: bounded queues per quality tier in front of a fixed number
+of pipeline slots, with a concurrency limit per tier.
+
+A request is submitted with its image area and gets a ticket with an estimated cost in seconds
+(the area times its tier's seconds per megapixel, learned from finished requests), or is refused
+with QueueFull, carrying a Retry-After estimate, when its tier's queue is full. Whenever a slot
+frees, the waiting ticket with the lowest cost minus time waited runs next: cheap requests
+overtake expensive ones, but an expensive one is not overtaken forever.
+"""
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from metrics import registry
+
+QUEUE_DEPTH = registry.gauge("pipeline_queue_depth", "Requests waiting for a pipeline slot", ["quality"])
+RUNNING = registry.gauge("pipeline_running", "Requests holding a pipeline slot", ["quality"])
+QUEUED_COST = registry.gauge("pipeline_queued_cost_seconds", "Estimated seconds of work waiting", ["quality"])
+REJECTED = registry.counter("pipeline_rejected", "Requests refused with 429 because their queue was full",
+                            ["quality"])
+QUEUE_WAIT = registry.histogram("pipeline_queue_wait_seconds", "Time requests waited for a pipeline slot",
+                                ["quality"])
+
+
+class QueueFull(Exception):
+    def __init__(self, quality, retry_after):
+        super().__init__(f"The {quality} quality queue is full")
+        self.quality = quality
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A submitted request: its tier, size and cost estimate, and when it was submitted and started."""
+
+    __slots__ = ("quality", "megapixels", "cost", "submitted", "started", "order")
+
+    def __init__(self, quality, megapixels, cost, order):
+        self.quality = quality
+        self.megapixels = megapixels
+        self.cost = cost
+        self.submitted = time.monotonic()
+        self.started = None
+        self.order = order
+
+
+class Scheduler:
+    def __init__(self, slots, queue_limits, concurrency, seconds_per_megapixel, smoothing=0.2):
+        """
+        slots: requests that may run at once, over all tiers
+        queue_limits: {quality: requests that may wait}
+        concurrency: {quality: requests of the tier that may run at once}
+        seconds_per_megapixel: {quality: initial cost rate}, refined as requests finish
+        smoothing: weight of each finished request in the cost rate's moving average
+        """
+        self.slots = slots
+        self.queue_limits = dict(queue_limits)
+        self.concurrency = dict(concurrency)
+        self.rates = dict(seconds_per_megapixel)
+        self.smoothing = smoothing
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.order = itertools.count()
+        for quality in self.queue_limits:
+            QUEUE_DEPTH.set(0, quality=quality)
+            RUNNING.set(0, quality=quality)
+            QUEUED_COST.set(0, quality=quality)
+
+    def estimate(self, quality, megapixels):
+        """Estimated pipeline seconds of a request."""
+        return self.rates[quality] * megapixels
+
+    def observe(self, quality, seconds, megapixels):
+        """Refines the tier's cost rate with a request that took seconds to run."""
+        with self.condition:
+            self.rates[quality] += self.smoothing * (seconds / megapixels - self.rates[quality])
+
+    def retry_after(self):
+        """Seconds until the work queued and running now should be done, at least 1."""
+        now = time.monotonic()
+        backlog = sum(t.cost for t in self.waiting)
+        backlog += sum(max(0.0, t.cost - (now - t.started)) for t in self.running)
+        return max(1, math.ceil(backlog / self.slots))
+
+    def submit(self, quality, megapixels):
+        """Queues a request and returns its ticket, or raises QueueFull."""
+        with self.condition:
+            if sum(1 for t in self.waiting if t.quality == quality) >= self.queue_limits[quality]:
+                REJECTED.inc(quality=quality)
+                raise QueueFull(quality, self.retry_after())
+            ticket = Ticket(quality, megapixels, self.estimate(quality, megapixels), next(self.order))
+            self.waiting.append(ticket)
+            QUEUE_DEPTH.inc(quality=quality)
+            QUEUED_COST.inc(ticket.cost, quality=quality)
+            return ticket
+
+    def next_ticket(self):
+        """The waiting ticket to run when a slot is free, or None."""
+        if len(self.running) >= self.slots:
+            return None
+        busy = Counter(t.quality for t in self.running)
+        # cost - (now - submitted) orders the same at any now, so every waiter agrees on the pick
+        return min((t for t in self.waiting if busy[t.quality] < self.concurrency[t.quality]),
+                   key=lambda t: (t.cost + t.submitted, t.order), default=None)
+
+    @contextmanager
+    def run(self, ticket):
+        """Waits for the ticket's turn and holds a pipeline slot for the block."""
+        with self.condition:
+            while self.next_ticket() is not ticket:
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            self.running.append(ticket)
+            ticket.started = time.monotonic()
+            QUEUE_DEPTH.dec(quality=ticket.quality)
+            QUEUED_COST.dec(ticket.cost, quality=ticket.quality)
+            RUNNING.inc(quality=ticket.quality)
+            QUEUE_WAIT.observe(ticket.started - ticket.submitted, quality=ticket.quality)
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            with self.condition:
+                self.running.remove(ticket)
+                RUNNING.dec(quality=ticket.quality)
+                if succeeded:
+                    self.observe(ticket.quality, time.monotonic() - ticket.started, ticket.megapixels)
+                self.condition.notify_all()
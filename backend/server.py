@@ -1,16 +1,44 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 
-# Version 1.1 - High mode optimization in progressimport os
+# Version 1.1 - High mode optimization in progress
+import os
 import sys
 from pathlib import Path
+import asyncio
+import base64
 import glob
+import io
+import json
+import logging
+import math
+import multiprocessing
 import subprocess
 import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import List
+import numpy as np
 from PIL import Image
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from jobqueue import DONE, FAILED, RUNNING as JOB_RUNNING, open_queue
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry as metrics
+from scheduler import QUEUE_DEPTH, QUEUED_COST, REJECTED, RUNNING, QueueFull, Scheduler
+
 app = FastAPI()
 
 # Allow all origins for Hugging Face deployment
@@ -34,52 +62,363 @@ ESRGAN_OUTPUT_DIR = ESRGAN_ROOT / "results"
 FACE_PARSING_DIR = BACKEND_DIR / "face-parsing.PyTorch"
 FACE_PARSING_SCRIPT = FACE_PARSING_DIR / "test.py"
 DIVIDED_REGIONS_DIR = BACKEND_DIR / "Divided Regions"
+UPLOAD_FILE_NAME = "test.jpg"
+
+# Uploads are scaled down to at most this many pixels a side before the pipeline runs
+MAX_INPUT_SIDE = 512
+
+# Upload limits: a body over MAX_UPLOAD_BYTES is refused with 413 before it is read (by its
+# Content-Length) or as soon as it passes the cap; an image over MAX_UPLOAD_PIXELS by its
+# header, before it is decoded. Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale (PIL draft,
+# the smallest that still covers the final size) before the LANCZOS resize.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS", str(50_000_000)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# /process/batch takes up to MAX_BATCH_IMAGES images (files, or zip archives of them) and
+# MAX_BATCH_BYTES in all, unzipped; each image is held to the limits above
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "200"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_LIMITS = {"/process": MAX_UPLOAD_BYTES, "/process/stream": MAX_UPLOAD_BYTES, "/process/batch": MAX_BATCH_BYTES}
+
+# Admission control (scheduler.py). The pipeline hands images between stages through the fixed
+# paths above, so one job runs at a time; per tier, QUEUE_LIMITS requests may wait (beyond that:
+# 429 with Retry-After) and TIER_CONCURRENCY may run at once. Costs are estimated from the image
+# area with SECONDS_PER_MEGAPIXEL (of the prepared input), refined as requests finish. With a
+# JOB_QUEUE the same limits and costs apply to the jobs queued for the workers.
+PIPELINE_SLOTS = 1
+QUEUE_LIMITS = {"low": 16, "medium": 8, "high": 4}
+TIER_CONCURRENCY = {"low": 1, "medium": 1, "high": 1}
+SECONDS_PER_MEGAPIXEL = {"low": 4.0, "medium": 120.0, "high": 600.0}
+
+# density (1-100, see face-parsing.PyTorch/renderer.py) sets the symbol lattice; each quality tier
+# caps the symbol count so a dense render of a large upscale stays within a bounded render time
+MAX_SYMBOLS_BY_QUALITY = {"low": 15000, "medium": 40000, "high": 100000}
+
+# /process/stream renders in up to this many coarse-to-fine passes, sending a preview after each
+MAX_RENDER_PASSES = 4
+PREVIEW_JPEG_QUALITY = 80
+
+# /process/batch runs each stage over the whole batch: one ESRGAN process per pass, BiSeNet on
+# BATCH_PARSE_SIZE images per forward pass, and rendering in a pool of RENDER_PROCESSES processes
+# (default: one per core), started by the first batch. Each face's image and label map go to the
+# pool through shared memory (face-parsing.PyTorch/shared_arrays.py), recycled in render_buffers;
+# at most RENDER_IN_FLIGHT faces per render process are handed over at a time.
+BATCH_PARSE_SIZE = 8
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", "0")) or os.cpu_count() or 1
+RENDER_IN_FLIGHT = 2
+render_pool = None
+render_buffers = None
+render_pool_lock = threading.Lock()
+
+# BiSeNet runs in-process: loaded once at startup, preferring the frozen TorchScript artifact
+# written by face-parsing.PyTorch/export_bisenet.py. Without it, requests fall back to running
+# test.py, which parses in its own process.
+BISENET_CHECKPOINT = "79999_iter.pth"
+BISENET_ARTIFACT = Path(os.getenv("BISENET_ARTIFACT", FACE_PARSING_DIR / "res" / "cp" / "bisenet_fused.pt"))
+FACE_LABEL_PATH = FACE_PARSING_DIR / "res" / "test_res" / "test_label.png"
+# BISENET_TILE > 0 parses at native resolution in overlapping tiles of that size instead of
+# letterboxing to at most 1024px; memory stays bounded by the tile batch
+BISENET_TILE = int(os.getenv("BISENET_TILE", "0"))
+face_parser = None
+
+# USE_INT8=1 serves the statically quantized models (face-parsing.PyTorch/quantize.py and
+# Real-ESRGAN/quantize_realesrgan.py) wherever their artifacts exist, the float models otherwise.
+USE_INT8 = os.getenv("USE_INT8", "0") == "1"
+
+# INFERENCE_BACKEND=onnxruntime runs the ONNX exports (face-parsing.PyTorch/export_bisenet.py --onnx,
+# Real-ESRGAN/scripts/pytorch2onnx.py) on the CPU execution provider with ORT_THREADS intra-op threads
+# (0 lets onnxruntime decide). Missing exports fall back to torch.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+ORT_THREADS = int(os.getenv("ORT_THREADS", "0"))
+
+# Palettes (symbol sets and style tables) are read from face-parsing.PyTorch/palettes/*.json once,
+# with every glyph rasterized up front; renderer.py then draws in-process with the resident registry.
+palette_names = {"math", "ascii"}
+
+# output_format -> media type and file extension (face-parsing.PyTorch/renderer.py); without an
+# output_format in the form, /process picks one by the Accept header (png when none matches)
+OUTPUT_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "webp_lossless": "image/webp",
+                      "jpeg": "image/jpeg", "svg": "image/svg+xml"}
+OUTPUT_EXTENSIONS = {"png": "png", "webp": "webp", "webp_lossless": "webp", "jpeg": "jpg", "svg": "svg"}
+ACCEPT_OUTPUT_FORMATS = {"image/png": "png", "image/webp": "webp", "image/jpeg": "jpeg", "image/svg+xml": "svg"}
+# Encoder effort: fast (PNG zlib level 1, ...), balanced (PIL's defaults) or small (slowest, smallest)
+ENCODE_SPEEDS = ("fast", "balanced", "small")
+
+# The symbol placement log (face-parsing.PyTorch/placement_log.py) behind GET /placements;
+# PLACEMENT_LOG_COMPRESSION=gzip|zstd compresses it when written
+PLACEMENT_LOG_COMPRESSION = os.getenv("PLACEMENT_LOG_COMPRESSION") or None
+PLACEMENT_LOG_ENCODINGS = {".gz": ("gzip", "application/gzip"), ".zst": ("zstd", "application/zstd")}
+
+# LOG_LEVEL=DEBUG brings back the per-request chatter (paths, sizes, the ESRGAN script's output);
+# at the default INFO a request logs one line, its stage trace as JSON
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+log = logging.getLogger("server")
+log.setLevel(LOG_LEVEL)
+if not log.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    log.addHandler(_handler)
+    log.propagate = False
+
+# Prometheus metrics behind GET /metrics (metrics.py); latencies are broken down by quality tier
+REQUEST_SECONDS = metrics.histogram("pipeline_request_seconds",
+                                    "Successful pipeline request latency, waiting for the pipeline included",
+                                    ["quality"])
+STAGE_SECONDS = metrics.histogram("pipeline_stage_seconds", "Pipeline stage latency", ["quality", "stage"])
+REQUESTS = metrics.counter("pipeline_requests", "Pipeline requests by HTTP status", ["quality", "status"])
+SYMBOLS_PLACED = metrics.histogram("pipeline_symbols_placed", "Symbols placed per render", ["quality"],
+                                   buckets=(1000, 2500, 5000, 10000, 15000, 25000, 40000, 60000, 100000))
+BATCH_IMAGES = metrics.counter("pipeline_batch_images", "Images of /process/batch requests by outcome (HTTP status)",
+                               ["quality", "status"])
+PEAK_RSS = metrics.gauge("pipeline_peak_rss_bytes",
+                         "Peak resident memory of the server process and of its largest child process",
+                         ["process"])
+
+scheduler = Scheduler(PIPELINE_SLOTS, QUEUE_LIMITS, TIER_CONCURRENCY, SECONDS_PER_MEGAPIXEL)
+
+# JOB_QUEUE moves the pipeline out of this process: requests are queued (jobqueue.py) for worker
+# processes (worker.py) that keep the models resident, each job in a folder of its own under
+# JOBS_DIR, which this process and every worker must share; the upload goes in and the output
+# and placement log come back through it. sqlite:///path/to/jobs.db takes any number of workers
+# on the box (or on the volume holding the database); memory:// runs JOB_WORKERS worker threads
+# in this process. Unset, the pipeline runs in this process as above.
+JOB_QUEUE = os.getenv("JOB_QUEUE") or None
+JOBS_DIR = Path(os.getenv("JOBS_DIR", BACKEND_DIR / "jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_UPLOAD_NAME = "upload"
+JOB_POLL_SECONDS = 0.1
+# Jobs of a tier that may run at once over all workers (JOB_TIER_CONCURRENCY=low=64,medium=4,high=2):
+# capping the slow tiers keeps workers free for low quality requests
+JOB_TIER_CONCURRENCY = {"low": 64, "medium": 4, "high": 2}
+JOB_TIER_CONCURRENCY.update({tier: int(limit) for tier, limit in
+                             (item.split("=") for item in os.getenv("JOB_TIER_CONCURRENCY", "").split(",") if item)})
+job_queue = open_queue(JOB_QUEUE) if JOB_QUEUE else None
+
+# Startup loads and warms everything in the background: /health answers at once (the process is
+# up), /ready only once warmup is done (route traffic here), and requests before that get 503.
+# WARMUP=0 skips the warmup passes but still loads the palettes and BiSeNet, e.g. for --reload.
+# A required step that fails (see warmup) keeps /ready at 503 with its name in warmup_failed:
+# the replica still serves what reaches it, on the slow fallbacks, but shouldn't get traffic.
+WARMUP = os.getenv("WARMUP", "1") == "1"
+WARMUP_RETRY_AFTER = 10
+ready = threading.Event()
+warmup_report = {}
+warmup_failed = []
 
 # Ensure directories exist on startup
 TEST_IMG_DIR.mkdir(parents=True, exist_ok=True)
 ESRGAN_INPUT_DIR.mkdir(parents=True, exist_ok=True)
 ESRGAN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 DIVIDED_REGIONS_DIR.mkdir(parents=True, exist_ok=True)
+if job_queue is not None:
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def run_esrgan_upscale(script_dir: Path, input_output_dir: Path, input_file_name: str, step: int):
+class JobPaths:
     """
-    Runs the Real-ESRGAN inference script with memory-optimized arguments.
-    script_dir: Directory where inference_realesrgan.py is located
-    input_output_dir: Directory containing inputs/ and results/ folders
+    The files a job's pipeline stages hand each other: the ESRGAN folder (inputs/ and results/),
+    the parser's input, its label map and the region folder, which also receives the output and
+    the placement log. The defaults are the fixed folders above, shared by every request of this
+    process; for_job gives a queued job (see JOB_QUEUE) folders of its own.
     """
-    input_path = input_output_dir / "inputs" / input_file_name
-    output_path = input_output_dir / "results/"
-    
-    # Verify input file exists
-    if not input_path.exists():
-        raise HTTPException(status_code=500, detail=f"ESRGAN input file not found: {input_path}")
-    
-    # Optimization: Adaptive tile size based on image dimensions
-    # Tile sizes MUST be even to avoid assertion errors
+
+    def __init__(self, esrgan_dir: Path = ESRGAN_ROOT, parse_input: Path = TEST_IMG_DIR / UPLOAD_FILE_NAME,
+                 label_path: Path = FACE_LABEL_PATH, regions_dir: Path = DIVIDED_REGIONS_DIR):
+        self.esrgan_dir = esrgan_dir
+        self.input_dir = esrgan_dir / "inputs"
+        self.output_dir = esrgan_dir / "results"
+        self.parse_input = parse_input
+        self.label_path = label_path
+        self.regions_dir = regions_dir
+
+    @classmethod
+    def for_job(cls, job_dir: Path):
+        return cls(job_dir / "esrgan", job_dir / UPLOAD_FILE_NAME, job_dir / "label.png", job_dir / "regions")
+
+
+DEFAULT_PATHS = JobPaths()
+
+
+if str(FACE_PARSING_DIR) not in sys.path:
+    sys.path.insert(0, str(FACE_PARSING_DIR))
+
+
+def load_palette_registry():
+    """Loads the palette files and pre-rasterizes their glyphs before the first request."""
+    global palette_names
+    from palettes import get_registry
+    palette_names = set(get_registry())
+    log.info("Palettes loaded: %s", sorted(palette_names))
+
+
+def load_face_parser():
+    """Loads BiSeNet once so requests don't pay for model construction and weight loading."""
+    global face_parser
     try:
-        img = Image.open(input_path)
-        img_area = img.size[0] * img.size[1]
-        
-        if img_area > 200000:  # Large image
-            tile_size = "128"  # Even tile size
-            tile_pad = "2"
-        elif img_area > 100000:  # Medium image
-            tile_size = "256"  # Even tile size
-            tile_pad = "2"
-        else:  # Small image
-            tile_size = "512"  # Even tile size
-            tile_pad = "2"
-        
-        sys.stderr.write(f"DEBUG: ESRGAN adaptive settings - Image: {img.size}, Area: {img_area}, Tile: {tile_size}\n")
-    except Exception as e:
-        tile_size = "256"
-        tile_pad = "2"
-        sys.stderr.write(f"DEBUG: Using default tile settings: {e}\n")
-    
-    sys.stderr.write(f"DEBUG: ESRGAN Step {step} - Input: {input_path}\n")
-    sys.stderr.write(f"DEBUG: ESRGAN Step {step} - Output dir: {output_path}\n")
-    
+        from parsing import INT8_ARTIFACT, ONNX_ARTIFACT, load_parser
+        face_parser = load_parser(BISENET_CHECKPOINT, artifact=str(BISENET_ARTIFACT), quantized=USE_INT8,
+                                  backend=INFERENCE_BACKEND, num_threads=ORT_THREADS)
+        if INFERENCE_BACKEND == "onnxruntime" and Path(ONNX_ARTIFACT).exists():
+            source = f"{ONNX_ARTIFACT} (onnxruntime)"
+        elif USE_INT8 and Path(INT8_ARTIFACT).exists():
+            source = INT8_ARTIFACT
+        else:
+            source = BISENET_ARTIFACT if BISENET_ARTIFACT.exists() else f"{BISENET_CHECKPOINT} (fused)"
+        log.info("BiSeNet loaded from %s", source)
+    except Exception:
+        # test.py will parse in its own process instead
+        face_parser = None
+        raise
+
+
+def warm_face_parser():
+    """BiSeNet forward passes at the input sizes the quality tiers hand it (or at the tile size)."""
+    from parsing import parse_letterboxed, parse_tiled
+
+    if face_parser is None:
+        raise RuntimeError("BiSeNet is not resident")
+    if BISENET_TILE:
+        parse_tiled(face_parser, Image.new("RGB", (BISENET_TILE, BISENET_TILE)), tile=BISENET_TILE)
+        return
+    # low parses the prepared input, medium and high a 4x upscale of it (letterboxed to parsing.MAX_PARSE_SIDE)
+    for side in (MAX_INPUT_SIDE, MAX_INPUT_SIDE * 4):
+        parse_letterboxed(face_parser, Image.new("RGB", (side, side)))
+
+
+def warm_esrgan():
+    """
+    One Real-ESRGAN run on a small image in a scratch folder. RealESRGANer lives in the inference
+    script's own process per request, so what carries over is the downloaded weights (fetched here
+    instead of by the first request) and the page cache.
+    """
+    with tempfile.TemporaryDirectory(prefix="esrgan_warmup_") as workdir:
+        workdir = Path(workdir)
+        (workdir / "inputs").mkdir()
+        (workdir / "results").mkdir()
+        Image.new("RGB", (64, 64), (128, 128, 128)).save(workdir / "inputs" / "warmup.jpg")
+        run_esrgan_upscale(ESRGAN_SCRIPT.parent, workdir, "warmup.jpg", 0)
+
+
+def warm_renderer():
+    """A tiny render per palette, so the first request doesn't pay for the renderer's imports and first draws."""
+    from renderer import create_math_face
+
+    with tempfile.TemporaryDirectory(prefix="renderer_warmup_") as workdir:
+        Image.new("RGB", (64, 64), (200, 160, 130)).save(Path(workdir) / "region_1.png")
+        for palette in sorted(palette_names):
+            create_math_face(palette=palette, seed=0, region_dir=workdir)
+
+
+def start_job_workers():
+    """JOB_WORKERS worker threads (worker.py) on the memory:// queue."""
+    import worker
+
+    for i in range(JOB_WORKERS):
+        threading.Thread(target=worker.serve, args=(f"{worker.worker_name()}-{i}",), name=f"job-worker-{i}",
+                         daemon=True).start()
+
+
+def warmup(load_models: bool = None):
+    """
+    Loads the palettes (glyphs pre-rasterized) and BiSeNet, runs the warmup passes, then sets ready.
+    load_models defaults to whether the pipeline runs in this process: with a JOB_QUEUE only
+    the workers need the models (but memory:// runs its workers here, started once warm).
+    Loading is required, the warmup passes are not: a failed required step goes in warmup_failed.
+    """
+    if load_models is None:
+        load_models = job_queue is None or JOB_QUEUE == "memory://"
+    steps = [("palettes", load_palette_registry, True)]
+    if load_models:
+        steps.append(("bisenet", load_face_parser, True))
+        if WARMUP:
+            steps += [("bisenet_forward", warm_face_parser, False), ("renderer", warm_renderer, False),
+                      ("esrgan", warm_esrgan, False)]
+    if load_models and JOB_QUEUE == "memory://":
+        steps.append(("job_workers", start_job_workers, True))
+    for name, step, required in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            warmup_report[name] = {"seconds": round(time.perf_counter() - start, 3)}
+        except Exception as e:
+            detail = str(getattr(e, "detail", e))
+            warmup_report[name] = {"error": detail[-500:], "required": required}
+            log.warning("Warmup step %s failed: %s", name, detail)
+            if required:
+                warmup_failed.append(name)
+    ready.set()
+    if warmup_failed:
+        # Requests still run, on the fallbacks (e.g. test.py parsing in its own process without BiSeNet)
+        log.warning("Not ready, required warmup steps failed: %s", ", ".join(warmup_failed))
+    log.info("Warmup done: %s", json.dumps(warmup_report))
+
+
+@app.on_event("startup")
+def start_warmup():
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+def run_face_parsing(image_path: Path, span: dict = None, label_path: Path = FACE_LABEL_PATH):
+    """Parses image_path with the resident BiSeNet and writes the label map the renderer reads to label_path.
+
+    The map is letterboxed (aspect preserved) and written at the image's own size, so
+    extract_regions uses it without a nearest-neighbour resize. span, if given, receives the
+    stage's attributes (image size, network tiles).
+    """
+    from parsing import count_tiles, parse_letterboxed, parse_tiled
+
+    with Image.open(image_path) as img:
+        if BISENET_TILE:
+            labels = parse_tiled(face_parser, img.convert("RGB"), tile=BISENET_TILE)
+        else:
+            labels = parse_letterboxed(face_parser, img.convert("RGB"))
+    label_path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(labels).save(label_path)
+    if span is not None:
+        height, width = labels.shape
+        span.update(input_size=[width, height], output_size=[width, height],
+                    tiles=count_tiles(height, width, tile=BISENET_TILE) if BISENET_TILE else 1)
+    log.debug("Label map saved: %s", label_path)
+
+
+def find_esrgan_output(step: int, output_dir: Path = ESRGAN_OUTPUT_DIR) -> Path:
+    """The newest image in the Real-ESRGAN results folder (or a subfolder of it), or raises 500."""
+    output_files = []
+    for ext in ["*.png", "*.jpg", "*.jpeg"]:
+        output_files.extend(list(output_dir.glob(ext)))
+    if not output_files:
+        for ext in ["*.png", "*.jpg", "*.jpeg"]:
+            output_files.extend(list(output_dir.glob(f"*/{ext}")))
+    if not output_files:
+        for ext in ["*.png", "*.jpg", "*.jpeg"]:
+            output_files.extend(list(output_dir.glob(f"**/{ext}")))
+
+    if not output_files:
+        output_contents = list(output_dir.rglob("*"))
+        content_names = [str(p.relative_to(output_dir)) for p in output_contents[:20]]
+        log.error("ESRGAN Step %d output files not found. Directory: %s. Contents: %s",
+                  step, output_dir, content_names)
+        raise HTTPException(status_code=500,
+            detail=f"ESRGAN Step {step} output not found. Directory: {output_dir}. Contents: {content_names}")
+
+    output_image = max(output_files, key=lambda p: p.stat().st_mtime)
+    log.debug("ESRGAN Step %d output found: %s", step, output_image)
+    return output_image
+
+
+def esrgan_tiles(area: int):
+    """(tile size, tile pad) for inputs of the given pixel area; tile sizes MUST be even."""
+    if area > 200000:  # Large image
+        return "128", "2"
+    if area > 100000:  # Medium image
+        return "256", "2"
+    return "512", "2"  # Small image
+
+
+def run_esrgan_script(script_dir: Path, input_path: Path, output_path: Path, tile_size: str, tile_pad: str,
+                      step: int):
+    """Runs the Real-ESRGAN inference script on an image, or on every image of a folder, or raises 500."""
     command = [
         "python", 
         "inference_realesrgan.py", 
@@ -90,10 +429,13 @@ def run_esrgan_upscale(script_dir: Path, input_output_dir: Path, input_file_name
         "--tile_pad", tile_pad,  # Minimal padding
         "--fp32"  # Force full precision on CPU
     ]
+    if USE_INT8:
+        command.append("--int8")  # Falls back to the float model when no INT8 artifact exists
+    if INFERENCE_BACKEND != "torch":
+        command += ["--backend", INFERENCE_BACKEND, "--num_threads", str(ORT_THREADS)]
     
-    sys.stderr.write(f"DEBUG: Running ESRGAN Step {step} with command: {' '.join(command)}\n")
+    log.debug("Running ESRGAN Step %d with command: %s", step, " ".join(command))
 
-    completed = None
     try:
         completed = subprocess.run(
             command,
@@ -106,108 +448,278 @@ def run_esrgan_upscale(script_dir: Path, input_output_dir: Path, input_file_name
         )
     except subprocess.CalledProcessError as e:
         error_detail = e.stderr or e.stdout or str(e)
-        sys.stderr.write(f"\n--- ESRGAN Step {step} FAILED ---\n{error_detail}\n")
+        log.error("ESRGAN Step %d FAILED\n%s", step, error_detail)
         raise HTTPException(status_code=500, detail=f"ESRGAN upscale Step {step} failed: {error_detail}")
 
-    if completed:
-        sys.stderr.write(f"ESRGAN Step {step} stdout:\n{completed.stdout}\n")
-        sys.stderr.write(f"ESRGAN Step {step} stderr:\n{completed.stderr}\n")
-        sys.stderr.write(f"--- ESRGAN Step {step} SUCCESS ---\n")
+    log.debug("ESRGAN Step %d stdout:\n%s", step, completed.stdout)
+    log.debug("ESRGAN Step %d stderr:\n%s", step, completed.stderr)
 
-    return completed
 
+def run_esrgan_upscale(script_dir: Path, input_output_dir: Path, input_file_name: str, step: int,
+                       span: dict = None) -> Path:
+    """
+    Runs the Real-ESRGAN inference script with memory-optimized arguments and returns its output image.
+    script_dir: Directory where inference_realesrgan.py is located
+    input_output_dir: Directory containing inputs/ and results/ folders
+    span: if given, receives the stage's attributes (input and output size, tile count)
+    """
+    input_path = input_output_dir / "inputs" / input_file_name
+    output_path = input_output_dir / "results/"
+    
+    # Verify input file exists
+    if not input_path.exists():
+        raise HTTPException(status_code=500, detail=f"ESRGAN input file not found: {input_path}")
+    
+    # Optimization: Adaptive tile size based on image dimensions
+    input_size = None
+    try:
+        with Image.open(input_path) as img:
+            input_size = img.size
+        img_area = input_size[0] * input_size[1]
+        tile_size, tile_pad = esrgan_tiles(img_area)
+        log.debug("ESRGAN adaptive settings - Image: %s, Area: %d, Tile: %s", input_size, img_area, tile_size)
+    except Exception as e:
+        tile_size = "256"
+        tile_pad = "2"
+        log.debug("Using default tile settings: %s", e)
+    
+    log.debug("ESRGAN Step %d - Input: %s", step, input_path)
+    log.debug("ESRGAN Step %d - Output dir: %s", step, output_path)
 
-@app.post("/process")
-async def process_image(
-    file: UploadFile = File(...),
-    quality: str = Form("high"),
-    density: int = Form(50),
-    palette: str = Form("math"),
-):
+    run_esrgan_script(script_dir, input_path, output_path, tile_size, tile_pad, step)
+
+    output_image = find_esrgan_output(step, input_output_dir / "results")
+    if span is not None:
+        with Image.open(output_image) as img:
+            span["output_size"] = list(img.size)
+        if input_size:
+            span["input_size"] = list(input_size)
+            span["tiles"] = math.ceil(input_size[0] / int(tile_size)) * math.ceil(input_size[1] / int(tile_size))
+    return output_image
+
+
+def run_esrgan_batch(script_dir: Path, input_output_dir: Path, step: int, span: dict = None) -> dict:
     """
-    Save upload, run optional ESRGAN upscaling, run face parsing script, return image.
+    One Real-ESRGAN run over every image in input_output_dir/inputs, so the model is loaded once
+    for all of them; tiles are sized for the largest. Returns {input stem: output image} for the
+    images it upscaled (one it fails on is left out). span, as for run_esrgan_upscale.
     """
+    inputs = sorted(p for p in (input_output_dir / "inputs").iterdir() if p.is_file())
+    sizes = {}
+    for path in inputs:
+        with Image.open(path) as img:
+            sizes[path.stem] = img.size
+    tile_size, tile_pad = esrgan_tiles(max((w * h for w, h in sizes.values()), default=0))
+    run_esrgan_script(script_dir, input_output_dir / "inputs", input_output_dir / "results", tile_size, tile_pad,
+                      step)
+
+    # The script names its outputs <input stem>_out.<ext>
+    outputs = {p.stem[:-len("_out")]: p for p in (input_output_dir / "results").glob("*_out.*")}
+    outputs = {stem: path for stem, path in outputs.items() if stem in sizes}
+    if span is not None:
+        span.update(images=len(inputs), upscaled=len(outputs),
+                    tiles=sum(math.ceil(w / int(tile_size)) * math.ceil(h / int(tile_size)) for w, h in sizes.values()))
+    return outputs
+
+
+def negotiate_output_format(accept: str) -> str:
+    """The output format the Accept header ranks highest (by q, then order); png if none is listed."""
+    best, best_q = "png", 0.0
+    for part in accept.split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        output_format = ACCEPT_OUTPUT_FORMATS.get(media_type.lower())
+        if output_format and q > best_q:
+            best, best_q = output_format, q
+    return best
+
+
+def validate_options(quality: str, palette: str, output_format: str, density: int, encode_speed: str = "balanced"):
+    """Normalizes the form options shared by /process and /process/stream, or raises 400."""
     quality = (quality or "high").strip().lower()
     if quality not in {"low", "medium", "high"}:
         raise HTTPException(status_code=400, detail="Invalid quality value. Use 'low', 'medium', or 'high'.")
+    palette = (palette or "math").strip().lower()
+    if palette not in palette_names:
+        raise HTTPException(status_code=400, detail=f"Unknown palette. Use one of: {', '.join(sorted(palette_names))}.")
+    # svg skips rasterization: the symbols are sent as vector text for the client to draw
+    output_format = (output_format or "png").strip().lower()
+    if output_format not in OUTPUT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid output_format value. Use one of: {', '.join(OUTPUT_MEDIA_TYPES)}.")
+    if not 1 <= density <= 100:
+        raise HTTPException(status_code=400, detail="Invalid density value. Use 1 to 100.")
+    encode_speed = (encode_speed or "balanced").strip().lower()
+    if encode_speed not in ENCODE_SPEEDS:
+        raise HTTPException(status_code=400, detail=f"Invalid encode_speed value. Use one of: {', '.join(ENCODE_SPEEDS)}.")
+    return quality, palette, output_format, encode_speed
 
-    uploaded_file_name = "test.jpg"
-    final_input_for_face_parsing = TEST_IMG_DIR / uploaded_file_name
 
-    # --- Directory Setup and Cleanup ---
+def probe_upload(data: bytes):
+    """The upload's (width, height) from its header, without decoding it; 400 if unreadable, 413 if too large."""
     try:
-        TEST_IMG_DIR.mkdir(parents=True, exist_ok=True)
-        ESRGAN_INPUT_DIR.mkdir(parents=True, exist_ok=True)
-        ESRGAN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-
-        for f in ESRGAN_INPUT_DIR.glob("*.*"):
-            os.remove(f)
-        for f in ESRGAN_OUTPUT_DIR.glob("*.*"):
-            os.remove(f)
-        if final_input_for_face_parsing.exists():
-            os.remove(final_input_for_face_parsing)
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
     except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to set up directories: {exc}")
+        log.debug("Unreadable upload: %s", exc)
+        raise HTTPException(status_code=400, detail="Unsupported or corrupt image.")
+    if width * height > MAX_UPLOAD_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image has {width}x{height} pixels, "
+                                                    f"more than the {MAX_UPLOAD_PIXELS} allowed.")
+    return width, height
 
-    # --- Save Uploaded File ---
-    esrgan_initial_input_path = ESRGAN_INPUT_DIR / uploaded_file_name
-    try:
-        data = await file.read()
-        if not data:
-            raise HTTPException(status_code=400, detail="Uploaded file is empty")
-        
-        with open(esrgan_initial_input_path, "wb") as out:
-            out.write(data)
-        
-        # Verify file was saved
-        if not esrgan_initial_input_path.exists():
-            raise HTTPException(status_code=500, detail=f"File save failed: {esrgan_initial_input_path}")
-        
-        sys.stderr.write(f"DEBUG: Uploaded file saved: {esrgan_initial_input_path} ({len(data)} bytes)\n")
-    except HTTPException:
-        raise
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to save uploaded file: {exc}")
 
-    # --- Optimization: Pre-process input image for faster upscaling ---
+def decode_upload(data: bytes):
+    """
+    Decodes the upload straight into the pipeline input: an RGB uint8 array (alpha flattened onto
+    white), at most MAX_INPUT_SIDE a side, with even sides for ESRGAN.
+    """
+    width, height = probe_upload(data)
     try:
-        img = Image.open(esrgan_initial_input_path)
-        sys.stderr.write(f"DEBUG: Image opened successfully: {img.size}, mode: {img.mode}\n")
-        
+        img = Image.open(io.BytesIO(data))
+        scale = MAX_INPUT_SIDE / max(width, height)
+        if scale < 1:
+            # JPEG only (other formats ignore it); before any convert, which would decode at full size
+            img.draft(None, (math.ceil(width * scale), math.ceil(height * scale)))
+        log.debug("Image opened successfully: %s, mode: %s", img.size, img.mode)
+
         # Convert to RGB first if needed
         if img.mode != "RGB":
-            sys.stderr.write(f"DEBUG: Converting {img.mode} to RGB\n")
+            log.debug("Converting %s to RGB", img.mode)
             if img.mode == "RGBA":
                 img_rgb = Image.new("RGB", img.size, (255, 255, 255))
                 img_rgb.paste(img, mask=img.split()[3])
                 img = img_rgb
             else:
                 img = img.convert("RGB")
-        
-        # Resize if too large (max 512 for better performance)
-        max_size = 512
-        if img.size[0] > max_size or img.size[1] > max_size:
-            img.thumbnail((max_size, max_size), Image.LANCZOS)
-            sys.stderr.write(f"DEBUG: Resized to {img.size}\n")
-        
-        # CRITICAL: Ensure dimensions are EVEN (divisible by 2) for ESRGAN
-        width, height = img.size
-        new_width = width - (width % 2)  # Make even
-        new_height = height - (height % 2)  # Make even
-        
-        if new_width != width or new_height != height:
-            img = img.crop((0, 0, new_width, new_height))
-            sys.stderr.write(f"DEBUG: Cropped to even dimensions: {img.size}\n")
-        
-        # Verify dimensions are even
-        assert img.size[0] % 2 == 0 and img.size[1] % 2 == 0, f"Dimensions still odd: {img.size}"
-        
-        # Save as JPEG
-        img.save(esrgan_initial_input_path, format="JPEG", quality=85)
-        sys.stderr.write(f"DEBUG: Preprocessed image saved with dimensions {img.size}\n")
-    except Exception as e:
-        sys.stderr.write(f"ERROR: Pre-processing failed: {e}\n")
-        raise HTTPException(status_code=500, detail=f"Image preprocessing failed: {e}")
+
+        # Resize if too large (max MAX_INPUT_SIDE for better performance)
+        if img.size[0] > MAX_INPUT_SIDE or img.size[1] > MAX_INPUT_SIDE:
+            img.thumbnail((MAX_INPUT_SIDE, MAX_INPUT_SIDE), Image.LANCZOS)
+            log.debug("Resized to %s", img.size)
+    except Exception as exc:
+        log.debug("Decoding the upload failed: %s", exc)
+        raise HTTPException(status_code=400, detail=f"Unsupported or corrupt image: {exc}")
+
+    # CRITICAL: Ensure dimensions are EVEN (divisible by 2) for ESRGAN
+    pixels = np.asarray(img)
+    return pixels[:pixels.shape[0] - pixels.shape[0] % 2, :pixels.shape[1] - pixels.shape[1] % 2]
+
+
+def prepare_input(data: bytes, span: dict = None, paths: JobPaths = None):
+    """Decodes the upload (decode_upload) and saves it as the ESRGAN input, in paths' folders (DEFAULT_PATHS).
+
+    span, if given, receives the stage's attributes (upload and prepared image size).
+    """
+    paths = paths or DEFAULT_PATHS
+    uploaded_file_name = UPLOAD_FILE_NAME
+    final_input_for_face_parsing = paths.parse_input
+
+    # Nothing touches the disk before the upload is known to be a usable image
+    pixels = decode_upload(data)
+
+    # --- Directory Setup and Cleanup ---
+    try:
+        final_input_for_face_parsing.parent.mkdir(parents=True, exist_ok=True)
+        paths.input_dir.mkdir(parents=True, exist_ok=True)
+        paths.output_dir.mkdir(parents=True, exist_ok=True)
+
+        for f in paths.input_dir.glob("*.*"):
+            os.remove(f)
+        for f in paths.output_dir.glob("*.*"):
+            os.remove(f)
+        if final_input_for_face_parsing.exists():
+            os.remove(final_input_for_face_parsing)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to set up directories: {exc}")
+
+    # --- Save the ESRGAN input ---
+    esrgan_initial_input_path = paths.input_dir / uploaded_file_name
+    try:
+        Image.fromarray(pixels).save(esrgan_initial_input_path, format="JPEG", quality=85)
+        log.debug("Preprocessed image saved with dimensions %s", pixels.shape[1::-1])
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to save the preprocessed image: {exc}")
+
+    if span is not None:
+        span.update(input_size=list(probe_upload(data)), output_size=[pixels.shape[1], pixels.shape[0]],
+                    bytes=len(data))
+
+
+def peak_rss_mb():
+    """High-water resident memory of this process and of its largest finished child, in MB."""
+    if resource is None:
+        return {"self": None, "children": None}
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1),
+    }
+
+
+class Trace:
+    """
+    Spans of one request, one per pipeline stage: its duration, the peak memory so far and
+    whatever the stage reports (image sizes, tile count, symbols placed).
+    Each finished span goes to on_progress as "stage_done" and into the stage latency histogram.
+    """
+
+    def __init__(self, quality: str, on_progress=None):
+        self.quality = quality
+        self.on_progress = on_progress
+        self.spans = []
+
+    def notify(self, event, **payload):
+        if self.on_progress is not None:
+            self.on_progress(event, payload)
+
+    def record(self, name: str, seconds: float, **attributes):
+        span = dict(stage=name, seconds=round(seconds, 4), **attributes)
+        span["peak_rss_mb"] = peak_rss_mb()
+        self.spans.append(span)
+        STAGE_SECONDS.observe(seconds, quality=self.quality, stage=name)
+        self.notify("stage_done", **span)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the block as stage name; the block can add attributes to the yielded dict."""
+        self.notify("stage", stage=name)
+        attributes = {}
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException:
+            self.spans.append(dict(stage=name, seconds=round(time.perf_counter() - start, 4), error=True,
+                                   **attributes))
+            raise
+        self.record(name, time.perf_counter() - start, **attributes)
+
+
+def run_pipeline(quality: str, palette: str, output_format: str, density: int, passes: int = 1,
+                 on_progress=None, trace: Trace = None, encode_speed: str = "balanced", paths: JobPaths = None) -> Path:
+    """Upscales the prepared input per quality tier, parses and renders it; returns the output path.
+
+    on_progress(event, payload) is called as stages start ("stage", {"stage": name}) and end
+    ("stage_done", the stage's span: "stage", "seconds", "peak_rss_mb" and its attributes) and,
+    when passes > 1, with coarse-to-fine previews ("preview", {"pass", "passes", "image"}).
+    The stages are upscale_1, upscale_2, parse, extract_regions, create_math_face and encode
+    (the output file write, part of create_math_face), or face_parsing_script when BiSeNet
+    isn't resident. Spans are added to trace when given (see run_request).
+
+    paths are the job's folders, prepared by prepare_input (DEFAULT_PATHS if not given); in
+    folders of its own a job needs the resident BiSeNet, test.py only works in the fixed ones.
+    """
+    paths = paths or DEFAULT_PATHS
+    uploaded_file_name = UPLOAD_FILE_NAME
+    final_input_for_face_parsing = paths.parse_input
+    esrgan_initial_input_path = paths.input_dir / uploaded_file_name
+    trace = trace or Trace(quality, on_progress)
 
     # --- Handle ESRGAN Quality Options ---
     if quality == "low":
@@ -217,7 +729,7 @@ async def process_image(
         input_file_name = uploaded_file_name
         
         # Clean outputs before ESRGAN step 1
-        for f in ESRGAN_OUTPUT_DIR.glob("*.*"):
+        for f in paths.output_dir.glob("*.*"):
             try:
                 os.remove(f)
             except Exception:
@@ -225,39 +737,17 @@ async def process_image(
         
         # ESRGAN Step 1
         try:
-            run_esrgan_upscale(ESRGAN_SCRIPT.parent, ESRGAN_ROOT, input_file_name, 1)
+            with trace.stage("upscale_1") as span:
+                first_output_image = run_esrgan_upscale(ESRGAN_SCRIPT.parent, paths.esrgan_dir, input_file_name, 1, span)
         except Exception as e:
-            sys.stderr.write(f"ESRGAN Step 1 failed: {str(e)}\n")
+            log.error("ESRGAN Step 1 failed: %s", e)
             raise
-        
-        # Search for output files - try multiple patterns
-        output_files_step1 = []
-        for ext in ["*.png", "*.jpg", "*.jpeg"]:
-            output_files_step1.extend(list(ESRGAN_OUTPUT_DIR.glob(ext)))
-        if not output_files_step1:
-            for ext in ["*.png", "*.jpg", "*.jpeg"]:
-                output_files_step1.extend(list(ESRGAN_OUTPUT_DIR.glob(f"*/{ext}")))
-        if not output_files_step1:
-            for ext in ["*.png", "*.jpg", "*.jpeg"]:
-                output_files_step1.extend(list(ESRGAN_OUTPUT_DIR.glob(f"**/{ext}")))
-        
-        if not output_files_step1:
-            output_contents = list(ESRGAN_OUTPUT_DIR.rglob("*"))
-            content_names = [str(p.relative_to(ESRGAN_OUTPUT_DIR)) for p in output_contents[:20]]
-            sys.stderr.write(f"ESRGAN Step 1 output files not found. Directory: {ESRGAN_OUTPUT_DIR}\n")
-            sys.stderr.write(f"Contents: {content_names}\n")
-            raise HTTPException(status_code=500, 
-                detail=f"ESRGAN Step 1 output not found. Directory: {ESRGAN_OUTPUT_DIR}. Contents: {content_names}")
-        
-        
-        first_output_image = max(output_files_step1, key=lambda p: p.stat().st_mtime)
-        sys.stderr.write(f"DEBUG: ESRGAN Step 1 output found: {first_output_image}\n")
 
         if quality == "high":
             # ESRGAN Step 2 - Load and fix dimensions FIRST
             step1_img = Image.open(first_output_image)
             width, height = step1_img.size
-            sys.stderr.write(f"DEBUG: Step 1 output size: {step1_img.size}\n")
+            log.debug("Step 1 output size: %s", step1_img.size)
             
             # Ensure EVEN dimensions (divisible by 2)
             new_width = width - (width % 2)
@@ -265,98 +755,106 @@ async def process_image(
             
             if new_width != width or new_height != height:
                 step1_img = step1_img.crop((0, 0, new_width, new_height))
-                sys.stderr.write(f"DEBUG: Step 2 input cropped to even dimensions: {step1_img.size}\n")
+                log.debug("Step 2 input cropped to even dimensions: %s", step1_img.size)
             
             # Verify dimensions are even
             assert step1_img.size[0] % 2 == 0 and step1_img.size[1] % 2 == 0, f"Step 2 input dimensions not even: {step1_img.size}"
             
             # Now clean up directories
-            for f in ESRGAN_INPUT_DIR.glob("*.*"):
+            for f in paths.input_dir.glob("*.*"):
                 try:
                     os.remove(f)
                 except Exception:
                     pass
             
-            for f in ESRGAN_OUTPUT_DIR.glob("*.*"):
+            for f in paths.output_dir.glob("*.*"):
                 try:
                     os.remove(f)
                 except Exception:
                     pass
             
             # Save the processed image for Step 2 as PNG to preserve exact dimensions
-            step1_img.save(ESRGAN_INPUT_DIR / input_file_name, format="JPEG", quality=95)
+            step1_img.save(paths.input_dir / input_file_name, format="JPEG", quality=95)
             
             # Verify saved file has even dimensions
-            verify_img = Image.open(ESRGAN_INPUT_DIR / input_file_name)
+            verify_img = Image.open(paths.input_dir / input_file_name)
             if verify_img.size[0] % 2 != 0 or verify_img.size[1] % 2 != 0:
-                sys.stderr.write(f"ERROR: Saved image has odd dimensions: {verify_img.size}\n")
+                log.error("Saved image has odd dimensions: %s", verify_img.size)
                 raise HTTPException(status_code=500, detail=f"Step 2 input has odd dimensions after save: {verify_img.size}")
-            sys.stderr.write(f"DEBUG: Step 2 input saved and verified with size {verify_img.size}\n")
+            log.debug("Step 2 input saved and verified with size %s", verify_img.size)
             
             try:
-                run_esrgan_upscale(ESRGAN_SCRIPT.parent, ESRGAN_ROOT, input_file_name, 2)
+                with trace.stage("upscale_2") as span:
+                    final_output_image = run_esrgan_upscale(ESRGAN_SCRIPT.parent, paths.esrgan_dir, input_file_name, 2, span)
             except Exception as e:
-                sys.stderr.write(f"ESRGAN Step 2 failed: {str(e)}\n")
+                log.error("ESRGAN Step 2 failed: %s", e)
                 raise
-
-            # Search for output files from Step 2
-            output_files_step2 = []
-            for ext in ["*.png", "*.jpg", "*.jpeg"]:
-                output_files_step2.extend(list(ESRGAN_OUTPUT_DIR.glob(ext)))
-            if not output_files_step2:
-                for ext in ["*.png", "*.jpg", "*.jpeg"]:
-                    output_files_step2.extend(list(ESRGAN_OUTPUT_DIR.glob(f"*/{ext}")))
-            if not output_files_step2:
-                for ext in ["*.png", "*.jpg", "*.jpeg"]:
-                    output_files_step2.extend(list(ESRGAN_OUTPUT_DIR.glob(f"**/{ext}")))
-            
-            if not output_files_step2:
-                output_contents = list(ESRGAN_OUTPUT_DIR.rglob("*"))
-                content_names = [str(p.relative_to(ESRGAN_OUTPUT_DIR)) for p in output_contents[:20]]
-                sys.stderr.write(f"ESRGAN Step 2 output files not found. Contents: {content_names}\n")
-                raise HTTPException(status_code=500, detail=f"ESRGAN Step 2 output not found. Contents: {content_names}")
-            
-            final_output_image = max(output_files_step2, key=lambda p: p.stat().st_mtime)
-            sys.stderr.write(f"DEBUG: ESRGAN Step 2 output found: {final_output_image}\n")
         else:
             final_output_image = first_output_image
 
-        sys.stderr.write(f"DEBUG: Copying output to parser: {final_output_image} -> {final_input_for_face_parsing}\n")
+        log.debug("Copying output to parser: %s -> %s", final_output_image, final_input_for_face_parsing)
         shutil.copy(final_output_image, final_input_for_face_parsing)
 
     # --- Run Face Parsing Script ---
     if not FACE_PARSING_SCRIPT.exists():
         raise HTTPException(status_code=500, detail=f"Processing script not found at {FACE_PARSING_SCRIPT}")
 
-    try:
-        completed = subprocess.run(
-            ["python", str(FACE_PARSING_SCRIPT), str(final_input_for_face_parsing), quality, palette],
-            cwd=str(FACE_PARSING_DIR),
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            check=False,
-        )
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to execute processing script: {exc}")
+    output_path = None
+    if face_parser is not None:
+        from renderer import create_math_face, extract_regions
+
+        try:
+            with trace.stage("parse") as span:
+                run_face_parsing(final_input_for_face_parsing, span, paths.label_path)
+            with trace.stage("extract_regions"):
+                extract_regions(str(final_input_for_face_parsing), str(paths.label_path), str(paths.regions_dir))
+            stats = {}
+            with trace.stage("create_math_face") as span:
+                output_path = Path(create_math_face(
+                    palette=palette, output_format=output_format, log_compression=PLACEMENT_LOG_COMPRESSION,
+                    passes=passes, density=density, max_symbols=MAX_SYMBOLS_BY_QUALITY[quality],
+                    on_preview=lambda k, n, image: trace.notify("preview", **{"pass": k, "passes": n, "image": image}),
+                    region_dir=str(paths.regions_dir), stats=stats, encode_speed=encode_speed))
+                span.update(output_size=[stats["width"], stats["height"]], symbols=stats["symbols"])
+            trace.record("encode", stats["encode"], format=output_format, encode_speed=encode_speed,
+                         bytes=output_path.stat().st_size)
+            SYMBOLS_PLACED.observe(stats["symbols"], quality=quality)
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Face parsing failed: {exc}")
+    elif paths is not DEFAULT_PATHS:
+        raise HTTPException(status_code=500, detail="BiSeNet is not resident, the job can't be parsed.")
+    else:
+        try:
+            with trace.stage("face_parsing_script"):
+                completed = subprocess.run(
+                    ["python", str(FACE_PARSING_SCRIPT), str(final_input_for_face_parsing), quality, palette,
+                     output_format, str(density), str(MAX_SYMBOLS_BY_QUALITY[quality]), encode_speed],
+                    cwd=str(FACE_PARSING_DIR),
+                    capture_output=True,
+                    text=True,
+                    encoding='utf-8',
+                    errors='replace',
+                    check=False,
+                )
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Failed to execute processing script: {exc}")
 
-    if completed.returncode != 0:
-        raise HTTPException(status_code=500, detail=f"Script failed: {completed.stderr or completed.stdout}")
+        if completed.returncode != 0:
+            raise HTTPException(status_code=500, detail=f"Script failed: {completed.stderr or completed.stdout}")
 
     # --- Locate and Return Output ---
-    candidates = []
-    for search_dir in [DIVIDED_REGIONS_DIR, FACE_PARSING_DIR, BACKEND_DIR]:
-        for pattern in ["gift_worthy_mathematical_face*", "gift-worthy*"]:
-            for ext in ("png", "jpg", "jpeg", "webp"):
+    if output_path is None or not output_path.exists():
+        candidates = []
+        for search_dir in [DIVIDED_REGIONS_DIR, FACE_PARSING_DIR, BACKEND_DIR]:
+            for pattern in ["gift_worthy_mathematical_face*", "gift-worthy*"]:
                 candidates.extend(
-                    glob.glob(str(search_dir / f"**/{pattern}.{ext}"), recursive=True)
+                    glob.glob(str(search_dir / f"**/{pattern}.{OUTPUT_EXTENSIONS[output_format]}"), recursive=True)
                 )
 
-    if not candidates:
-        raise HTTPException(status_code=500, detail="Processed output not found.")
+        if not candidates:
+            raise HTTPException(status_code=500, detail="Processed output not found.")
 
-    output_path = max((Path(p) for p in candidates), key=lambda p: p.stat().st_mtime)
+        output_path = max((Path(p) for p in candidates), key=lambda p: p.stat().st_mtime)
 
     # Cleanup input file
     try:
@@ -365,15 +863,858 @@ async def process_image(
     except Exception:
         pass
 
-    return FileResponse(path=str(output_path), media_type="image/png")
+    return output_path
+
+
+def input_megapixels(width: int, height: int) -> float:
+    """Megapixels of a width x height upload once prepare_input has capped it to MAX_INPUT_SIDE."""
+    scale = min(1.0, MAX_INPUT_SIDE / max(width, height, 1))
+    return max(width * scale * height * scale / 1e6, 0.01)
+
+
+def check_ready():
+    """Raises 503 with Retry-After until startup warmup is done."""
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail="Server is warming up, retry shortly.",
+                            headers={"Retry-After": str(WARMUP_RETRY_AFTER)})
+
+
+def queue_full(exc: QueueFull) -> HTTPException:
+    return HTTPException(status_code=429, detail=f"Too many {exc.quality} quality requests queued, retry later.",
+                         headers={"Retry-After": str(exc.retry_after)})
+
+
+def admit(data: bytes, quality: str):
+    """Queues the upload for the pipeline and returns its scheduler ticket, or raises 429 with Retry-After.
+
+    Before startup warmup is done it raises 503 instead; an upload that isn't a usable image, 400 or 413.
+    """
+    check_ready()
+    try:
+        return scheduler.submit(quality, input_megapixels(*probe_upload(data)))
+    except QueueFull as exc:
+        raise queue_full(exc)
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """Awaits fn(*args, **kwargs) run in a thread of its own.
+
+    Queued jobs block while they wait for their turn; in a shared pool they could fill every
+    thread and leave none for the job whose turn it is.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def target():
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as exc:
+            loop.call_soon_threadsafe(settle, future.set_exception, exc)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+
+def record_request(quality: str, status: int, seconds: float):
+    """Counts a finished request in the metrics, with its latency if it succeeded."""
+    REQUESTS.inc(quality=quality, status=status)
+    if status == 200:
+        REQUEST_SECONDS.observe(seconds, quality=quality)
+    rss = peak_rss_mb()
+    for process in ("self", "children"):
+        if rss[process] is not None:
+            PEAK_RSS.set(int(rss[process] * 1024 * 1024), process=process)
+
+
+def run_upload(data: bytes, quality: str, palette: str, output_format: str, density: int, passes: int = 1,
+               on_progress=None, encode_speed: str = "balanced", paths: JobPaths = None) -> Path:
+    """prepare_input and run_pipeline for one upload, in paths' folders; logs its stage trace at INFO."""
+    trace = Trace(quality, on_progress)
+    start = time.perf_counter()
+    status = 500
+    try:
+        with trace.stage("preprocess") as span:
+            prepare_input(data, span, paths)
+        output_path = run_pipeline(quality, palette, output_format, density, passes, trace=trace,
+                                   encode_speed=encode_speed, paths=paths)
+        status = 200
+        return output_path
+    except HTTPException as exc:
+        status = exc.status_code
+        raise
+    finally:
+        if log.isEnabledFor(logging.INFO):
+            log.info("trace %s", json.dumps({"quality": quality, "palette": palette, "output_format": output_format,
+                                             "encode_speed": encode_speed, "density": density, "status": status,
+                                             "seconds": round(time.perf_counter() - start, 4),
+                                             "spans": trace.spans}))
+
+
+def run_request(data: bytes, quality: str, palette: str, output_format: str, density: int, passes: int = 1,
+                on_progress=None, ticket=None, encode_speed: str = "balanced") -> Path:
+    """
+    run_upload for one upload in this process, once the scheduler gives it a pipeline slot.
+    ticket is the upload's admit() ticket, admitted here if not given (which may raise 429).
+    Records the request in the metrics.
+    """
+    start = time.perf_counter()
+    status = 500
+    try:
+        ticket = ticket or admit(data, quality)
+        with scheduler.run(ticket):
+            output_path = run_upload(data, quality, palette, output_format, density, passes, on_progress,
+                                     encode_speed)
+        status = 200
+        return output_path
+    except HTTPException as exc:
+        status = exc.status_code
+        raise
+    finally:
+        record_request(quality, status, time.perf_counter() - start)
+
+
+def get_render_pool(broken: ProcessPoolExecutor = None):
+    """The batch render pool and its shared memory BufferPool, started on first use.
+
+    The pool's processes load the palettes as they start. broken is a pool a render failed on
+    with BrokenProcessPool (one of its processes died, e.g. killed for memory): if it is still
+    the current pool it is shut down and replaced, once however many renders report it.
+    """
+    global render_pool, render_buffers
+    with render_pool_lock:
+        if broken is not None and render_pool is broken:
+            log.warning("A render process died, restarting the render pool")
+            render_pool.shutdown(wait=False, cancel_futures=True)
+            render_pool = None
+        if render_pool is None:
+            from palettes import get_registry
+            from shared_arrays import BufferPool
+
+            # spawn: forking a process that runs torch and the event loop's threads isn't safe
+            render_pool = ProcessPoolExecutor(RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=get_registry)
+            if render_buffers is None:
+                render_buffers = BufferPool()
+        return render_pool, render_buffers
+
+
+@app.on_event("shutdown")
+def stop_render_pool():
+    if render_pool is not None:
+        render_pool.shutdown(cancel_futures=True)
+        render_buffers.close()
+
+
+def run_batch(items: list, quality: str, palette: str, output_format: str, density: int, encode_speed: str,
+              workdir: Path, on_progress=None):
+    """
+    The pipeline over many uploads at once, in workdir; items is [(name, bytes)]. Each stage runs
+    over the whole batch: decoding (batch_preprocess), one ESRGAN run per upscale pass
+    (batch_upscale_1, batch_upscale_2), BiSeNet in batches (batch_parse) and rendering in the
+    render pool (batch_render), which starts on an image as soon as it is parsed; parsing waits
+    while RENDER_IN_FLIGHT faces per render process are waiting for it.
+
+    on_progress gets the stage events of run_pipeline and, as each image is done,
+    ("image_done", {"index", "name", "output", "symbols"}), output relative to workdir, or
+    ("image_done", {"index", "name", "status", "detail"}) if it failed. Needs the resident BiSeNet.
+    """
+    from parsing import parse_letterboxed_batch, parse_tiled
+    from renderer import render_regions
+
+    if face_parser is None:
+        raise HTTPException(status_code=503, detail="BiSeNet is not resident, batches can't be parsed.")
+    trace = Trace(quality, on_progress)
+    start = time.perf_counter()
+    status = 500
+    esrgan_dir = workdir / "esrgan"
+    for folder in (esrgan_dir / "inputs", esrgan_dir / "results", workdir / "regions"):
+        folder.mkdir(parents=True, exist_ok=True)
+    names = {}
+
+    def failed(stem, status_code, detail):
+        trace.notify("image_done", index=int(stem), name=names.pop(stem), status=status_code, detail=detail)
+
+    try:
+        with trace.stage("batch_preprocess") as span:
+            for i, (name, data) in enumerate(items):
+                stem = f"{i:04d}"
+                names[stem] = name
+                try:
+                    Image.fromarray(decode_upload(data)).save(esrgan_dir / "inputs" / f"{stem}.jpg", format="JPEG",
+                                                              quality=85)
+                except HTTPException as exc:
+                    failed(stem, exc.status_code, exc.detail)
+            span["images"] = len(names)
+        sources = {stem: esrgan_dir / "inputs" / f"{stem}.jpg" for stem in names}
+
+        if quality in {"medium", "high"}:
+            with trace.stage("batch_upscale_1") as span:
+                sources = run_esrgan_batch(ESRGAN_SCRIPT.parent, esrgan_dir, 1, span)
+            if quality == "high":
+                # The second pass upscales the first's outputs, cropped to even sides
+                for path in (esrgan_dir / "inputs").iterdir():
+                    path.unlink()
+                for stem, path in sources.items():
+                    with Image.open(path) as img:
+                        img.crop((0, 0, img.width - img.width % 2, img.height - img.height % 2)).convert("RGB").save(
+                            esrgan_dir / "inputs" / f"{stem}.jpg", format="JPEG", quality=95)
+                    path.unlink()
+                with trace.stage("batch_upscale_2") as span:
+                    sources = run_esrgan_batch(ESRGAN_SCRIPT.parent, esrgan_dir, 2, span)
+            for stem in sorted(set(names) - set(sources)):
+                failed(stem, 500, "Upscaling failed.")
+
+        options = dict(palette=palette, output_format=output_format, log_compression=PLACEMENT_LOG_COMPRESSION,
+                       density=density, max_symbols=MAX_SYMBOLS_BY_QUALITY[quality], encode_speed=encode_speed)
+        _, buffers = get_render_pool()
+        in_flight = threading.Semaphore(RENDER_PROCESSES * RENDER_IN_FLIGHT)
+        rendering = threading.Condition()
+        outstanding = set()
+
+        def render(stem, refs, retry=True):
+            pool, _ = get_render_pool()
+            try:
+                future = pool.submit(render_regions, refs[0], refs[1], str(workdir / "regions" / stem), **options)
+            except BrokenProcessPool:
+                pool, _ = get_render_pool(broken=pool)
+                future = pool.submit(render_regions, refs[0], refs[1], str(workdir / "regions" / stem), **options)
+            future.add_done_callback(lambda f: rendered(f, pool, stem, refs, retry))
+
+        def rendered(future, pool, stem, refs, retry):
+            try:
+                output_path, stats = future.result()
+            except BrokenProcessPool:
+                # A render process died, under this image or another one of the pool's: each
+                # image it took down gets one more try on a new pool
+                if retry:
+                    get_render_pool(broken=pool)
+                    try:
+                        render(stem, refs, retry=False)
+                        return
+                    except Exception as exc:
+                        log.warning("Render of batch image %s could not be retried: %s", stem, exc)
+                failed(stem, 500, "Rendering failed: the render process died.")
+                finish(stem, refs)
+                return
+            except Exception as exc:
+                failed(stem, 500, f"Rendering failed: {exc}")
+                finish(stem, refs)
+                return
+            SYMBOLS_PLACED.observe(stats["symbols"], quality=quality)
+            trace.notify("image_done", index=int(stem), name=names.pop(stem),
+                         output=str(Path(output_path).relative_to(workdir)), symbols=stats["symbols"])
+            finish(stem, refs)
+
+        def finish(stem, refs):
+            """The image is done with: its buffers and its in-flight slot go back, batch_render stops waiting for it."""
+            for ref in refs:
+                buffers.release(ref)
+            in_flight.release()
+            with rendering:
+                outstanding.discard(stem)
+                rendering.notify_all()
+
+        with trace.stage("batch_parse") as span:
+            stems = sorted(sources)
+            for first in range(0, len(stems), BATCH_PARSE_SIZE):
+                chunk = stems[first:first + BATCH_PARSE_SIZE]
+                images = []
+                for stem in chunk:
+                    with Image.open(sources[stem]) as img:
+                        images.append(np.asarray(img.convert("RGB")))
+                if BISENET_TILE:
+                    labels = [parse_tiled(face_parser, image, tile=BISENET_TILE) for image in images]
+                else:
+                    labels = parse_letterboxed_batch(face_parser, images, batch_size=BATCH_PARSE_SIZE)
+                for stem, image, label in zip(chunk, images, labels):
+                    in_flight.acquire()
+                    refs = (buffers.put(image), buffers.put(label))
+                    with rendering:
+                        outstanding.add(stem)
+                    try:
+                        render(stem, refs)
+                    except Exception:
+                        finish(stem, refs)
+                        raise
+            span["images"] = len(stems)
+        with trace.stage("batch_render") as span:
+            with rendering:
+                rendering.wait_for(lambda: not outstanding)
+            span.update(images=len(stems), processes=RENDER_PROCESSES)
+        status = 200
+    except HTTPException as exc:
+        status = exc.status_code
+        raise
+    finally:
+        if log.isEnabledFor(logging.INFO):
+            log.info("batch trace %s", json.dumps({"quality": quality, "palette": palette,
+                                                   "output_format": output_format, "images": len(items),
+                                                   "status": status, "seconds": round(time.perf_counter() - start, 4),
+                                                   "spans": trace.spans}))
+
+
+def enqueue_job(quality: str, megapixels: float, options: dict, files: dict) -> str:
+    """Writes files ({relative path: bytes}) into a new job folder and queues the job; 429 if the tier's queue is full."""
+    job_id = uuid.uuid4().hex
+    job_dir = JOBS_DIR / job_id
+    for name, data in files.items():
+        (job_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (job_dir / name).write_bytes(data)
+    try:
+        job_queue.submit(job_id, quality, scheduler.estimate(quality, megapixels),
+                         dict(options, megapixels=megapixels), QUEUE_LIMITS[quality])
+    except QueueFull as exc:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        REJECTED.inc(quality=quality)
+        raise queue_full(exc)
+    log.debug("Job %s queued", job_id)
+    return job_id
+
+
+def submit_job(data: bytes, quality: str, options: dict) -> str:
+    """
+    Queues the upload as a job for the workers (JOB_QUEUE) and returns its id. Raises as admit():
+    503 before warmup is done, 400 or 413 for an unusable upload, 429 when the tier's queue is full.
+    options are run_upload's (palette, output_format, density, passes, encode_speed).
+    """
+    check_ready()
+    return enqueue_job(quality, input_megapixels(*probe_upload(data)), options, {JOB_UPLOAD_NAME: data})
+
+
+def poll_job(job_id: str, after: int):
+    """The job (None if it's gone) and its events after seq `after`; the job is read first, so no event is missed."""
+    return job_queue.get(job_id), job_queue.read_events(job_id, after)
+
+
+async def follow_job(job_id: str):
+    """Yields the job's progress events as its worker publishes them, until the job has finished."""
+    seq = 0
+    while True:
+        job, events = await asyncio.to_thread(poll_job, job_id, seq)
+        for seq, event, payload in events:
+            if event == "stage_done":
+                STAGE_SECONDS.observe(payload["seconds"], quality=job.quality, stage=payload["stage"])
+            yield event, payload
+        if job is None or job.status in (DONE, FAILED):
+            return
+        await asyncio.sleep(JOB_POLL_SECONDS)
+
+
+def job_output(job_id: str) -> Path:
+    """
+    The finished job's output, or its error as an HTTPException. Its placement log replaces the
+    one GET /placements serves, and the request is recorded in the metrics.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=500, detail="The job was lost.")
+    if job.status == FAILED:
+        record_request(job.quality, job.error["status"], time.time() - job.submitted)
+        raise HTTPException(status_code=job.error["status"], detail=job.error["detail"])
+
+    job_dir = JOBS_DIR / job_id
+    if job.result.get("placement_log"):
+        placement_log = job_dir / job.result["placement_log"]
+        for old in DIVIDED_REGIONS_DIR.glob("symbol_placements.mfpl*"):
+            old.unlink(missing_ok=True)
+        shutil.move(str(placement_log), str(DIVIDED_REGIONS_DIR / placement_log.name))
+    scheduler.observe(job.quality, job.result["seconds"], job.params["megapixels"])
+    record_request(job.quality, 200, time.time() - job.submitted)
+    return job_dir / job.result["output"]
+
+
+def discard_job(job_id: str):
+    """Drops the job from the queue and deletes its folder, unless a worker is still running it (see worker.run_job)."""
+    if job_queue.delete(job_id) != JOB_RUNNING:
+        shutil.rmtree(JOBS_DIR / job_id, ignore_errors=True)
+
+
+async def run_job(data: bytes, quality: str, options: dict) -> str:
+    """submit_job, then waits for the job to finish; returns its id for job_output and discard_job."""
+    job_id = submit_job(data, quality, options)
+    try:
+        async for _ in follow_job(job_id):
+            pass
+    except BaseException:
+        # The client went away: the job's result has no one to go to
+        discard_job(job_id)
+        raise
+    return job_id
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware refusing an upload over its UPLOAD_LIMITS with 413: by its Content-Length
+    before its body is read, otherwise as soon as the body received passes the limit, before the
+    rest is parsed (and spooled to disk by the multipart parser).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = UPLOAD_LIMITS.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        too_large = JSONResponse(status_code=413, content={"detail": f"Upload is larger than {limit} bytes."})
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit + MULTIPART_OVERHEAD_BYTES:
+            await too_large(scope, receive, send)
+            return
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit + MULTIPART_OVERHEAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Upload is larger than {limit} bytes.")
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as exc:
+            # Raised from limited_receive outside a route's exception handling
+            if exc.status_code != 413 or started:
+                raise
+            await too_large(scope, receive, send)
+
+
+app.add_middleware(UploadSizeLimit)
+
+
+async def read_upload(file: UploadFile, limit: int = MAX_UPLOAD_BYTES) -> bytes:
+    """The uploaded file's bytes, read in chunks: 413 as soon as they pass limit, 400 if empty."""
+    chunks, size = [], 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=f"Upload is larger than {limit} bytes.")
+        chunks.append(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    return b"".join(chunks)
+
+
+@app.post("/process")
+async def process_image(
+    request: Request,
+    file: UploadFile = File(...),
+    quality: str = Form("high"),
+    density: int = Form(50),
+    palette: str = Form("math"),
+    output_format: str = Form(None),
+    encode_speed: str = Form("balanced"),
+):
+    """
+    Save upload, run optional ESRGAN upscaling, run face parsing script, return image.
+    Without output_format the image format is negotiated from the Accept header.
+    """
+    headers = {}
+    if not output_format:
+        output_format = negotiate_output_format(request.headers.get("accept", ""))
+        headers["Vary"] = "Accept"
+    quality, palette, output_format, encode_speed = validate_options(quality, palette, output_format, density,
+                                                                     encode_speed)
+
+    data = await read_upload(file)
+
+    if job_queue is not None:
+        job_id = await run_job(data, quality, {"palette": palette, "output_format": output_format,
+                                               "density": density, "passes": 1, "encode_speed": encode_speed})
+        try:
+            output_path = job_output(job_id)
+        except BaseException:
+            discard_job(job_id)
+            raise
+        return FileResponse(path=str(output_path), media_type=OUTPUT_MEDIA_TYPES[output_format], headers=headers,
+                            background=BackgroundTask(discard_job, job_id))
+
+    ticket = admit(data, quality)
+    output_path = await run_in_thread(run_request, data, quality, palette, output_format, density, ticket=ticket,
+                                      encode_speed=encode_speed)
+
+    return FileResponse(path=str(output_path), media_type=OUTPUT_MEDIA_TYPES[output_format], headers=headers)
+
+
+
+def data_url(data: bytes, media_type: str) -> str:
+    return f"data:{media_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def encode_preview(image: Image.Image) -> str:
+    """A render pass preview as a JPEG data URL (the canvas is opaque, so nothing is lost but detail)."""
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return data_url(buffer.getvalue(), "image/jpeg")
+
+
+@app.post("/process/stream")
+async def process_image_stream(
+    file: UploadFile = File(...),
+    quality: str = Form("high"),
+    density: int = Form(50),
+    palette: str = Form("math"),
+    output_format: str = Form("png"),
+    encode_speed: str = Form("balanced"),
+    passes: int = Form(3),
+):
+    """
+    Same as /process, but runs as a job and streams its progress as server-sent events:
+    "stage" as each stage starts, "stage_done" with its span (see Trace), "preview" with a JPEG
+    data URL of the canvas after each coarse render pass, then "result" with the output as a
+    data URL, or "error".
+    """
+    quality, palette, output_format, encode_speed = validate_options(quality, palette, output_format, density,
+                                                                     encode_speed)
+    passes = min(max(passes, 1), MAX_RENDER_PASSES)
+
+    data = await read_upload(file)
+
+    if job_queue is not None:
+        job_id = submit_job(data, quality, {"palette": palette, "output_format": output_format, "density": density,
+                                            "passes": passes, "encode_speed": encode_speed})
+
+        async def job_stream():
+            try:
+                async for event, payload in follow_job(job_id):
+                    yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                try:
+                    output = job_output(job_id).read_bytes()
+                    event, payload = "result", {"image": data_url(output, OUTPUT_MEDIA_TYPES[output_format])}
+                except HTTPException as exc:
+                    event, payload = "error", {"status": exc.status_code, "detail": exc.detail}
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+            finally:
+                discard_job(job_id)
+
+        return StreamingResponse(job_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    ticket = admit(data, quality)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event, payload):
+        loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+
+    def on_progress(event, payload):
+        if event == "preview":
+            payload = dict(payload, image=encode_preview(payload["image"]))
+        emit(event, payload)
+
+    def job():
+        try:
+            output_path = run_request(data, quality, palette, output_format, density, passes, on_progress, ticket,
+                                      encode_speed)
+            emit("result", {"image": data_url(output_path.read_bytes(), OUTPUT_MEDIA_TYPES[output_format])})
+        except HTTPException as exc:
+            emit("error", {"status": exc.status_code, "detail": exc.detail})
+        except Exception as exc:
+            emit("error", {"status": 500, "detail": str(exc)})
+        finally:
+            emit(None, None)
+
+    # A thread of its own, see run_in_thread
+    threading.Thread(target=job, daemon=True).start()
+
+    async def event_stream():
+        while True:
+            event, payload = await events.get()
+            if event is None:
+                break
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def read_batch(files: List[UploadFile]):
+    """
+    The batch's images as [(name, bytes)], zip archives unpacked, and [(name, HTTPException)] for
+    those over MAX_UPLOAD_BYTES. 413 past MAX_BATCH_BYTES (unzipped) or MAX_BATCH_IMAGES, 400 if empty.
+    """
+    items, rejected, total = [], [], 0
+
+    def add(name, data):
+        nonlocal total
+        total += len(data)
+        if total > MAX_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail=f"Batch is larger than {MAX_BATCH_BYTES} bytes.")
+        if len(data) > MAX_UPLOAD_BYTES:
+            rejected.append((name, HTTPException(status_code=413,
+                                                 detail=f"Image is larger than {MAX_UPLOAD_BYTES} bytes.")))
+        else:
+            items.append((name, data))
+        if len(items) + len(rejected) > MAX_BATCH_IMAGES:
+            raise HTTPException(status_code=413, detail=f"Batch has more than {MAX_BATCH_IMAGES} images.")
+
+    for file in files:
+        data = await read_upload(file, MAX_BATCH_BYTES)
+        if not zipfile.is_zipfile(io.BytesIO(data)):
+            add(file.filename or f"image_{len(items) + len(rejected) + 1}", data)
+            continue
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name or name.startswith(".") or info.filename.startswith("__MACOSX/"):
+                    continue
+                # Read at most one byte past the limit, whatever the header claims (zip bombs)
+                with archive.open(info) as member:
+                    add(name, member.read(MAX_UPLOAD_BYTES + 1))
+    if not items and not rejected:
+        raise HTTPException(status_code=400, detail="No images in the batch.")
+    return items, rejected
+
+
+class ZipStream:
+    """A write-only file for zipfile.ZipFile that hands out what has been written so far (see take)."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+async def local_batch_events(ticket, items: list, options: dict, workdir: Path, release):
+    """run_batch in a thread of its own once the ticket's turn comes; yields its events, then its error if any."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event, payload):
+        loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+
+    def job():
+        try:
+            with scheduler.run(ticket):
+                run_batch(items, ticket.quality, workdir=workdir, on_progress=emit, **options)
+        except HTTPException as exc:
+            emit("error", {"status": exc.status_code, "detail": exc.detail})
+        except Exception as exc:
+            emit("error", {"status": 500, "detail": str(exc)})
+        finally:
+            release()
+            emit(None, None)
+
+    threading.Thread(target=job, daemon=True).start()
+    while True:
+        event, payload = await events.get()
+        if event is None:
+            return
+        yield event, payload
+
+
+async def no_events():
+    return
+    yield
+
+
+async def queued_batch_events(job_id: str):
+    """follow_job for a batch job, then its error if it failed."""
+    async for event, payload in follow_job(job_id):
+        yield event, payload
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        yield "error", {"status": 500, "detail": "The job was lost."}
+    elif job.status == FAILED:
+        yield "error", job.error
+
+
+async def batch_zip(events, names: list, rejected: list, workdir: Path, quality: str, output_format: str, release):
+    """
+    The zip /process/batch streams: each output as it is done, named after its upload, then
+    manifest.json with every image's outcome. names are the uploads run_batch was given, in order.
+    """
+    stream = ZipStream()
+    manifest = [{"name": name, "status": exc.status_code, "detail": exc.detail} for name, exc in rejected]
+    entries = [None] * len(names)
+    used = set()
+    try:
+        with zipfile.ZipFile(stream, "w") as archive:
+            async for event, payload in events:
+                if event == "error":
+                    # The batch failed: whatever is left failed with it
+                    for i, name in enumerate(names):
+                        if entries[i] is None:
+                            entries[i] = {"name": name, "status": payload["status"], "detail": payload["detail"]}
+                if event != "image_done":
+                    continue
+                entry = {"name": payload["name"]}
+                if "output" in payload:
+                    stem = Path(payload["name"]).stem or "image"
+                    arcname, n = f"{stem}.{OUTPUT_EXTENSIONS[output_format]}", 1
+                    while arcname in used:
+                        n += 1
+                        arcname = f"{stem}_{n}.{OUTPUT_EXTENSIONS[output_format]}"
+                    used.add(arcname)
+                    await asyncio.to_thread(archive.write, workdir / payload["output"], arcname)
+                    entry.update(status=200, output=arcname, symbols=payload["symbols"])
+                else:
+                    entry.update(status=payload["status"], detail=payload["detail"])
+                entries[payload["index"]] = entry
+                yield stream.take()
+            manifest += [entry or {"name": name, "status": 500, "detail": "The image was not processed."}
+                         for name, entry in zip(names, entries)]
+            for entry in manifest:
+                BATCH_IMAGES.inc(quality=quality, status=entry["status"])
+            archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        yield stream.take()
+    finally:
+        release()
+
+
+@app.post("/process/batch")
+async def process_batch(
+    files: List[UploadFile] = File(...),
+    quality: str = Form("high"),
+    density: int = Form(50),
+    palette: str = Form("math"),
+    output_format: str = Form("png"),
+    encode_speed: str = Form("balanced"),
+):
+    """
+    Many portraits in one style: files are images, or zip archives of them. Runs each stage over
+    the whole batch (see run_batch) and streams back a zip of the outputs as they are done, named
+    after their uploads, then manifest.json with every image's outcome (status, and detail or
+    the output's name and symbol count). The batch queues as one request of its quality tier.
+    """
+    quality, palette, output_format, encode_speed = validate_options(quality, palette, output_format, density,
+                                                                     encode_speed)
+    items, rejected = await read_batch(files)
+
+    check_ready()
+    usable, megapixels = [], 0.0
+    for name, data in items:
+        try:
+            megapixels += input_megapixels(*probe_upload(data))
+            usable.append((name, data))
+        except HTTPException as exc:
+            rejected.append((name, exc))
+    names = [name for name, _ in usable]
+    options = {"palette": palette, "output_format": output_format, "density": density, "encode_speed": encode_speed}
+
+    if not usable:
+        events, workdir, release = no_events(), None, lambda: None
+    elif job_queue is not None:
+        job_id = enqueue_job(quality, max(megapixels, 0.01), dict(options, batch=names),
+                             {f"batch/{i:04d}": data for i, (_, data) in enumerate(usable)})
+        events = queued_batch_events(job_id)
+        workdir = JOBS_DIR / job_id
+        release = lambda: discard_job(job_id)
+    else:
+        if face_parser is None:
+            raise HTTPException(status_code=503, detail="BiSeNet is not resident, batches can't be parsed.")
+        try:
+            ticket = scheduler.submit(quality, max(megapixels, 0.01))
+        except QueueFull as exc:
+            raise queue_full(exc)
+        workdir = Path(tempfile.mkdtemp(prefix="batch_"))
+        # The folder goes once both the batch and the zip stream are done with it
+        holders, lock = [2], threading.Lock()
+
+        def release():
+            with lock:
+                holders[0] -= 1
+                if holders[0] == 0:
+                    shutil.rmtree(workdir, ignore_errors=True)
+
+        events = local_batch_events(ticket, usable, options, workdir, release)
+
+    return StreamingResponse(batch_zip(events, names, rejected, workdir, quality, output_format, release),
+                             media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="batch.zip"'})
+
+
+@app.get("/placements")
+def get_placements(request: Request):
+    """Placement log of the last render, for the animation frontend.
+
+    A compressed log goes out with Content-Encoding when the client accepts it, so browsers
+    hand the raw log to fetch(); otherwise as the compressed file itself.
+    """
+    logs = list(DIVIDED_REGIONS_DIR.glob("symbol_placements.mfpl*"))
+    if not logs:
+        raise HTTPException(status_code=404, detail="No placement log yet. Process an image first.")
+    log_path = max(logs, key=lambda p: p.stat().st_mtime)
+
+    if log_path.suffix not in PLACEMENT_LOG_ENCODINGS:
+        return FileResponse(path=str(log_path), media_type="application/octet-stream")
+    encoding, media_type = PLACEMENT_LOG_ENCODINGS[log_path.suffix]
+    accepted = {e.split(";")[0].strip() for e in request.headers.get("accept-encoding", "").split(",")}
+    if encoding in accepted:
+        return FileResponse(path=str(log_path), media_type="application/octet-stream",
+                            headers={"Content-Encoding": encoding})
+    return FileResponse(path=str(log_path), media_type=media_type, filename=log_path.name)
+
+
+@app.get("/palettes")
+def get_palettes():
+    """Available palettes with a short symbol preview, for the frontend's palette picker."""
+    from palettes import list_palettes
+
+    return list_palettes()
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint: request and stage latency histograms per quality tier, and more."""
+    if job_queue is not None:
+        # The queue gauges of the jobs queued for the workers, rather than of this process's scheduler
+        stats = job_queue.stats()
+        for quality in QUEUE_LIMITS:
+            tier = stats.get(quality, {})
+            QUEUE_DEPTH.set(tier.get("pending", 0), quality=quality)
+            RUNNING.set(tier.get("running", 0), quality=quality)
+            QUEUED_COST.set(tier.get("pending_cost", 0.0), quality=quality)
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
 
 
 # --- Health check endpoint for Hugging Face ---
 @app.get("/health")
 def health_check():
+    """Liveness: the process is up. Route traffic by /ready instead."""
     return {"status": "healthy"}
 
 
+@app.get("/ready")
+def readiness_check():
+    """
+    Readiness: 503 until startup warmup is done, then 200, or 503 for good if a required step
+    failed (named in "failed"); all with the warmup steps so far.
+    """
+    if not ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "warming_up", "warmup": warmup_report})
+    if warmup_failed:
+        return JSONResponse(status_code=503, content={"status": "failed", "failed": warmup_failed,
+                                                      "warmup": warmup_report})
+    return {"status": "ready", "warmup": warmup_report}
+
+
 # --- Serve React Frontend (Static Files) ---
 # Serve index.html for root and SPA routing
 @app.get("/", response_class=FileResponse)
@@ -0,0 +1,20 @@
+"""
+Puts the backend, its benchmarks, face-parsing.PyTorch and Real-ESRGAN (with its scripts) on
+sys.path, so the tests import their modules as the server and the scripts do.
+"""
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+PATHS = [
+    BACKEND_DIR,
+    BACKEND_DIR / "benchmarks",
+    BACKEND_DIR / "face-parsing.PyTorch",
+    BACKEND_DIR / "Real-ESRGAN",
+    BACKEND_DIR / "Real-ESRGAN" / "scripts",
+]
+
+for _path in PATHS:
+    if str(_path) not in sys.path:
+        sys.path.insert(0, str(_path))
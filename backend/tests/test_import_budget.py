@@ -0,0 +1,24 @@
+"""
+Import-time budget of the modules the API and the workers import (benchmarks/bench_import.py
+prints the full report). IMPORT_BUDGET_SCALE multiplies the budgets on slow machines.
+"""
+import os
+
+import pytest
+
+from bench_import import ENTRY_POINTS, profile
+
+BUDGET_SCALE = float(os.getenv("IMPORT_BUDGET_SCALE", "1"))
+REPEATS = 2
+
+
+@pytest.mark.parametrize("module", sorted(ENTRY_POINTS))
+def test_import_budget(module):
+    limits = ENTRY_POINTS[module]
+    runs = [profile(module) for _ in range(REPEATS)]
+    imported = min(runs, key=lambda r: r[module])
+
+    forbidden = sorted(name for name in limits["forbidden"] if name in imported)
+    assert not forbidden, f"import {module} loads {forbidden}"
+    budget = limits["budget"] * BUDGET_SCALE
+    assert imported[module] <= budget, f"import {module} took {imported[module]:.2f} s, budget {budget:.2f} s"
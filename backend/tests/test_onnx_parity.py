@@ -0,0 +1,79 @@
+"""
+The onnxruntime backends against the torch models they are exported from: small random-weight
+networks are exported with the scripts' own helpers, loaded the way the pipeline loads them
+(load_parser / RealESRGANer with backend="onnxruntime") and compared on the scripts' input shapes.
+"""
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+
+ATOL = 1e-3
+
+
+@pytest.fixture
+def bisenet(monkeypatch):
+    import resnet
+    from model import BiSeNet, BiSeNetInference
+    from parsing import N_CLASSES
+
+    # No pretrained backbone download; the weights only need to be the same on both sides
+    monkeypatch.setattr(resnet.Resnet18, "init_weight", lambda self: None)
+    torch.manual_seed(0)
+    return BiSeNetInference(BiSeNet(n_classes=N_CLASSES)).eval()
+
+
+def test_bisenet_parity(bisenet, tmp_path, monkeypatch):
+    import parsing
+    from export_bisenet import PARITY_SHAPES
+    from model import fuse_for_inference
+    from ort_runner import OnnxRuntimeModel, check_parity
+
+    path = str(tmp_path / "bisenet.onnx")
+    parsing.export_onnx(fuse_for_inference(bisenet, channels_last=False), path)
+    monkeypatch.setattr(parsing, "ONNX_ARTIFACT", path)
+    runner = parsing.load_parser(backend="onnxruntime")
+    assert isinstance(runner, OnnxRuntimeModel)
+
+    check_parity(bisenet, runner, PARITY_SHAPES, ATOL)
+
+    image = np.random.default_rng(0).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+    expected = parsing.parse_letterboxed(bisenet, image, device=torch.device("cpu"))
+    np.testing.assert_array_equal(parsing.parse_letterboxed(runner, image), expected)
+
+
+def srvgg():
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+    return SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=16, num_conv=4, upscale=4, act_type="prelu"), 4
+
+
+def rrdbnet():
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+
+    return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=16, num_block=1, num_grow_ch=8, scale=2), 2
+
+
+@pytest.mark.parametrize("build", [srvgg, rrdbnet], ids=["SRVGGNetCompact", "RRDBNet"])
+def test_realesrgan_parity(build, tmp_path):
+    pytest.importorskip("basicsr")
+    from ort_runner import check_parity
+    from pytorch2onnx import PARITY_SHAPES, export_onnx
+    from realesrgan import RealESRGANer
+
+    torch.manual_seed(0)
+    model, scale = build()
+    model.eval()
+    path = str(tmp_path / "model.onnx")
+    export_onnx(model, path)
+
+    cpu = torch.device("cpu")
+    upsampler = RealESRGANer(scale=scale, model_path=path, backend="onnxruntime")
+    check_parity(model, upsampler.model, PARITY_SHAPES, ATOL)
+
+    image = np.random.default_rng(0).integers(0, 256, (40, 56, 3), dtype=np.uint8)
+    expected, _ = RealESRGANer(scale=scale, model_path=None, model=model, device=cpu).enhance(image)
+    output, _ = upsampler.enhance(image)
+    assert output.shape == expected.shape == (40 * scale, 56 * scale, 3)
+    assert np.abs(output.astype(int) - expected.astype(int)).max() <= 1
@@ -0,0 +1,147 @@
+"""
+Pipeline worker: takes jobs off the API's JOB_QUEUE (jobqueue.py) and runs them with the models
+resident, each in its own folder under JOBS_DIR, where the API picks up the output and the
+placement log. Progress (stages, spans, previews) goes back through the queue.
+
+Start as many as the box has cores and memory for, with the API's JOB_QUEUE and JOBS_DIR, on
+any box that shares both; every process loads the models (and warms up, see server.warmup)
+before it takes a job. SIGTERM lets the job in hand finish first.
+
+Usage:
+    JOB_QUEUE=sqlite:///data/jobs.db JOBS_DIR=/data/jobs python worker.py --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import shutil
+import threading
+import time
+
+from fastapi import HTTPException
+
+import server
+from jobqueue import JOB_HEARTBEAT_SECONDS
+
+log = logging.getLogger("server")
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def heartbeat(job_id, stop):
+    """Renews the job's lease every JOB_HEARTBEAT_SECONDS until stop is set."""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        server.job_queue.renew(job_id)
+
+
+def run_job(job):
+    """
+    Runs one claimed job and records its result, or its error, in the queue, renewing its lease
+    while it runs. A job the API dropped meanwhile (its client went away) has its folder deleted here.
+    """
+    queue = server.job_queue
+    job_dir = server.JOBS_DIR / job.id
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job.id, stop), name=f"heartbeat-{job.id}", daemon=True).start()
+    try:
+        execute(job, job_dir)
+    finally:
+        stop.set()
+        if queue.get(job.id) is None:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def execute(job, job_dir):
+    """The job's pipeline run; its result or error goes to the queue."""
+    queue = server.job_queue
+    paths = server.JobPaths.for_job(job_dir)
+    options = job.params
+
+    def on_progress(event, payload):
+        if event == "preview":
+            payload = dict(payload, image=server.encode_preview(payload["image"]))
+        queue.publish(job.id, event, payload)
+
+    start = time.perf_counter()
+    try:
+        if "batch" in options:
+            # A /process/batch job: its uploads are batch/0000, batch/0001, ... in options["batch"] order
+            items = [(name, (job_dir / "batch" / f"{i:04d}").read_bytes()) for i, name in enumerate(options["batch"])]
+            server.run_batch(items, job.quality, options["palette"], options["output_format"], options["density"],
+                             options["encode_speed"], job_dir, on_progress)
+            queue.finish(job.id, {"seconds": round(time.perf_counter() - start, 4)})
+            return
+        data = (job_dir / server.JOB_UPLOAD_NAME).read_bytes()
+        output_path = server.run_upload(data, job.quality, options["palette"], options["output_format"],
+                                        options["density"], options["passes"], on_progress,
+                                        options["encode_speed"], paths)
+        logs = sorted(paths.regions_dir.glob("symbol_placements.mfpl*"), key=lambda p: p.stat().st_mtime)
+        queue.finish(job.id, {"output": str(output_path.relative_to(job_dir)),
+                              "placement_log": str(logs[-1].relative_to(job_dir)) if logs else None,
+                              "seconds": round(time.perf_counter() - start, 4)})
+    except HTTPException as exc:
+        queue.fail(job.id, exc.status_code, exc.detail)
+    except Exception as exc:
+        log.exception("Job %s failed", job.id)
+        queue.fail(job.id, 500, str(exc))
+
+
+def serve(name, stop=None, poll_seconds=server.JOB_POLL_SECONDS):
+    """Claims and runs jobs until stop (a threading.Event) is set."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        job = server.job_queue.claim(name, server.JOB_TIER_CONCURRENCY)
+        if job is None:
+            stop.wait(poll_seconds)
+            continue
+        log.debug("Worker %s took job %s", name, job.id)
+        run_job(job)
+
+
+def work():
+    """One worker process: loads the models, then serves until SIGTERM or SIGINT."""
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+    server.warmup(load_models=True)
+    if server.face_parser is None:
+        sys.exit(f"BiSeNet failed to load, see the warmup report: {server.warmup_report}")
+    log.info("Worker %s serving %s", worker_name(), server.JOB_QUEUE)
+    serve(worker_name(), stop)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to run")
+    args = parser.parse_args()
+
+    if server.JOB_QUEUE is None or server.JOB_QUEUE == "memory://":
+        sys.exit("Set JOB_QUEUE to the API's queue, e.g. sqlite:///data/jobs.db (memory:// runs its workers "
+                 "inside the API)")
+    if args.processes <= 1:
+        work()
+        return
+
+    processes = [multiprocessing.get_context("spawn").Process(target=work, name=f"worker-{i}")
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()